@@ -1,142 +1,298 @@
 #!/usr/bin/env python
-from twisted.python import log
-from twisted.internet import reactor, utils
-import os
+from twisted.python import usage
+from twisted.internet import reactor, protocol
+from kyro import probe, stats, archive, decision, control, metrics, logger, timer
+from kyro.util import *
+import numpy
+import sys
 import random
 import time
-import pickle
 
-is_linux = 'Linux' in os.uname()[0]
-
-class Pinger:
+class Pinger(probe.Prober):
+    # Measures latency and loss for every host over every path in-process:
+    # each (host, path) gets a probe on the shared raw socket, tagged with the
+    # path's type of service, and every reply or timeout lands in the sample
+    # store as it happens.  Each sample re-evaluates just that host's prefix.
+    #
+    # Hosts behind the same last hop with the same AS path share one probe per
+    # path (see probe.Prober), the samples are copied to every one of them.
+    #
+    # Probe priorities follow what the prefix is worth measuring: its traffic
+    # weight, how volatile its paths are (jitter relative to latency, plus
+    # loss) and how close the decision engine is to switching it.  Prefixes
+    # the router reports as flapping are left alone until they settle: their
+    # decisions are held and they're only pinged now and then.
     
-    def __init__(self):
-        self.pool = []
-        self.pool_size = 30
-        self.ping_command = os.popen("which ping").read().strip()
-        self.queue = []
-        self.prefixes = []
-        self.running = True
-        self.interval = 90
-        self.completed = 0
+    def __init__(self, paths, interval=5.0, pps=1000, window=60, archive_name=None, aggregate=True):
+        probe.Prober.__init__(self, pps=pps, aggregate=aggregate)
+        self.paths = paths
+        self.path_by_tos = dict((path['probe'], index) for index, path in enumerate(paths))
+        self.path_by_asn = dict((path['asn'], index) for index, path in enumerate(paths) if path['asn'] is not None)
+        self.interval = interval
+        self.samples = stats.SampleStore(window=window)
+        self.archive = archive.ArchiveWriter(archive_name) if archive_name else None
+        self.engine = decision.DecisionEngine()
+        self.volatility_gain = 4.0
+        self.closeness_gain = 4.0
+        self.damped_priority = 0.001
         self.hosts = []
-        self.poll()
+        self.hostinfo = {}
+        self.prefixes = {}
+        # Control channel to the router, when it's up
+        self.router = None
+        self.sample_count = metrics.counter('kyro_analyzer_samples_total', 'Samples recorded, answered or lost')
+        self.decision_count = metrics.counter('kyro_analyzer_decision_changes_total', 'Changes of the path chosen for a prefix')
+        metrics.gauge('kyro_analyzer_hosts', 'Hosts measured').function = lambda: len(self.hosts)
+        metrics.gauge('kyro_analyzer_steered_prefixes', 'Prefixes steered off the path BGP picks').function = lambda: len([choice for choice in self.engine.decisions.itervalues() if self.steered(choice)])
+        metrics.gauge('kyro_analyzer_router_connected', '1 while the router control channel is up').function = lambda: int(self.router is not None)
         self.stats()
+        self.flush()
         
-    def addHost(self, host):
+    def addHost(self, host, prefix=None, weight=1.0):
+        if host in self.hostinfo:
+            return
         hostinfo = {
             'host' : host,
-            'last_ping' : time.time(),
-            'latency' : None,
-            'loss' : None,
-            'interval' : self.interval
+            'prefix' : prefix or host,
+            'interval' : self.interval,
+            'as_path' : None,
+            'weight' : weight,
+            'damped' : False,
         }
         self.hosts.append(hostinfo)
-        if self.running:
-            self.ping(hostinfo)
-
-    def pingCompleted(self, result, hostinfo):
-        self.completed += 1
-        self.pool.remove(hostinfo['host'])
-        self.queuePing(hostinfo)
-        loss = 0.0
-        avg = 0.0
-        for line in result.split('\n'):
-            if is_linux:
-                if 'rtt' in line:
-                    times = line.split()[line.replace(',', '').split().index('ms') - 1]
-                    avg = float(times.split('/')[1])
-                    hostinfo['latency'] = avg
-                if 'loss' in line:
-                    loss = float(line.split()[-5].replace('%', ''))
-                    hostinfo['loss'] = loss
-            else:
-                if 'round-trip' in line:
-                    times = line.split()[-2]
-                    avg = float(times.split('/')[1])
-                    hostinfo['latency'] = avg
-                if 'loss' in line:
-                    print line
-                    loss = float(line.split()[-3].replace('%', ''))
-                    if loss != 100.0: 
-                        hostinfo['loss'] = loss
-        print "ping_complete(%s): %s ms, %.2f%% packet loss" % (hostinfo['host'], avg, loss)
-    
-    def pingFailed(self, reason):
-        print "Ping Failed:"
-        print reason
-    
-    def queuePing(self, hostinfo):
-        next_ping = hostinfo['last_ping'] + hostinfo['interval']
+        self.hostinfo[host] = hostinfo
+        self.prefixes[hostinfo['prefix']] = hostinfo
+        for path in self.paths:
+            self.add(host, path['probe']).interval = self.interval
+
+    def group_key(self, probe):
+        # Same last hop isn't enough if the routes beyond it differ
+        return probe.tos, probe.mapped_ip, self.hostinfo[probe.host]['as_path']
+
+    def replyReceived(self, probe, ms):
+        self.sampleReceived(probe, ms)
+
+    def replyLost(self, probe):
+        self.sampleReceived(probe, None)
+
+    def sampleReceived(self, probe, ms):
+        hostinfo = self.hostinfo[probe.host]
+        path = self.path_by_tos[probe.tos]
         now = time.time()
-        if next_ping < now:
-            if len(self.queue) == 0:
-                self.ping(hostinfo)
+        self.sample_count.inc()
+        self.samples.add((probe.host, path), ms, now)
+        if self.archive:
+            self.archive.append(now, probe.host, ms, path)
+        self.evaluate(hostinfo, now)
+
+    def evaluate(self, hostinfo, now):
+        if hostinfo['damped']:
+            return
+        host = hostinfo['host']
+        per_path = []
+        volatility = 0.0
+        for path in xrange(len(self.paths)):
+            if (host, path) in self.samples:
+                latency, loss, count = self.samples.metrics((host, path))
+                per_path.append((latency, loss, count))
+                if latency > 0:
+                    volatility = max(volatility, self.samples.variation((host, path)) / latency + loss / 100.0)
             else:
-                self.queue.append(hostinfo)
-        else:
-            reactor.callLater(next_ping - now, self.ping, hostinfo)        
+                per_path.append((None, 0.0, 0))
+        change = self.engine.update(hostinfo['prefix'], per_path, now)
+        if change:
+            self.decisionChanged(hostinfo['prefix'], *change)
+        self.prioritize(hostinfo, hostinfo['weight'] * (1.0 + self.volatility_gain * min(volatility, 1.0)) * (1.0 + self.closeness_gain * self.engine.closeness(hostinfo['prefix'])))
+
+    def prioritize(self, hostinfo, priority):
+        for path in self.paths:
+            member = self.probes.get((hostinfo['host'], path['probe']))
+            if member is not None:
+                member.priority = priority
+
+    def pathName(self, path):
+        return 'bgp' if path is None else self.paths[path]['name']
+
+    def decisionChanged(self, prefix, old, new):
+        self.decision_count.inc()
+        logger.info('analyzer.decision', 'decision(%s): %s -> %s', prefix, self.pathName(old), self.pathName(new))
+        if self.router is not None:
+            self.steer(self.router, prefix, new)
+
+    def steer(self, link, prefix, path):
+        # Asks the router to send prefix over path, or to leave it to BGP
+        if '/' not in prefix:
+            return
+        network, length = unprefix(prefix)
+        choice = self.engine.decisions.get(prefix)
+        if path is None or (choice is not None and path == choice.default):
+            link.queueWithdraw(network, length)
+        elif self.paths[path].get('next_hop'):
+            link.queueInject(network, length, long(unip(self.paths[path]['next_hop'])))
+
+    def routerConnected(self, link):
+        # The router may have lost track of our routes, so tell it again.  It
+        # tells us which prefixes are still damped.
+        self.router = link
+        self.dampReceived([(unprefix(hostinfo['prefix']), False) for hostinfo in self.hosts if hostinfo['damped']])
+        for prefix, choice in self.engine.decisions.iteritems():
+            if self.steered(choice):
+                self.steer(link, prefix, choice.path)
+
+    def steered(self, choice):
+        return choice is not None and choice.path is not None and choice.path != choice.default
+
+    def routerLost(self, link):
+        if self.router is link:
+            self.router = None
+
+    def routesReceived(self, routes):
+        # The router's table changed: keep track of which path BGP picks by
+        # itself for the prefixes we measure
+        for (network, length), as_path in routes:
+            name = prefix(network, length)
+            if name not in self.prefixes:
+                continue
+            hostinfo = self.prefixes[name]
+            as_path = tuple(as_path) if as_path is not None else None
+            if as_path != hostinfo['as_path']:
+                # Whatever group the host's probes were in may not fit anymore
+                hostinfo['as_path'] = as_path
+                for path in self.paths:
+                    member = self.probes.get((hostinfo['host'], path['probe']))
+                    if member is not None and member.group is not None:
+                        self.remap(member)
+                        self.reschedule(member, time.time())
+            path = self.path_by_asn.get(as_path[0]) if as_path else None
+            before = self.steered(self.engine.decisions.get(name))
+            self.engine.setDefault(name, path)
+            choice = self.engine.decisions[name]
+            if self.router is not None and self.steered(choice) != before:
+                self.steer(self.router, name, choice.path)
         
-    def ping(self, hostinfo):
-        hostinfo['last_ping'] = time.time()
-        if len(self.pool) < self.pool_size:
-            print "ping_start(%s)" % hostinfo['host']
-            uid = hostinfo['host'] + "_%08s_" % random.randint(0, 99999999)
-            if is_linux:
-                args = "-i 1 -c 100 %s" % hostinfo['host']
+    def dampReceived(self, prefixes):
+        # The router says these prefixes are flapping, or have settled down
+        now = time.time()
+        for (network, length), damped in prefixes:
+            hostinfo = self.prefixes.get(prefix(network, length))
+            if hostinfo is None or hostinfo['damped'] == damped:
+                continue
+            hostinfo['damped'] = damped
+            if damped:
+                self.prioritize(hostinfo, self.damped_priority)
             else:
-                args = "-i 1 -c 100 %s" % hostinfo['host']
-            output = utils.getProcessOutput(self.ping_command, args.split())
-            output.addCallbacks(self.pingCompleted, self.pingFailed, [hostinfo])
-            self.pool.append(hostinfo['host'])
-        else:
-            print "ping_queue(%s)" % hostinfo['host']
-            self.queue.append(hostinfo)
-
-    def poll(self):
-        available = self.pool_size - len(self.pool)
-        if available > 0:
-            for i in range(available):
-                if len(self.queue):
-                    self.ping(self.queue.pop(0))
-        reactor.callLater(1.0, self.poll)
-        
+                self.evaluate(hostinfo, now)
+
+    def flush(self):
+        # Keep what's on disk at most a second behind
+        if self.archive:
+            self.archive.flush()
+        timer.callLater(1.0, self.flush)
+
     def stats(self):
-        measured = len([h for h in self.hosts if h['latency']])
+        latency = self.samples.latency()
+        measured = len(set(key[0] for key, rtt in zip(self.samples.keys, latency) if not numpy.isnan(rtt)))
         hosts = 1 if not len(self.hosts) else len(self.hosts)
-        print "stats:"
-        print "\tqueue: %s" % len(self.queue)
-        print "\trunning: %s" % len(self.pool)
-        print "\tpings: %s" % self.completed
-        print "\tuniques: %s" % measured
-        print "\ttotal hosts: %s" % len(self.hosts)
-        print "\tmeasured: %.2f%%" % (float(measured) / float(hosts) * 100.0)
-        reactor.callLater(10.0, self.stats)
+        logger.info('analyzer.stats', 'STATS: sent: %s\treceived: %s\tlost: %s\tuniques: %s\ttotal hosts: %s\tprobe groups: %s\tinterval scale: %.2f\tmeasured: %.2f%%\tsteered prefixes: %s',
+            self.sent, self.received, self.lost, measured, len(self.hosts), len(self.groups), self.scale, float(measured) / float(hosts) * 100.0,
+            len([d for d in self.engine.decisions.values() if self.steered(d)]))
+        if len(self.samples):
+            with numpy.errstate(invalid='ignore'):
+                p50, p95, p99 = numpy.nanmedian(self.samples.percentiles(), axis=0)
+            logger.info('analyzer.stats', 'STATS: median rtt p50/p95/p99: %.1f/%.1f/%.1f ms\tmedian loss: %.2f%%', p50, p95, p99, numpy.nanmedian(self.samples.loss()))
+        timer.callLater(10.0, self.stats)
+
+# Control channel to the router
+class RouterLink(control.Protocol):
+
+    def connectionMade(self):
+        control.Protocol.connectionMade(self)
+        self.factory.pinger.routerConnected(self)
+
+    def connectionLost(self, reason):
+        control.Protocol.connectionLost(self, reason)
+        self.factory.pinger.routerLost(self)
+
+    def routesReceived(self, routes):
+        self.factory.pinger.routesReceived(routes)
+
+    def dampReceived(self, prefixes):
+        self.factory.pinger.dampReceived(prefixes)
+
+class RouterLinkFactory(protocol.ReconnectingClientFactory):
+    protocol = RouterLink
+    maxDelay = 10
+
+    def __init__(self, pinger):
+        self.pinger = pinger
+
+    def buildProtocol(self, addr):
+        self.resetDelay()
+        return protocol.ReconnectingClientFactory.buildProtocol(self, addr)
         
 if __name__ == "__main__":
+
+    class Options(usage.Options):
+        optFlags = [
+            ['no-aggregate', 'n', 'Ping every host on its own, even behind a shared last hop'],
+        ]
+        optParameters = [
+            ['prefixes', 'p', None, 'File with one prefix per line to measure'],
+            ['interval', 'i', '5', 'Seconds between pings to each host'],
+            ['pps', 'r', '1000', 'Most pings to send per second, across all hosts'],
+            ['window', 'w', '60', 'Samples per host to compute latency and loss over'],
+            ['paths', 'c', None, 'Path config file (see conf/sample.conf), default is a single path'],
+            ['archive', 'a', 'measurements', 'Append every sample to <archive>.dat (with host names in <archive>.hosts and a host index in <archive>.idx)'],
+            ['control', 'k', 'kyro.sock', 'Unix socket of the router control channel'],
+            ['metrics', 'm', '9180', 'Local port serving Prometheus metrics, 0 for none'],
+            ['timer-resolution', 'u', '0.01', 'Seconds per tick of the timer wheel running probe deadlines'],
+        ]
+    try:
+        options = Options()
+        options.parseOptions()
+        config = dict(options)
+    except usage.UsageError, errortext:
+        print '%s: %s' % (sys.argv[0], errortext)
+        print '%s: Try --help for usage details.' % (sys.argv[0])
+        sys.exit(1)
     
-    prefixes = ['64.91.18.0', '182.54.192.0', '202.83.96.0', '165.233.200.0', '138.242.96.0', '20.139.8.0']
+    networks = ['64.91.18.0/24', '182.54.192.0/24', '202.83.96.0/24', '165.233.200.0/24', '138.242.96.0/24', '20.139.8.0/24']
     # Or, for something more useful, create a list of ip prefixes, one per line, 
-    # and save them in ips.txt.  It should look something like this:
+    # and pass it with --prefixes.  It should look something like this:
     #     
     # 64.91.18.0/24
-    # 182.54.192.0/24
+    # 182.54.192.0/24 5
     # 202.83.96.0/24
     #
     # (etc)
     #
-    #prefixes = [p.split('/')[0] for p in open('ips.txt', 'r').readlines() if p]
+    # A number after a prefix weighs it by how much traffic it carries (the
+    # default is 1), heavier prefixes get measured more often.
+    #
+    weights = {}
+    if config['prefixes']:
+        networks = []
+        for line in open(config['prefixes'], 'r').readlines():
+            parts = line.split()
+            if parts:
+                networks.append(parts[0])
+                weights[parts[0]] = float(parts[1]) if len(parts) > 1 else 1.0
     
-    random.shuffle(prefixes)
-    pinger = Pinger()
-    for prefix in prefixes:
-        host = prefix.replace('.0', '.1')
-        pinger.addHost(host)
-    reactor.run()
-    print "Terminated, dumping data to hosts.dat..."
-    pickle.dump(pinger.hosts, open('hosts.dat', 'w'))
-    print "Finshed.  Raw data:"
-    # To prevent weird terminal error
-    time.sleep(5.0)
-    print pinger.hosts
+    if config['paths']:
+        paths = parsePaths(open(config['paths'], 'r').read())
+    else:
+        paths = [{'name' : 'default', 'asn' : None, 'probe' : 0}]
     
+    random.shuffle(networks)
+    timer.setResolution(float(config['timer-resolution']))
+    pinger = Pinger(paths, float(config['interval']), int(config['pps']), int(config['window']), config['archive'], not config['no-aggregate'])
+    for network in networks:
+        host = network.split('/')[0].replace('.0', '.1')
+        pinger.addHost(host, network, weights.get(network, 1.0))
+    pinger.start()
+    reactor.connectUNIX(config['control'], RouterLinkFactory(pinger))
+    if int(config['metrics']):
+        metrics.listen(config['metrics'])
+    reactor.run()
+    if pinger.archive:
+        pinger.archive.close()
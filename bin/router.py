@@ -1,43 +1,307 @@
 #!/usr/bin/env python
 from twisted.python import log, usage
-from twisted.internet import reactor, protocol
-from kyro import bgp, rib
+from twisted.internet import reactor, protocol, threads, task
+from kyro import bgp, rib, control, metrics, logger, snapshot, churn, timer
+from kyro.util import *
 import sys
+import os
+import time
+
+def asPath(path_attributes):
+    # The AS path as a flat list of asns, sets and sequences alike
+    as_path = []
+    for segment_type, segment_length, asns in path_attributes.get('AS_PATH') or []:
+        as_path.extend(asns)
+    return as_path
 
 # Logic for the BGP router
 class Peer(bgp.Protocol):
     
     def __init__(self):
         bgp.Protocol.__init__(self)
-        self.rib = {}
+        # Routes live in the factory's shared table, under the peer's BGP
+        # identifier (as a number) once the session is open
+        self.source = None
+        self.established = False
+
+    def connectionMade(self):
+        bgp.Protocol.connectionMade(self)
+        self.factory.peers.append(self)
+
+    def connectionLost(self, reason):
+        bgp.Protocol.connectionLost(self, reason)
+        self.established = False
+        if self in self.factory.peers:
+            self.factory.peers.remove(self)
+        # Everything learned from this peer is gone with it, unless the peer
+        # has already reconnected and the new session owns those routes now
+        if self.source is not None and not self.factory.isEstablished(self.source):
+            for network, length, previous, best in self.factory.rib.withdrawSource(self.source):
+                self.factory.routeChanged(network, length, previous, best)
+
+    def openMessageReceived(self, message):
+        bgp.Protocol.openMessageReceived(self, message)
+        self.source = long(unip(message['bgp_identifier']))
+        self.established = True
+        self.factory.peerEstablished(self)
         self.logTableStats()
     
     def logTableStats(self):
-        if self.factory.config.get('statistics'):
-            log.msg('STATS (%s-%s): adj_rib: %s routes\ttotal: %s routes' % (self.peer['bgp_identifier'], self.peer['sender_as'], len(self.rib), self.total_routes))
-            reactor.callLater(5.0, self.logTableStats)
+        if self.established and self.factory.config.get('statistics'):
+            rib = self.factory.rib
+            logger.info('router.stats', 'STATS (%s-%s): adj_rib: %s routes\tshared: %s prefixes, %s paths, %s attribute sets\ttotal: %s routes', self.peer['bgp_identifier'], self.peer['sender_as'], rib.count(self.source), len(rib), rib.path_count, len(rib.attributes), self.total_routes)
+            timer.callLater(5.0, self.logTableStats)
+
+    def isInjected(self, path_attributes):
+        # True for routes carrying our injection community, i.e. our own
+        # injected routes coming back
+        community = {'asn' : int(self.config['sender-as']), 'value' : int(self.config['injection-community'])}
+        return community in (path_attributes.get('COMMUNITIES') or [])
 
     def messageReceived(self, message):
         # Called whenever a BGP message arrives from a peer
-        log.msg(message)
-        if message['type'] != 'UPDATE': return
+        if message['type'] != 'UPDATE':
+            logger.debug('bgp.message', '%s from %s', message['type'], self.ip)
+            return
+        # Counts rather than the message, which the writer thread would
+        # format after the PathAttributes have been shared with the RIB
+        logger.debug('bgp.message', 'UPDATE from %s', self.ip, announced=len(message['network_layer_reachability_information']) / 2, withdrawn=len(message['withdrawn_routes']) / 2)
+        rib = self.factory.rib
+        if not message['withdrawn_routes_length'] and not message['total_path_attributes_length'] and not message['network_layer_reachability_information']:
+            # End-of-RIB marker (RFC 4724), the peer has sent its whole table
+            self.factory.sweep(self.source)
+            return
+        withdrawn_routes = list(prefixes(message['withdrawn_routes']))
+        routes = []
         if message['network_layer_reachability_information']:
-            prefixes = message['network_layer_reachability_information']
-            for prefix in prefixes:
+            path_attributes = message['path_attributes']
+            if self.isInjected(path_attributes):
+                # Our own routes don't compete with the ones they override,
+                # but they do replace whatever this peer sent before
+                withdrawn_routes.extend(prefixes(message['network_layer_reachability_information']))
+            else:
+                routes = prefixes(message['network_layer_reachability_information'])
+        for network, length in withdrawn_routes:
+            change = rib.withdraw(self.source, network, length)
+            if change is not None and change[0] is not change[1]:
+                self.factory.routeChanged(network, length, change[0], change[1])
+        if routes:
+            # Every prefix shares one interned copy of the path attributes,
+            # across all peers
+            attributes = rib.intern(path_attributes.raw, path_attributes)
+            for network, length in routes:
                 self.total_routes += 1
-                self.rib[prefix] = message
-        if message['withdrawn_routes']:
-            prefixes = message['withdrawn_routes']
-            for prefix in prefixes:
-                if prefix in self.rib:
-                    del self.rib[prefix]
+                previous, best = rib.announce(self.source, network, length, attributes)
+                if previous is not best:
+                    self.factory.routeChanged(network, length, previous, best)
                 
 class PeerFactory(protocol.ServerFactory):
     protocol = Peer
     
     def __init__(self, config):
-        log.msg('config: %s' % repr(config))
+        logger.info('router', 'config: %r', config)
         self.config = config
+        self.rib = rib.AdjRibIn()
+        # Best path changes reach the analyzers through here, see churn.py
+        self.churn = churn.ChurnFilter(self.rib, self.publish, float(config.get('churn-window', 1.0)), not config.get('no-dampening'))
+        self.peers = []
+        # A bgp.Decoder for the sessions to share, if any
+        self.decoder = None
+        self.controls = []
+        # Routes the analyzer wants injected, by prefix, and the changes to
+        # them not yet sent to the peers (None means withdraw)
+        self.injected = {}
+        self.pending = {}
+        self.flushing = None
+        self.injection_attributes = {}
+        metrics.gauge('kyro_router_peers', 'Established BGP sessions').function = lambda: len([peer for peer in self.peers if peer.established])
+        metrics.gauge('kyro_router_analyzers', 'Connected analyzers').function = lambda: len(self.controls)
+        metrics.gauge('kyro_rib_prefixes', 'Distinct prefixes in the Adj-RIB-In').function = lambda: len(self.rib)
+        metrics.gauge('kyro_rib_paths', 'Paths in the Adj-RIB-In, across all peers').function = lambda: self.rib.path_count
+        metrics.gauge('kyro_rib_attribute_sets', 'Distinct path attribute sets in the Adj-RIB-In').function = lambda: len(self.rib.attributes)
+        metrics.gauge('kyro_router_injected_routes', 'Routes injected on behalf of the analyzer').function = lambda: len(self.injected)
+        self.injections = metrics.counter('kyro_router_injection_requests_total', 'Inject and withdraw requests from the analyzer')
+        # Snapshot state: pending sweeps of stale routes by source, the table
+        # generation last saved and the save under way, if any
+        self.sweeps = {}
+        self.saved_generation = None
+        self.saving = None
+        self.snapshot_time = metrics.gauge('kyro_rib_snapshot_timestamp_seconds', 'When the RIB snapshot was last written')
+        metrics.gauge('kyro_rib_stale_paths', 'Paths restored from a snapshot and not yet sent again').function = lambda: self.rib.staleCount()
+
+    def routeChanged(self, network, length, previous, best):
+        # A change of best path (None once there's none), the analyzers hear
+        # about it once it's settled
+        self.churn.routeChanged(network, length, previous, best)
+
+    def publish(self, changes, damped):
+        # Streams a batch of settled changes to every connected analyzer
+        for link in self.controls:
+            for network, length, best in changes:
+                link.queueRoute(network, length, None if best is None else asPath(best.attributes))
+            for network, length, flag in damped:
+                link.queueDampen(network, length, flag)
+
+    def controlConnected(self, link):
+        # Brings a new analyzer up to date with everything we know
+        self.controls.append(link)
+        for network, length, best in self.rib:
+            link.queueRoute(network, length, asPath(best.attributes))
+            if self.churn.isDamped(network, length):
+                link.queueDampen(network, length, True)
+
+    def controlLost(self, link):
+        if link in self.controls:
+            self.controls.remove(link)
+
+    def injectionAttributes(self, next_hop):
+        # Encoded path attributes for an injected route, one set per next hop
+        path_attributes = self.injection_attributes.get(next_hop)
+        if path_attributes is None:
+            path_attributes = self.injection_attributes[next_hop] = bgp.encodePathAttributes([
+                {'flags' : 0x40, 'type_code' : 'ORIGIN', 'value' : 'IGP'},
+                {'flags' : 0x40, 'type_code' : 'AS_PATH', 'value' : []},
+                {'flags' : 0x40, 'type_code' : 'NEXT_HOP', 'value' : ip(next_hop)},
+                {'flags' : 0xC0, 'type_code' : 'COMMUNITIES', 'value' : ['%s:%s' % (self.config['sender-as'], self.config['injection-community'])]},
+            ])
+        return path_attributes
+
+    def inject(self, routes):
+        self.injections.inc(len(routes))
+        for prefix, next_hop in routes:
+            self.injected[prefix] = next_hop
+            self.pending[prefix] = next_hop
+        self.schedule()
+
+    def withdraw(self, prefixes):
+        self.injections.inc(len(prefixes))
+        for prefix in prefixes:
+            if self.injected.pop(prefix, None) is not None:
+                self.pending[prefix] = None
+        self.schedule()
+
+    def schedule(self):
+        # Everything requested during this reactor iteration goes out together
+        if self.pending and self.flushing is None:
+            self.flushing = reactor.callLater(0, self.flush)
+
+    def flush(self):
+        self.flushing = None
+        routes = [(prefix, self.injectionAttributes(next_hop)) for prefix, next_hop in self.pending.iteritems() if next_hop is not None]
+        withdrawn_routes = [prefix for prefix, next_hop in self.pending.iteritems() if next_hop is None]
+        self.pending = {}
+        logger.info('router.control', 'INJECTING %s routes, withdrawing %s', len(routes), len(withdrawn_routes))
+        for peer in self.peers:
+            if peer.established:
+                peer.sendRoutes(routes, withdrawn_routes)
+
+    def isEstablished(self, source):
+        # True if a session is open with the peer known as source
+        return any(peer.established and peer.source == source for peer in self.peers)
+
+    def peerEstablished(self, peer):
+        # A peer whose routes were restored gets stale-time from now to send
+        # them again
+        if peer.source in self.sweeps:
+            self.sweeps[peer.source].reset(float(self.config.get('stale-time', 300)))
+        # A new session gets every route currently injected
+        if self.injected:
+            peer.sendRoutes([(prefix, self.injectionAttributes(next_hop)) for prefix, next_hop in self.injected.iteritems()])
+
+    # Snapshots
+    def restore(self, name):
+        # Starts out with the table saved by the last run.  Each peer's routes
+        # are kept until it has had stale-time seconds to send them again.
+        if not os.path.exists(name):
+            return
+        start = time.time()
+        try:
+            ts = snapshot.load(name, self.rib)
+        except (IOError, ValueError), e:
+            logger.warning('router.snapshot', 'Not restoring from %s: %s', name, e)
+            self.rib = self.churn.rib = rib.AdjRibIn()
+            return
+        for source in self.rib.stale:
+            self.sweeps[source] = reactor.callLater(float(self.config.get('stale-time', 300)), self.sweep, source)
+        self.saved_generation = self.rib.generation
+        logger.info('router.snapshot', 'Restored %s paths to %s prefixes from %s (taken %.0fs ago) in %.2fs', self.rib.path_count, len(self.rib), name, time.time() - ts, time.time() - start)
+
+    def sweep(self, source):
+        # Drops the restored routes source hasn't sent again
+        call = self.sweeps.pop(source, None)
+        if call is not None and call.active():
+            call.cancel()
+        stale = self.rib.staleCount(source)
+        if not stale:
+            return
+        for network, length, previous, best in self.rib.sweep(source):
+            self.routeChanged(network, length, previous, best)
+        logger.info('router.snapshot', 'Dropped %s stale paths from %s', stale, ip(source))
+
+    def save(self, name, wait=False):
+        # Writes the table out if it changed since the last time.  The table
+        # is copied a slice per reactor iteration, unless we're about to shut
+        # down, and encoded and written in a thread.
+        if self.saving is not None:
+            if not wait:
+                return None
+            # About to shut down, finish the save under way and then write
+            # out whatever changed since it started
+            d = self.saving
+            d.addCallback(lambda result: self.save(name, wait))
+            return d
+        if self.rib.generation == self.saved_generation:
+            return None
+        start = time.time()
+        generation = self.rib.generation
+        capture = snapshot.Capture(self.rib)
+        if wait:
+            d = threads.deferToThread(snapshot.write, name, capture.run().columns, capture.sets, start)
+        else:
+            d = task.cooperate(iter(capture)).whenDone()
+            d.addCallback(lambda result: threads.deferToThread(snapshot.write, name, capture.columns, capture.sets, start))
+        self.saving = d
+        d.addCallbacks(self.snapshotSaved, self.snapshotFailed, callbackArgs=(name, generation, start), errbackArgs=(name, ))
+        return d
+
+    def snapshotSaved(self, result, name, generation, start):
+        self.saving = None
+        self.saved_generation = generation
+        self.snapshot_time.set(start)
+        logger.info('router.snapshot', 'Saved %s paths to %s in %.2fs', self.rib.path_count, name, time.time() - start)
+
+    def snapshotFailed(self, failure, name):
+        self.saving = None
+        logger.error('router.snapshot', 'Could not save %s: %s', name, failure.getErrorMessage())
+
+    def saveEvery(self, name, interval):
+        self.save(name)
+        reactor.callLater(interval, self.saveEvery, name, interval)
+
+# Control channel to the analyzer
+class Control(control.Protocol):
+
+    def connectionMade(self):
+        control.Protocol.connectionMade(self)
+        logger.info('router.control', 'Analyzer connected')
+        self.factory.router.controlConnected(self)
+
+    def connectionLost(self, reason):
+        control.Protocol.connectionLost(self, reason)
+        logger.info('router.control', 'Analyzer disconnected')
+        self.factory.router.controlLost(self)
+
+    def injectReceived(self, routes):
+        self.factory.router.inject(routes)
+
+    def withdrawReceived(self, prefixes):
+        self.factory.router.withdraw(prefixes)
+
+class ControlFactory(protocol.ServerFactory):
+    protocol = Control
+
+    def __init__(self, router):
+        self.router = router
 
 if __name__ == '__main__':
 
@@ -45,6 +309,7 @@ if __name__ == '__main__':
         optFlags = [
             ['verbose', 'v', 'Verbose logging'],
             ['statistics', 's', 'Enable BGP statistics logging'],            
+            ['no-dampening', 'd', 'Pass flapping prefixes on to the analyzer instead of damping them'],
         ]
         optParameters = [
             ['log', 'l', 'stdout', 'Log file'],
@@ -53,6 +318,14 @@ if __name__ == '__main__':
             ['bgp-identifier', 'i', '127.0.0.1', 'BGP identifier'],
             ['hold-time', 'o', '180', 'BGP hold time'],
             ['bgp-port', 'b', '179', 'Local BGP server port'],
+            ['control', 'k', 'kyro.sock', 'Unix socket for the analyzer control channel'],
+            ['metrics', 'm', '9179', 'Local port serving Prometheus metrics, 0 for none'],
+            ['snapshot', 'f', 'kyro.rib', 'File to save the routing table to and restore it from, "" for none'],
+            ['snapshot-interval', 'e', '300', 'Seconds between routing table snapshots'],
+            ['stale-time', 't', '300', 'Seconds a peer gets to send its routes again after a restore'],
+            ['churn-window', 'w', '1', 'Seconds to hold route changes for, so only the net change reaches the analyzer'],
+            ['decode-workers', 'p', '0', 'Worker processes for decoding UPDATE bursts, 0 to decode them in the reactor'],
+            ['timer-resolution', 'u', '0.1', 'Seconds per tick of the timer wheel running session timers'],
         ]
     config = {}
     try:
@@ -70,11 +343,32 @@ if __name__ == '__main__':
     else:
         l = open(config['log'], 'a')
 
+    # Twisted's own messages go through its log, ours through the logger's
+    # writer thread, both to the same place
     log.startLogging(l)
+    if config['verbose']:
+        logger.setLevel(logger.DEBUG)
+    logger.start(l)
     from twisted.internet import reactor  
 
+    # Keepalive and hold timers don't need to be more precise than this
+    timer.setResolution(float(config['timer-resolution']))
+
     # Router server-side
-    reactor.listenTCP(int(config['bgp-port']), PeerFactory(config))
+    router = PeerFactory(config)
+    if int(config['decode-workers']):
+        # Forked before the table is loaded, so the workers start out small
+        router.decoder = bgp.Decoder(int(config['decode-workers']))
+        reactor.addSystemEventTrigger('after', 'shutdown', router.decoder.close)
+    if config['snapshot']:
+        # Start from the last snapshot, and save one on the way out too
+        router.restore(config['snapshot'])
+        reactor.callLater(float(config['snapshot-interval']), router.saveEvery, config['snapshot'], float(config['snapshot-interval']))
+        reactor.addSystemEventTrigger('before', 'shutdown', router.save, config['snapshot'], True)
+    reactor.listenTCP(int(config['bgp-port']), router)
+    reactor.listenUNIX(config['control'], ControlFactory(router), wantPID=True)
+    if int(config['metrics']):
+        metrics.listen(config['metrics'])
 
     # Run
     reactor.run()
\ No newline at end of file
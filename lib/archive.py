@@ -0,0 +1,268 @@
+import numpy
+import struct
+import os
+
+__author__    = "Kyle Vogt <kyle@justin.tv>"
+__version__   = "0.1"
+__copyright__ = "Copyright (c) 2010, Kyle Vogt"
+__license__   = "MIT"
+
+# Append-only measurement archive
+#
+# Every ping sample is one fixed size record appended to <name>.dat:
+#
+#    8 bytes: timestamp (float, seconds since the epoch)
+#    4 bytes: host id
+#    4 bytes: round trip time in ms (float, NaN if the ping was lost)
+#    2 bytes: path id
+#    2 bytes: unused
+#
+# behind a 16 byte header (magic, version, record size).  Host ids map to
+# names in <name>.hosts, one "id host" line each, written before the first
+# record that uses the id.  Records go in time order, so the timestamp column
+# doubles as the time index.
+#
+# Each batch of records written also gets a block in <name>.idx, behind the
+# same kind of header:
+#
+#   32 bytes: first record number, record count, first and last timestamp
+#    4 bytes: host id, for each record in the batch, sorted
+#    4 bytes: record number within the batch, in the same order
+#
+# Records of one host stay in time order within a block.  A host's records
+# are found with a binary search in each block whose time range overlaps the
+# query, without reading the rest.
+#
+# Readers map the files and look at them through NumPy, so only the pages a
+# query touches get read.  A record torn by a crash is just ignored, since
+# readers only count whole records, and so is a torn index block.  Records
+# past the last whole index block are scanned.  The next writer cuts both
+# files back to whole records and blocks, and indexes any records left out.
+
+MAGIC = 'KYRO'
+VERSION = 1
+INDEX_MAGIC = 'KYRX'
+HEADER = struct.Struct('<4sHH8x')
+RECORD = struct.Struct('<dIfHH')
+BLOCK = struct.Struct('<QI4xdd')
+DTYPE = numpy.dtype([
+    ('ts', '<f8'),
+    ('host', '<u4'),
+    ('rtt', '<f4'),
+    ('path', '<u2'),
+    ('unused', '<u2'),
+])
+
+def readHosts(name):
+    hosts = {}
+    if os.path.exists(name + '.hosts'):
+        for line in open(name + '.hosts'):
+            parts = line.split()
+            if len(parts) == 2:
+                hosts[parts[1]] = int(parts[0])
+    return hosts
+
+def readBlocks(name, offset, records):
+    # Whole index blocks in <name>.idx from offset (0 for the start of the
+    # file) that cover no more than the first 'records' records.  Returns
+    # them as (offset of the host ids, first record, count, first timestamp,
+    # last timestamp), and the offset just past the last.
+    blocks = []
+    if not os.path.exists(name + '.idx'):
+        return blocks, 0
+    f = open(name + '.idx', 'rb')
+    size = os.fstat(f.fileno()).st_size
+    if offset == 0 and size >= HEADER.size:
+        magic, version, entry_size = HEADER.unpack(f.read(HEADER.size))
+        if magic != INDEX_MAGIC or version != VERSION or entry_size != 4:
+            f.close()
+            raise ValueError('%s.idx is not a version %s measurement index' % (name, VERSION))
+        offset = HEADER.size
+    while offset and offset + BLOCK.size <= size:
+        f.seek(offset)
+        first, count, first_ts, last_ts = BLOCK.unpack(f.read(BLOCK.size))
+        end = offset + BLOCK.size + count * 8
+        if end > size or first + count > records:
+            break
+        blocks.append((offset + BLOCK.size, first, count, first_ts, last_ts))
+        offset = end
+    f.close()
+    return blocks, offset
+
+class ArchiveWriter(object):
+
+    def __init__(self, name, flush_records=4096):
+        self.name = name
+        self.flush_records = flush_records
+        self.ids = readHosts(name)
+        self.buffer = []
+        self.data = open(name + '.dat', 'ab')
+        self.data.seek(0, os.SEEK_END)
+        if self.data.tell() == 0:
+            self.data.write(HEADER.pack(MAGIC, VERSION, RECORD.size))
+            self.data.flush()
+        else:
+            # Cut off any record torn by a crash so new ones line up again
+            torn = (self.data.tell() - HEADER.size) % RECORD.size
+            if torn:
+                self.data.truncate(self.data.tell() - torn)
+                self.data.seek(0, os.SEEK_END)
+        self.hosts = open(name + '.hosts', 'a')
+        records = (self.data.tell() - HEADER.size) // RECORD.size
+        blocks, end = readBlocks(name, 0, records)
+        self.index = open(name + '.idx', 'ab')
+        self.index.truncate(end)
+        self.index.seek(0, os.SEEK_END)
+        if end == 0:
+            self.index.write(HEADER.pack(INDEX_MAGIC, VERSION, 4))
+        # Records indexed so far
+        self.count = blocks[-1][1] + blocks[-1][2] if blocks else 0
+        if self.count < records:
+            # Written without their index block, or before there were any
+            f = open(name + '.dat', 'rb')
+            f.seek(HEADER.size + self.count * RECORD.size)
+            self.writeBlock(numpy.fromfile(f, dtype=DTYPE, count=records - self.count))
+            f.close()
+        self.index.flush()
+
+    def hostId(self, host):
+        host_id = self.ids.get(host)
+        if host_id is None:
+            host_id = self.ids[host] = len(self.ids)
+            self.hosts.write('%s %s\n' % (host_id, host))
+            self.hosts.flush()
+        return host_id
+
+    def append(self, ts, host, rtt, path=0):
+        # rtt is None for a lost ping
+        self.buffer.append(RECORD.pack(ts, self.hostId(host), float('nan') if rtt is None else rtt, path, 0))
+        if len(self.buffer) >= self.flush_records:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            records = ''.join(self.buffer)
+            self.buffer = []
+            self.data.write(records)
+            # Records first, so an index block never points past them
+            self.data.flush()
+            self.writeBlock(numpy.frombuffer(records, dtype=DTYPE))
+        self.data.flush()
+
+    def writeBlock(self, records):
+        # Index block for records, the next ones after self.count
+        hosts = records['host']
+        # Stable, so records stay in time order within a host
+        order = numpy.argsort(hosts, kind='mergesort')
+        ts = records['ts']
+        self.index.write(BLOCK.pack(self.count, len(records), ts.min(), ts.max()))
+        self.index.write(hosts[order].astype('<u4').tostring())
+        self.index.write(order.astype('<u4').tostring())
+        self.index.flush()
+        self.count += len(records)
+
+    def close(self):
+        self.flush()
+        self.data.close()
+        self.hosts.close()
+        self.index.close()
+
+class Archive(object):
+    # Read side.  Call refresh() to pick up records appended since opening.
+
+    def __init__(self, name):
+        self.name = name
+        self.blocks = []
+        self.index_end = 0
+        self.refresh()
+
+    def refresh(self):
+        self.ids = readHosts(self.name)
+        self.hosts = dict((host_id, host) for host, host_id in self.ids.items())
+        size = os.path.getsize(self.name + '.dat')
+        f = open(self.name + '.dat', 'rb')
+        magic, version, record_size = HEADER.unpack(f.read(HEADER.size))
+        f.close()
+        if magic != MAGIC or version != VERSION or record_size != DTYPE.itemsize:
+            raise ValueError('%s.dat is not a version %s measurement archive' % (self.name, VERSION))
+        count = (size - HEADER.size) // DTYPE.itemsize
+        if count:
+            self.records = numpy.memmap(self.name + '.dat', dtype=DTYPE, mode='r', offset=HEADER.size, shape=(count,))
+        else:
+            self.records = numpy.zeros(0, dtype=DTYPE)
+        # Only blocks added since the last refresh are read, unless a writer
+        # cut the index back in the meantime
+        size = os.path.getsize(self.name + '.idx') if os.path.exists(self.name + '.idx') else 0
+        if size < self.index_end:
+            self.blocks = []
+            self.index_end = 0
+        blocks, self.index_end = readBlocks(self.name, self.index_end, count)
+        self.blocks.extend(blocks)
+        self.index = numpy.memmap(self.name + '.idx', dtype=numpy.uint8, mode='r') if self.blocks else None
+        self.first_ts = numpy.array([block[3] for block in self.blocks])
+        self.last_ts = numpy.array([block[4] for block in self.blocks])
+        self.indexed = self.blocks[-1][1] + self.blocks[-1][2] if self.blocks else 0
+
+    def byHost(self, host_id, start=None, end=None):
+        # Record numbers for host_id, in time order.  Only index blocks
+        # overlapping start <= ts < end are searched, so there may be some
+        # outside it.
+        found = []
+        lo = 0 if start is None else numpy.searchsorted(self.last_ts, start, 'left')
+        hi = len(self.blocks) if end is None else numpy.searchsorted(self.first_ts, end, 'left')
+        for offset, first, count, first_ts, last_ts in self.blocks[lo:hi]:
+            hosts = numpy.ndarray((count,), dtype='<u4', buffer=self.index, offset=offset)
+            left = numpy.searchsorted(hosts, host_id, 'left')
+            right = numpy.searchsorted(hosts, host_id, 'right')
+            if left < right:
+                order = numpy.ndarray((count,), dtype='<u4', buffer=self.index, offset=offset + count * 4)
+                found.append(first + order[left:right].astype(numpy.int64))
+        # Records not indexed yet
+        tail = self.records['host'][self.indexed:]
+        if len(tail):
+            found.append(self.indexed + numpy.nonzero(tail == host_id)[0])
+        if not found:
+            return numpy.zeros(0, dtype=numpy.int64)
+        return numpy.concatenate(found)
+
+    def __len__(self):
+        return len(self.records)
+
+    def select(self, start=None, end=None, host=None, path=None):
+        # Records with start <= ts < end, optionally for one host and path.
+        # The time range is a binary search on the mapped timestamps, or on
+        # the host's own from the index when there's a host.
+        records = self.records
+        if host is not None:
+            if host not in self.ids:
+                return records[:0]
+            index = self.byHost(self.ids[host], start, end)
+            ts = records['ts'][index]
+            lo = 0 if start is None else numpy.searchsorted(ts, start, 'left')
+            hi = len(index) if end is None else numpy.searchsorted(ts, end, 'left')
+            records = records[index[lo:hi]]
+        else:
+            ts = records['ts']
+            lo = 0 if start is None else numpy.searchsorted(ts, start, 'left')
+            hi = len(records) if end is None else numpy.searchsorted(ts, end, 'left')
+            records = records[lo:hi]
+        if path is not None:
+            records = records[records['path'] == path]
+        return records
+
+    def summarize(self, start=None, end=None, path=None):
+        # Per host mean round trip time and loss percentage over a time range.
+        # Returns (host ids, latency, loss) arrays, for hosts with samples.
+        records = self.select(start, end, path=path)
+        hosts = records['host']
+        rtt = records['rtt']
+        answered = ~numpy.isnan(rtt)
+        size = len(self.hosts) or (int(hosts.max()) + 1 if len(hosts) else 0)
+        count = numpy.bincount(hosts, minlength=size)
+        replies = numpy.bincount(hosts[answered], minlength=size)
+        total = numpy.bincount(hosts[answered], weights=rtt[answered], minlength=size)
+        seen = numpy.nonzero(count)[0]
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            latency = total[seen] / replies[seen]
+        loss = (1.0 - replies[seen] / count[seen].astype(numpy.float64)) * 100.0
+        return seen, latency, loss
@@ -1,6 +1,8 @@
-from twisted.python import log
 from twisted.internet import reactor, protocol
-import sys, traceback, struct, math
+import sys, traceback, struct, time, signal
+import multiprocessing
+from array import array
+from kyro import metrics, logger, timer
 from kyro.util import *
 
 __author__    = "Kyle Vogt <kyle@justin.tv>"
@@ -18,6 +20,21 @@ __license__   = "MIT"
 #
 # See router.py for kyro's usage of this class to implement a BGP peer router
 
+HEADER_LENGTH = 19
+MAX_MESSAGE_LENGTH = 4096
+EXTENDED_LENGTH = 0x10
+PADDING = chr(0) * 4
+MESSAGE_TYPES = {1 : 'OPEN', 2 : 'UPDATE', 3 : 'NOTIFICATION', 4 : 'KEEPALIVE'}
+HOLD_TIMER_EXPIRED = 4
+
+# Metrics, with a child per message type picked up front
+BYTES_RECEIVED = metrics.counter('kyro_bgp_received_bytes_total', 'Bytes received from BGP peers')
+MESSAGES_RECEIVED = metrics.counter('kyro_bgp_received_messages_total', 'BGP messages received, by type', ('type', ))
+MESSAGES_SENT = metrics.counter('kyro_bgp_sent_updates_total', 'UPDATE messages sent to BGP peers')
+PARSE_TIME = metrics.histogram('kyro_bgp_parse_seconds', 'Time to decode one BGP message, by type', ('type', ))
+RECEIVED_BY_TYPE = dict((kind, MESSAGES_RECEIVED.labels(name)) for kind, name in MESSAGE_TYPES.items())
+PARSE_TIME_BY_TYPE = dict((kind, PARSE_TIME.labels(name)) for kind, name in MESSAGE_TYPES.items())
+
 # Serialization functions
 def header(kind, data):
     length = len(data) + 19
@@ -37,28 +54,112 @@ def updateMessage(params):
     data = ''
     data += unshort(params['withdrawn_routes_length'])
     data += params['withdrawn_routes']
-    if not isinstance(params['path_attributes'], str):
-        encodePathAttributes(params['path_attributes'])
-    data += unshort(len(params['path_attributes']))
-    data += params['path_attributes']
+    path_attributes = params['path_attributes']
+    if not isinstance(path_attributes, str):
+        path_attributes = encodePathAttributes(path_attributes)
+    data += unshort(len(path_attributes))
+    data += path_attributes
     data += params['network_layer_reachability_information']
     return header(2, data)
 
+def updateMessages(routes, withdrawn_routes=()):
+    # Packs many routes into as few UPDATE messages as possible.
+    #
+    # 'routes' is a sequence of ((network, length), path_attributes) pairs,
+    #   where path_attributes is either encoded or in encodePathAttributes()
+    #   form.  Routes with identical attributes share messages.
+    # 'withdrawn_routes' is a sequence of (network, length) pairs.  They fill
+    #   whatever room is left in the announcements before getting messages of
+    #   their own.  A prefix that is also announced is not withdrawn.
+    #
+    # Returns a list of wire-ready messages, none over MAX_MESSAGE_LENGTH.
+    room = MAX_MESSAGE_LENGTH - HEADER_LENGTH - 4
+    announced = {}
+    groups = {}
+    order = []
+    for prefix, path_attributes in routes:
+        if not isinstance(path_attributes, str):
+            path_attributes = encodePathAttributes(path_attributes)
+        previous = announced.get(prefix)
+        if previous == path_attributes:
+            continue
+        if previous is not None:
+            groups[previous].remove(prefix)
+        announced[prefix] = path_attributes
+        if path_attributes not in groups:
+            if len(path_attributes) >= room:
+                raise ValueError('path attributes too long (%s bytes)' % len(path_attributes))
+            groups[path_attributes] = []
+            order.append(path_attributes)
+        groups[path_attributes].append(prefix)
+    withdrawn = [encodePrefix(prefix) for prefix in withdrawn_routes if prefix not in announced]
+    w_next = 0
+
+    def pack(withdrawn_routes, path_attributes, nlri):
+        return updateMessage({
+            'withdrawn_routes_length' : sum(len(route) for route in withdrawn_routes),
+            'withdrawn_routes' : ''.join(withdrawn_routes),
+            'path_attributes' : path_attributes,
+            'network_layer_reachability_information' : ''.join(nlri),
+        })
+
+    messages = []
+    for path_attributes in order:
+        if not groups[path_attributes]:
+            continue
+        nlri = []
+        used = len(path_attributes)
+        for prefix in groups[path_attributes]:
+            route = encodePrefix(prefix)
+            if used + len(route) > room:
+                messages.append(pack([], path_attributes, nlri))
+                nlri = []
+                used = len(path_attributes)
+            nlri.append(route)
+            used += len(route)
+        # Top up the last, partly filled message with withdrawals
+        w_start = w_next
+        while w_next < len(withdrawn) and used + len(withdrawn[w_next]) <= room:
+            used += len(withdrawn[w_next])
+            w_next += 1
+        messages.append(pack(withdrawn[w_start:w_next], path_attributes, nlri))
+
+    while w_next < len(withdrawn):
+        w_start = w_next
+        used = 0
+        while w_next < len(withdrawn) and used + len(withdrawn[w_next]) <= room:
+            used += len(withdrawn[w_next])
+            w_next += 1
+        messages.append(pack(withdrawn[w_start:w_next], '', []))
+    return messages
+
 def keepAliveMessage(params = {}):
     return header(4, '')
 
+def notificationMessage(error_code, error_subcode=0, data=''):
+    return header(3, chr(error_code) + chr(error_subcode) + data)
+
+def encodePrefix(prefix):
+    network, length = prefix
+    return chr(length) + unlong(network)[:(length + 7) >> 3]
+
+def encodePrefixes(prefixes):
+    return ''.join([encodePrefix(prefix) for prefix in prefixes])
+
 def encodePathAttributes(params):
+    if isinstance(params, PathAttributes):
+        return params.raw
     data = ''
     for param in params:
         flags = param['flags']
         type_code = param['type_code']
         attribute = param['value']
-        data += chr(flags)
         if type_code == 'ORIGIN': 
             type_code = 1
             if attribute == 'IGP' : attribute = 0
             if attribute == 'EGP' : attribute = 1
             if attribute == 'INCOMPLETE' : attribute = 2
+            attribute = chr(attribute)
         elif type_code == 'AS_PATH': 
             type_code = 2
             a_data = ''
@@ -83,34 +184,330 @@ def encodePathAttributes(params):
             attribute = unlong(attribute)
         elif type_code == 'ATOMIC_AGGREGATE': 
             type_code = 6
+            attribute = ''
         elif type_code == 'AGGREGATOR': 
             type_code = 7
             attribute = unshort(attribute[0]) + unip(attribute[1])
         elif type_code == 'COMMUNITIES': 
             type_code = 8     
-            attribute = ''.join([''.join(unshort(part) for part in com.split(':')) for com in attribute])
+            a_data = ''
+            for com in attribute:
+                # Either 'asn:value' or {'asn' : asn, 'value' : value}
+                if isinstance(com, dict):
+                    a_data += unshort(com['asn']) + unshort(com['value'])
+                else:
+                    a_data += ''.join(unshort(int(part)) for part in com.split(':'))
+            attribute = a_data
+        elif type_code == 'ORIGINATOR_ID':
+            type_code = 9
+            attribute = unip(attribute)
+        elif type_code == 'CLUSTER_LIST':
+            type_code = 10
+            attribute = ''.join([unip(cluster) for cluster in attribute])
+        if attribute is None:
+            attribute = ''
+        if len(attribute) > 255:
+            flags |= EXTENDED_LENGTH
+        data += chr(flags)
         data += chr(type_code)
+        if flags & EXTENDED_LENGTH:
+            data += unshort(len(attribute))
+        else:
+            data += chr(len(attribute))
         data += attribute
     return data
 
+# Path attributes
+ATTRIBUTE_CODES = {
+    'ORIGIN' : 1,
+    'AS_PATH' : 2,
+    'NEXT_HOP' : 3,
+    'MULTI_EXIT_DISC' : 4,
+    'LOCAL_PREF' : 5,
+    'ATOMIC_AGGREGATE' : 6,
+    'AGGREGATOR' : 7,
+    'COMMUNITIES' : 8,
+    'ORIGINATOR_ID' : 9,
+    'CLUSTER_LIST' : 10,
+}
+ATTRIBUTE_NAMES = dict((code, name) for name, code in ATTRIBUTE_CODES.items())
+
+def decodePathAttribute(type_code, data):
+    # Decodes one attribute value, returns (type_code, value) with the type
+    # code turned into its name when it's a known one
+    if data:
+        attribute = pick(len(data))(data)
+    else:
+        attribute = None
+    if type_code == 1:
+        type_code = "ORIGIN"
+        if attribute == 0:
+            attribute = "IGP"
+        elif attribute == 1:
+            attribute = "EGP"
+        elif attribute == 2:
+            attribute = "INCOMPLETE"
+    elif type_code == 2:
+        type_code = "AS_PATH"
+        a_offset = 0
+        segments = []
+        if attribute:
+            while a_offset < len(attribute):
+                segment_type = ord(attribute[a_offset])
+                if segment_type == 1:
+                    segment_type = "AS_SET"
+                elif segment_type == 2:
+                    segment_type = "AS_SEQUENCE"
+                a_offset += 1
+                segment_length = ord(attribute[a_offset])
+                a_offset += 1
+                asns = []
+                for i in xrange(segment_length):
+                    asns.append(short(attribute[a_offset : a_offset + 2]))
+                    a_offset += 2
+                segments.append((segment_type, segment_length, asns))
+        attribute = segments
+    elif type_code == 3:
+        type_code = "NEXT_HOP"
+        attribute = ip(attribute)
+    elif type_code == 4:
+        type_code = "MULTI_EXIT_DISC"
+        attribute = long(attribute)
+    elif type_code == 5:
+        type_code = "LOCAL_PREF"
+        attribute = long(attribute)
+    elif type_code == 6:
+        type_code = "ATOMIC_AGGREGATE"
+    elif type_code == 7:
+        type_code = "AGGREGATOR"
+        attribute = (short(attribute[0:2]), ip(attribute[2:6]))
+    elif type_code == 8:
+        type_code = "COMMUNITIES"
+        a_offset = 0
+        communities = []
+        while a_offset < len(attribute):
+            communities.append({
+                'asn' : short(attribute[a_offset : a_offset + 2]),
+                'value' : short(attribute[a_offset + 2 : a_offset + 4])
+            })
+            a_offset += 4
+        attribute = communities
+    elif type_code == 9:
+        type_code = "ORIGINATOR_ID"
+        attribute = ip(attribute)
+    elif type_code == 10:
+        type_code = "CLUSTER_LIST"
+        a_offset = 0
+        clusters = []
+        while a_offset < len(attribute):
+            clusters.append(ip(attribute[a_offset : a_offset + 4]))
+            a_offset += 4
+        attribute = clusters
+    else:
+        logger.warning('bgp.attribute', 'unknown path attribute type_code: %s', type_code)
+    return type_code, attribute
+
+class PathAttributes(object):
+    # The path attributes of an UPDATE, decoded on demand.
+    #
+    # Only the raw attribute bytes are kept.  The first lookup indexes where
+    # each attribute sits, and each attribute is decoded the first time it's
+    # asked for, so an UPDATE nobody looks inside costs one string copy.
+    # Iterating yields the same {'flags', 'type_code', 'value'} dicts the
+    # eager decoder used to build.
+    __slots__ = ('raw', 'index', 'decoded')
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.index = None
+        self.decoded = None
+
+    def buildIndex(self):
+        # Lists (type_code, flags, offset, length) per attribute, in wire order
+        index = []
+        data = self.raw
+        offset = 0
+        end = len(data)
+        while offset < end:
+            flags = ord(data[offset])
+            type_code = ord(data[offset + 1])
+            offset += 2
+            if flags & EXTENDED_LENGTH:
+                length = struct.unpack_from('!H', data, offset)[0]
+                offset += 2
+            else:
+                length = ord(data[offset])
+                offset += 1
+            index.append((type_code, flags, offset, length))
+            offset += length
+        self.index = index
+        self.decoded = {}
+        return index
+
+    def find(self, type_code):
+        for entry in self.index if self.index is not None else self.buildIndex():
+            if entry[0] == type_code:
+                return entry
+        return None
+
+    def get(self, type_code, default=None):
+        # Looks up one attribute value by name or number
+        type_code = ATTRIBUTE_CODES.get(type_code, type_code)
+        entry = self.find(type_code)
+        if entry is None:
+            return default
+        if type_code not in self.decoded:
+            offset, length = entry[2], entry[3]
+            self.decoded[type_code] = decodePathAttribute(type_code, self.raw[offset:offset + length])[1]
+        return self.decoded[type_code]
+
+    def __contains__(self, type_code):
+        return self.find(ATTRIBUTE_CODES.get(type_code, type_code)) is not None
+
+    def __len__(self):
+        return len(self.index if self.index is not None else self.buildIndex())
+
+    def __iter__(self):
+        for type_code, flags, offset, length in self.index if self.index is not None else self.buildIndex():
+            value = self.get(type_code)
+            yield {
+                'flags' : flags,
+                'type_code' : ATTRIBUTE_NAMES.get(type_code, type_code),
+                'value' : value
+            }
+
+    def __repr__(self):
+        return repr(list(self))
+
+def decodePrefixes(data):
+    # Returns the prefixes as an array of (network, length) integer pairs,
+    # laid out flat.  Iterate it with util.prefixes().
+    prefixes = array('I')
+    end = len(data)
+    if not end:
+        return prefixes
+    # Prefixes are left-aligned and at most 4 bytes, so with a few bytes of
+    # zero padding every network can be read as a 32 bit word and masked
+    data = bytearray(data)
+    data.extend(PADDING)
+    append = prefixes.append
+    unpack = struct.unpack_from
+    offset = 0
+    while offset < end:
+        length = data[offset]
+        append(unpack('!I', data, offset + 1)[0] & MASKS[length])
+        append(length)
+        offset += 1 + ((length + 7) >> 3)
+    return prefixes
+
+# Off-reactor decoding
+#
+# A peer sending its whole table can keep the reactor decoding UPDATEs for
+# long enough to hold up our keepalives (and everything else).  Given a
+# Decoder, the protocol hands bursts of UPDATE bodies to a pool of worker
+# processes instead.  Workers turn each body into
+#
+#     (withdrawn routes length, withdrawn routes, path attributes, nlri)
+#
+# with the prefixes as flat arrays in string form, which are cheap to send
+# back.  Results are applied in the order the UPDATEs arrived, on the
+# reactor as usual.  Framing, OPEN, KEEPALIVE and NOTIFICATION never leave
+# the reactor.
+
+def splitUpdate(data):
+    # Cuts an UPDATE body into its withdrawn routes, path attributes and nlri.
+    # Every UPDATE is decoded starting here, in a worker or not.
+    withdrawn_routes_length = struct.unpack_from('!H', data, 0)[0]
+    offset = 2 + withdrawn_routes_length
+    total_path_attributes_length = struct.unpack_from('!H', data, offset)[0]
+    offset += 2
+    return (
+        data[2:2 + withdrawn_routes_length],
+        data[offset:offset + total_path_attributes_length],
+        data[offset + total_path_attributes_length:],
+    )
+
+def decodeUpdate(data):
+    withdrawn_routes, path_attributes, nlri = splitUpdate(data)
+    return (
+        len(withdrawn_routes),
+        decodePrefixes(withdrawn_routes).tostring(),
+        path_attributes,
+        decodePrefixes(nlri).tostring(),
+    )
+
+def decodeUpdates(bodies):
+    # Runs in a worker.  A body that doesn't decode comes back as None.
+    results = []
+    for body in bodies:
+        try:
+            results.append(decodeUpdate(body))
+        except Exception:
+            results.append(None)
+    return results
+
+def ignoreInterrupts():
+    # Workers leave ^C to the router, which shuts them down
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+class Decoder(object):
+    # A pool of worker processes shared by every session.  Create it before
+    # the reactor runs, so the workers are forked from a quiet process.
+    #
+    #   batch       UPDATEs per job
+    #   threshold   a read with at least this many UPDATEs goes to the pool,
+    #               smaller ones are decoded in place
+    #   backlog     jobs a session can have out before it stops reading
+    #   timeout     seconds a session waits for its next job before it gives
+    #               up on the pool and drops the peer
+
+    def __init__(self, workers=None, batch=64, threshold=16, backlog=None, timeout=30.0):
+        self.workers = workers or multiprocessing.cpu_count()
+        self.batch = batch
+        self.threshold = threshold
+        self.backlog = backlog or 2 * self.workers
+        self.timeout = timeout
+        self.pool = multiprocessing.Pool(self.workers, ignoreInterrupts)
+
+    def decode(self, bodies, callback):
+        # callback(results) is called from the reactor
+        self.pool.apply_async(decodeUpdates, (bodies, ), callback=lambda results: reactor.callFromThread(callback, results))
+
+    def close(self):
+        self.pool.terminate()
+
 # Parser
 class Protocol(protocol.Protocol):
     def __init__(self, config={}):
-        protocol.Protocol.__init__(self)
-        self.state = 'start'
-        self.buffer = ''
-        self.message = {}
+        self.buffer = bytearray()
         self.total_routes = 0
         self.current_routes = 0
         self.bytes_received = 0
         self.config = config
+        # With a decoder: UPDATEs framed by the current read, jobs handed out
+        # and applied so far, and finished jobs waiting for earlier ones
+        self.decoder = None
+        self.updates = []
+        self.jobs = 0
+        self.applied = 0
+        self.decoded = {}
+        self.paused = False
+        self.decodeTimer = None
+        # Set once the session is being dropped, after which nothing more the
+        # peer sent is applied
+        self.dropped = False
+        # Negotiated hold time, and the session timers on the timing wheel
+        self.hold_time = None
+        self.keepAliveDeferred = None
+        self.holdTimer = None
         
     def connectionMade(self):
         self.connected = True
         self.ip = self.transport.getPeer().host
         self.config = self.factory.config
-        log.msg('Got a connection from %s' % self.ip)
-        log.msg('SENDING OPEN')
+        self.decoder = getattr(self.factory, 'decoder', None)
+        logger.info('bgp.session', 'Got a connection from %s', self.ip)
+        logger.debug('bgp.session', 'SENDING OPEN to %s', self.ip)
         params = {
             'version' : 4,
             'sender_as' : int(self.config['sender-as']),
@@ -122,249 +519,244 @@ class Protocol(protocol.Protocol):
         self.transport.write(openMessage(params))
         
     def connectionLost(self, reason):
-        log.msg('Lost connection to %s.' % self.ip)
+        logger.info('bgp.session', 'Lost connection to %s.', self.ip)
         self.connected = False
+        for call in (self.keepAliveDeferred, self.holdTimer, self.decodeTimer):
+            if call is not None:
+                call.cancel()
                 
     def keepAlive(self):
         if self.connected:
-            log.msg('SENDING KEEPALIVE')
+            logger.debug('bgp.keepalive', 'SENDING KEEPALIVE to %s', self.ip)
             self.transport.write(keepAliveMessage())
-            self.keepAliveDeferred = reactor.callLater(int(self.config['hold-time']) / 3.0, self.keepAlive)
-
-    def advance(self, bytes, fun, next):
-        if len(self.buffer) >= bytes:
-            self.message[self.state] = fun(self.buffer[:bytes])
-            self.state = next
-            if len(self.buffer) > bytes:
-                self.buffer = self.buffer[bytes:]
+            if self.keepAliveDeferred is None:
+                self.keepAliveDeferred = timer.callLater(self.hold_time / 3.0, self.keepAlive)
             else:
-                self.buffer = ''
+                self.keepAliveDeferred.reset(self.hold_time / 3.0)
+
+    def holdTimerExpired(self):
+        # Nothing from the peer for a whole hold time
+        if self.connected:
+            logger.error('bgp.session', 'Hold timer expired for %s, dropping connection', self.ip)
+            self.transport.write(notificationMessage(HOLD_TIMER_EXPIRED))
+            self.transport.loseConnection()
+
+    def drop(self, msg, *args):
+        # Closes the session over something that went wrong with it
+        logger.error('bgp.session', msg, *args)
+        self.dropped = True
+        self.updates = []
+        self.transport.loseConnection()
 
     def dataReceived(self, data):
+        if self.dropped:
+            return
         self.bytes_received += len(data)
-        self.buffer += data
+        BYTES_RECEIVED.inc(len(data))
+        self.buffer.extend(data)
 
-        #log.msg('Recieved %s bytes, buffer is %s bytes (%s all time)' % (len(data), len(self.buffer), self.bytes_received))
-        
-        # Header
-        if self.state == 'start':
-            self.advance(16, str, 'length')
-        if self.state == 'length':
-            self.advance(2, short, 'type')
-        if self.state == 'type':
-            self.advance(1, ord, 'dispatch')
-        if self.state == 'dispatch':
-            kind = self.message['type']
-            if kind == 1: 
-                self.message['type'] = 'OPEN'
-                self.state = 'version'
-            elif kind == 2: 
-                self.message['type'] = 'UPDATE'
-                self.state = 'withdrawn_routes_length'
-            elif kind == 3: 
-                self.message['type'] = 'NOTIFICATION'
-                self.state = 'error_code'
-            elif kind == 4: 
-                self.message['type'] = 'KEEPALIVE'
-                self.state = 'start'
-            else: self.state = 'start'
-
-        # OPEN
-        if self.state == 'version':
-            self.advance(1, ord, 'sender_as')
-        if self.state == 'sender_as':
-            self.advance(2, short, 'hold_time')
-        if self.state == 'hold_time':
-            self.advance(2, short, 'bgp_identifier')
-        if self.state == 'bgp_identifier':
-            self.advance(4, ip, 'optional_length')
-        if self.state == 'optional_length':
-            self.advance(1, ord, 'optional_data')
-        if self.state == 'optional_data':
-            self.advance(self.message['optional_length'], str, 'start')
-            
-        # UPDATE
-        if self.state == 'withdrawn_routes_length':
-            self.advance(2, short, 'withdrawn_routes')
-        if self.state == 'withdrawn_routes':
-            length = self.message['withdrawn_routes_length']
-            self.advance(length, str, 'total_path_attributes_length')
-        if self.state == 'total_path_attributes_length':
-            if not isinstance(self.message['withdrawn_routes'], list):
-                self.parseWithdrawnRoutes()
-            self.advance(2, short, 'path_attributes')
-        if self.state == 'path_attributes':
-            length = self.message['total_path_attributes_length']
-            self.advance(length, str, 'network_layer_reachability_information')
-        if self.state == 'network_layer_reachability_information':
-            if not isinstance(self.message['path_attributes'], list):
-                self.parsePathAttributes()
-            length = max(self.message['length'] - 23 - self.message['total_path_attributes_length'] - self.message['withdrawn_routes_length'], 0)
-            self.advance(length, str, 'start')
-            if self.state == 'start':
-                self.parseNetworkLayerReachabilityInformation()
-            
-        # NOTIFICATION
-        if self.state == 'error_code':
-            self.advance(1, ord, 'error_subcode')
-        if self.state == 'error_subcode':
-            self.advance(1, ord, 'data')
-        if self.state == 'data':
-            length = self.message['length'] - 21
-            self.advance(length, str, 'start')        
-            
-        if self.message and self.state == 'start':
-            del self.message['start']
-            if self.message.get('type', '') == 'OPEN':
-                self.openMessageReceived(self.message)
-            else:
-                self.messageReceived(self.message)
-            self.message = {}
-        
-            # Continue processing messages
-            if len(self.buffer): self.dataReceived('')
-            
-    def parsePrefixes(self, data):
-        prefixes = []
+        # Frame every complete message sitting in the buffer.  Each message body
+        # is handed to its decoder as a memoryview into the buffer, so nothing
+        # is copied until a decoder pulls a field out of it.  Consumed bytes are
+        # dropped once per call, which keeps framing linear in the backlog.
+        #
+        # NOTE: decoders must not hold on to the view after they return, or the
+        #   buffer can't be resized on the next call.
+        buffer = self.buffer
+        view = memoryview(buffer)
+        available = len(buffer)
         offset = 0
-        while offset < len(data):
-            length = ord(data[offset])
-            offset += 1
-            if length:
-                bytes = int(math.ceil(float(length) / 8.0))
-                prefix = long(data[offset : offset + bytes])
-                offset += bytes
-                prefix = prefix >> (bytes * 8 - length)
-                prefix = prefix << (32 - length)
-                prefixes.append('%s/%s' % (ip(prefix), length))
-            else:
-                prefixes.append('0.0.0.0/0')
-        return prefixes
+        while available - offset >= HEADER_LENGTH:
+            length = struct.unpack_from('!H', buffer, offset + 16)[0]
+            if length < HEADER_LENGTH or length > MAX_MESSAGE_LENGTH:
+                del view
+                self.buffer = bytearray()
+                self.drop('Bad message length %s from %s, dropping connection', length, self.ip)
+                return
+            if available - offset < length:
+                break
+            kind = buffer[offset + 18]
+            body = view[offset + HEADER_LENGTH : offset + length]
+            offset += length
+            self.frameReceived(kind, length, body)
+            del body
+        del view
+        if offset:
+            del buffer[:offset]
+            # Heard from the peer, once per read rather than per message
+            if self.holdTimer is not None:
+                self.holdTimer.reset(self.hold_time)
+        if self.updates:
+            self.dispatchUpdates()
 
-    def parseWithdrawnRoutes(self):
-        data = self.message['withdrawn_routes']
-        self.message['withdrawn_routes'] = self.parsePrefixes(data)
-        
-    def parsePathAttributes(self):
-        offset = 0
-        attributes = []
-        while offset < self.message['total_path_attributes_length']:
-            # Read attribute data
-            flags = ord(self.message['path_attributes'][offset])
-            offset += 1
-            type_code = ord(self.message['path_attributes'][offset])
-            offset += 1
-            if flags & (2 ** 5):
-                length = short(self.message['path_attributes'][offset:offset + 2])
-                offset += 2
-            else:
-                length = ord(self.message['path_attributes'][offset:offset + 1])
-                offset += 1
-            if length:
-                attribute = pick(length)(self.message['path_attributes'][offset:offset + length])
-                offset += length
-            else:
-                attribute = None
-            # Parse attribute
-            if type_code == 1:
-                type_code = "ORIGIN"
-                if attribute == 0:
-                    attribute = "IGP"
-                elif attribute == 1:
-                    attribute = "EGP"
-                elif attribute == 2:
-                    attribute = "INCOMPLETE"
-            elif type_code == 2:
-                type_code = "AS_PATH"
-                a_offset = 0
-                segments = []
-                if attribute:
-                    while a_offset < len(attribute):
-                        segment_type = ord(attribute[a_offset])
-                        if segment_type == 1:
-                            segment_type = "AS_SET"
-                        elif segment_type == 2:
-                            segment_type = "AS_SEQUENCE"
-                        a_offset += 1
-                        segment_length = ord(attribute[a_offset])
-                        a_offset += 1
-                        asns = []
-                        for i in xrange(segment_length):
-                            asns.append(short(attribute[a_offset : a_offset + 2]))
-                            a_offset += 2
-                        segments.append((segment_type, segment_length, asns))
-                attribute = segments
-            elif type_code == 3:
-                type_code = "NEXT_HOP"
-                attribute = ip(attribute)
-            elif type_code == 4:
-                type_code = "MULTI_EXIT_DISC"
-                attribute = long(attribute)
-            elif type_code == 5:
-                type_code = "LOCAL_PREF"
-                attribute = long(attribute)
-            elif type_code == 6:
-                type_code = "ATOMIC_AGGREGATE"
-            elif type_code == 7:
-                type_code = "AGGREGATOR"
-                attribute = (short(attribute[0:2]), ip(attribute[2:6]))
-            elif type_code == 8:
-                type_code = "COMMUNITIES"
-                a_offset = 0
-                communities = []
-                while a_offset < len(attribute):
-                    communities.append({
-                        'asn' : short(attribute[a_offset : a_offset + 2]),
-                        'value' : short(attribute[a_offset + 2 : a_offset + 4])
-                    })
-                    a_offset += 4
-                attribute = communities
-            elif type_code == 9:
-                type_code = "ORIGINATOR_ID"
-                attribute = ip(attribute)
-            elif type_code == 10:
-                type_code = "CLUSTER_LIST"
-                a_offset = 0
-                clusters = []
-                while a_offset < len(attribute):
-                    clusters.append(ip(attribute[a_offset : a_offset + 4]))
-                    a_offset += 4
-                attribute = clusters
+    def frameReceived(self, kind, length, data):
+        if kind == 2 and self.decoder is not None:
+            self.updates.append((data.tobytes(), length))
+            return
+        start = time.time()
+        if kind == 1:
+            message = self.parseOpen(data)
+        elif kind == 2:
+            message = self.parseUpdate(data)
+        elif kind == 3:
+            message = self.parseNotification(data)
+        elif kind == 4:
+            message = {'type' : 'KEEPALIVE'}
+        else:
+            logger.warning('bgp.session', 'unknown message type: %s from %s', kind, self.ip)
+            return
+        PARSE_TIME_BY_TYPE[kind].observe(time.time() - start)
+        RECEIVED_BY_TYPE[kind].inc()
+        message['length'] = length
+        if message['type'] == 'OPEN':
+            self.openMessageReceived(message)
+        else:
+            self.messageReceived(message)
+
+    def dispatchUpdates(self):
+        # Decodes the UPDATEs from the last read: in the pool if there are
+        # enough of them, or earlier ones are still there (so they stay in
+        # order), otherwise right here
+        updates = self.updates
+        self.updates = []
+        decoder = self.decoder
+        if self.jobs == self.applied and len(updates) < decoder.threshold:
+            for body, length in updates:
+                if self.dropped:
+                    break
+                try:
+                    decoded = decodeUpdate(body)
+                except Exception:
+                    decoded = None
+                self.updateDecoded(decoded, length)
+            return
+        for start in xrange(0, len(updates), decoder.batch):
+            batch = updates[start:start + decoder.batch]
+            job = self.jobs
+            self.jobs += 1
+            lengths = [length for body, length in batch]
+            decoder.decode([body for body, length in batch], lambda results, job=job, lengths=lengths: self.jobDone(job, lengths, results))
+        if self.decodeTimer is None:
+            self.decodeTimer = timer.callLater(decoder.timeout, self.decoderStalled)
+        elif not self.decodeTimer.active():
+            self.decodeTimer.reset(decoder.timeout)
+        if self.jobs - self.applied >= decoder.backlog and not self.paused:
+            # Let TCP hold the peer back until the workers catch up
+            self.paused = True
+            self.transport.pauseProducing()
+
+    def jobDone(self, job, lengths, results):
+        self.decoded[job] = (lengths, results)
+        applied = self.applied
+        while self.applied in self.decoded:
+            lengths, results = self.decoded.pop(self.applied)
+            self.applied += 1
+            for length, decoded in zip(lengths, results):
+                if self.dropped or not self.connected:
+                    break
+                self.updateDecoded(decoded, length)
+        if self.applied != applied:
+            # The next job in line has as long again
+            if self.jobs == self.applied:
+                self.decodeTimer.cancel()
             else:
-                log.msg('unknown path attribute type_code: %s' % type_code)
-            attributes.append({
-                'flags' : flags, 
-                'type_code' : type_code,
-                'value' : attribute
-            })
-        self.message['path_attributes'] = attributes
+                self.decodeTimer.reset(self.decoder.timeout)
+        if self.paused and self.connected and not self.dropped and self.jobs - self.applied < self.decoder.backlog:
+            self.paused = False
+            self.transport.resumeProducing()
+
+    def decoderStalled(self):
+        # The job the session is waiting on hasn't come back.  A worker that
+        # dies takes its job with it, and the session would stay paused on it
+        # forever.
+        if self.connected and not self.dropped and self.jobs != self.applied:
+            self.drop('No UPDATEs decoded for %s in %s seconds, dropping connection', self.ip, self.decoder.timeout)
+
+    def updateDecoded(self, decoded, length):
+        # Hands on an UPDATE decoded with decodeUpdate()
+        if decoded is None:
+            self.drop('Bad UPDATE from %s, dropping connection', self.ip)
+            return
+        withdrawn_routes_length, withdrawn_routes, path_attributes, nlri = decoded
+        message = self.buildUpdate(withdrawn_routes_length, array('I'), PathAttributes(path_attributes), array('I'))
+        message['withdrawn_routes'].fromstring(withdrawn_routes)
+        message['network_layer_reachability_information'].fromstring(nlri)
+        message['length'] = length
+        RECEIVED_BY_TYPE[2].inc()
+        self.messageReceived(message)
+
+    def parseOpen(self, data):
+        version, sender_as, hold_time = struct.unpack_from('!BHH', data, 0)
+        optional_length = ord(data[9])
+        return {
+            'type' : 'OPEN',
+            'version' : version,
+            'sender_as' : sender_as,
+            'hold_time' : hold_time,
+            'bgp_identifier' : ip(data[5:9].tobytes()),
+            'optional_length' : optional_length,
+            'optional_data' : data[10:10 + optional_length].tobytes(),
+        }
+
+    def parseUpdate(self, data):
+        withdrawn_routes, path_attributes, nlri = splitUpdate(data)
+        return self.buildUpdate(len(withdrawn_routes), self.parsePrefixes(withdrawn_routes), self.parsePathAttributes(path_attributes), self.parsePrefixes(nlri))
+
+    def buildUpdate(self, withdrawn_routes_length, withdrawn_routes, path_attributes, nlri):
+        # The UPDATE message handed to messageReceived(), however it was decoded
+        return {
+            'type' : 'UPDATE',
+            'withdrawn_routes_length' : withdrawn_routes_length,
+            'withdrawn_routes' : withdrawn_routes,
+            'total_path_attributes_length' : len(path_attributes.raw),
+            'path_attributes' : path_attributes,
+            'network_layer_reachability_information' : nlri,
+        }
+
+    def parseNotification(self, data):
+        return {
+            'type' : 'NOTIFICATION',
+            'error_code' : ord(data[0]),
+            'error_subcode' : ord(data[1]),
+            'data' : data[2:].tobytes(),
+        }
+
+    def parsePrefixes(self, data):
+        return decodePrefixes(data)
+
+    def parsePathAttributes(self, data):
+        return PathAttributes(data.tobytes())
 
     def extractCommunity(self, message, asn):
-        coms = []
-        for attribute in message.get('path_attributes', []):
-            if attribute['type_code'] == 'COMMUNITIES':
-                coms = attribute['value']
-        for com in coms:
+        path_attributes = message.get('path_attributes')
+        coms = path_attributes.get('COMMUNITIES') if path_attributes is not None else None
+        for com in coms or []:
             if int(asn) == int(com['asn']):
                 return int(com['value'])
         return 0
     
     def extractLocalPreference(self, message):
-        for attribute in message.get('path_attributes', []):
-            if attribute['type_code'] == 'LOCAL_PREF':
-                return int(attribute['value'])
+        path_attributes = message.get('path_attributes')
+        if path_attributes is not None and 'LOCAL_PREF' in path_attributes:
+            return int(path_attributes.get('LOCAL_PREF'))
         return None
     
-    def parseNetworkLayerReachabilityInformation(self):
-        data = self.message['network_layer_reachability_information']
-        routes = self.parsePrefixes(data)
-        self.message['network_layer_reachability_information'] = routes
-        
     def openMessageReceived(self, message):
-        # Start keepalive loop (send every hold-time / 3 seconds)
+        # Start keepalive loop (send every hold time / 3 seconds) and the hold
+        # timer, using the smaller of our hold time and the peer's.  A hold
+        # time of 0 means neither.
         self.peer = message  
-        self.keepAlive()
+        self.hold_time = min(int(self.config['hold-time']), message['hold_time'])
+        if self.hold_time:
+            self.holdTimer = timer.callLater(self.hold_time, self.holdTimerExpired)
+            self.keepAlive()
             
+    def sendRoutes(self, routes, withdrawn_routes=()):
+        # Announces and withdraws routes in bulk, see updateMessages()
+        messages = updateMessages(routes, withdrawn_routes)
+        MESSAGES_SENT.inc(len(messages))
+        self.transport.writeSequence(messages)
+
     def messageReceived(self, message):
         # OVERRIDE ME!
-        log.msg(message)
+        logger.debug('bgp.message', '%s from %s', message['type'], self.ip)
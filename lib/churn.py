@@ -0,0 +1,196 @@
+from twisted.internet import reactor
+from kyro import metrics, timer
+from collections import deque
+import math
+
+__author__    = "Kyle Vogt <kyle@justin.tv>"
+__version__   = "0.1"
+__copyright__ = "Copyright (c) 2010, Kyle Vogt"
+__license__   = "MIT"
+
+# Churn control between the RIB and whoever follows its best paths
+#
+# The RIB takes every announce and withdraw as it arrives.  Consumers (the
+# analyzer, through the control channel) only hear about changes of best
+# path after they've gone through here:
+#
+# Coalescing: changes to a prefix are held for 'window' seconds from the
+#   first one, and only the net change goes out.  A prefix that flaps A, B, A
+#   inside the window isn't published at all.  Everything due goes out
+#   together as one batch.
+#
+# Dampening, after RFC 2439: each change of best path adds to the prefix's
+#   penalty ('withdrawal' when the last path goes away, 'change' when it
+#   moves to a path with other attributes, nothing when it comes back after
+#   a withdrawal or only the peer it's from changed).
+#   The penalty decays by half every 'half_life' seconds.  Past 'suppress'
+#   the prefix is damped: consumers are told so and hear nothing more about
+#   it until the penalty decays below 'reuse', when they get its best path
+#   as it is by then.  The penalty is capped so nothing stays damped longer
+#   than 'max_suppress'.
+#
+# Unlike RFC 2439 the penalty is kept per prefix rather than per peer and
+# prefix: it's the best path consumers would chase that matters here.  A
+# prefix whose penalty has decayed below half of 'reuse' is forgotten.
+#
+# Penalties are never scanned.  Since the decay is known in advance, each
+# penalized prefix has a timer on the timing wheel (see timer.py) for when
+# its penalty will be down to 'reuse' if it's damped, or to half of that if
+# not, moved whenever it's charged again.
+
+CHANGES = metrics.counter('kyro_churn_changes_total', 'Best path changes from the RIB')
+PUBLISHED = metrics.counter('kyro_churn_published_total', 'Net best path changes published after coalescing')
+SUPPRESSED = metrics.counter('kyro_churn_suppressed_total', 'Times a prefix was damped')
+
+class Penalty(object):
+    __slots__ = ('value', 'ts', 'suppressed', 'timer')
+
+    def __init__(self, ts):
+        self.value = 0.0
+        self.ts = ts
+        self.suppressed = False
+        self.timer = None
+
+class ChurnFilter(object):
+
+    def __init__(self, rib, publish, window=1.0, dampening=True, half_life=900.0, suppress=2000.0, reuse=750.0,
+                 max_suppress=3600.0, withdrawal=1000.0, change=500.0, wheel=None):
+        # publish(changes, damped) gets the batches: changes is a list of
+        # (network, length, best attribute set or None), damped a list of
+        # (network, length, True when damped or False when released)
+        self.rib = rib
+        self.publish = publish
+        self.window = window
+        self.dampening = dampening
+        self.half_life = half_life
+        self.suppress = suppress
+        self.reuse = reuse
+        self.ceiling = reuse * 2.0 ** (max_suppress / half_life)
+        self.withdrawal = withdrawal
+        self.change = change
+        self.wheel = timer.WHEEL if wheel is None else wheel
+        # Held changes by prefix as [due, previous best, best], and the order
+        # they're due in as (due, prefix)
+        self.pending = {}
+        self.queue = deque()
+        self.damped = []
+        self.flushing = None
+        # Penalties by prefix, for prefixes with any, and the best paths of
+        # prefixes just released, to go out with the next flush
+        self.penalties = {}
+        self.suppressed = 0
+        self.released = []
+        metrics.gauge('kyro_churn_pending_prefixes', 'Prefixes with changes held for coalescing').function = lambda: len(self.pending)
+        metrics.gauge('kyro_churn_damped_prefixes', 'Prefixes currently damped').function = lambda: self.suppressed
+        metrics.gauge('kyro_churn_penalized_prefixes', 'Prefixes with a dampening penalty').function = lambda: len(self.penalties)
+
+    def isDamped(self, network, length):
+        penalty = self.penalties.get(network << 6 | length)
+        return penalty is not None and penalty.suppressed
+
+    def routeChanged(self, network, length, previous, best, now=None):
+        # Takes a change of best path from the RIB
+        CHANGES.inc()
+        if now is None:
+            now = reactor.seconds()
+        key = network << 6 | length
+        if self.dampening and self.penalize(key, previous, best, now):
+            return
+        held = self.pending.get(key)
+        if held is not None:
+            held[2] = best
+            return
+        due = now + self.window
+        self.pending[key] = [due, previous, best]
+        self.queue.append((due, key))
+        if self.flushing is None:
+            self.flushing = reactor.callLater(self.window, self.flush)
+
+    def penalize(self, key, previous, best, now):
+        # Charges the prefix for a change.  Returns True if it's damped.
+        if best is None:
+            charge = self.withdrawal
+        elif previous is None or previous.key == best.key:
+            charge = 0.0
+        else:
+            charge = self.change
+        penalty = self.penalties.get(key)
+        if not charge:
+            return penalty is not None and penalty.suppressed
+        if penalty is None:
+            penalty = self.penalties[key] = Penalty(now)
+        self.decay(penalty, now)
+        penalty.value = min(penalty.value + charge, self.ceiling)
+        if not penalty.suppressed and penalty.value >= self.suppress:
+            # Whatever was held goes unpublished, consumers hear it's damped
+            penalty.suppressed = True
+            self.suppressed += 1
+            SUPPRESSED.inc()
+            self.pending.pop(key, None)
+            self.damped.append((key >> 6, key & 63, True))
+            if self.flushing is None:
+                self.flushing = reactor.callLater(0, self.flush)
+        self.schedule(key, penalty)
+        return penalty.suppressed
+
+    def decay(self, penalty, now):
+        if now > penalty.ts:
+            penalty.value *= 0.5 ** ((now - penalty.ts) / self.half_life)
+            penalty.ts = now
+
+    def schedule(self, key, penalty):
+        # Sets the prefix's timer for when its penalty is down to 'reuse' if
+        # it's damped, or half of that
+        threshold = self.reuse if penalty.suppressed else self.reuse / 2.0
+        ts = penalty.ts + self.half_life * math.log(max(penalty.value / threshold, 1.0), 2)
+        if penalty.timer is None:
+            penalty.timer = self.wheel.callAt(ts, self.decayed, key)
+        else:
+            penalty.timer.resetAt(ts)
+
+    def flush(self, now=None):
+        # Publishes the changes whose window is over, net of what they undid
+        self.flushing = None
+        if now is None:
+            now = reactor.seconds()
+        changes = self.released
+        self.released = []
+        queue = self.queue
+        pending = self.pending
+        while queue and queue[0][0] <= now:
+            due, key = queue.popleft()
+            held = pending.get(key)
+            if held is None or held[0] != due:
+                # Dropped when the prefix got damped
+                continue
+            del pending[key]
+            previous, best = held[1], held[2]
+            if (previous is None) != (best is None) or (best is not None and previous.key != best.key):
+                changes.append((key >> 6, key & 63, best))
+        damped = self.damped
+        self.damped = []
+        if changes or damped:
+            PUBLISHED.inc(len(changes))
+            self.publish(changes, damped)
+        if queue and self.flushing is None:
+            self.flushing = reactor.callLater(max(queue[0][0] - now, 0), self.flush)
+
+    def decayed(self, key, now=None):
+        # A prefix's penalty is down to where it's let go if it was damped,
+        # or forgotten if not.  It hasn't been charged since the timer was
+        # set, or the timer would have moved.
+        if now is None:
+            now = reactor.seconds()
+        penalty = self.penalties[key]
+        if not penalty.suppressed:
+            del self.penalties[key]
+            return
+        self.decay(penalty, now)
+        penalty.suppressed = False
+        self.suppressed -= 1
+        network, length = key >> 6, key & 63
+        self.damped.append((network, length, False))
+        self.released.append((network, length, self.rib.best(network, length)))
+        self.schedule(key, penalty)
+        if self.flushing is None:
+            self.flushing = reactor.callLater(0, self.flush)
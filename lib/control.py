@@ -0,0 +1,232 @@
+from twisted.internet import reactor, protocol
+from kyro import logger
+import struct
+
+__author__    = "Kyle Vogt <kyle@justin.tv>"
+__version__   = "0.1"
+__copyright__ = "Copyright (c) 2010, Kyle Vogt"
+__license__   = "MIT"
+
+# Control channel between the router and the analyzer
+#
+# The two daemons talk over a local (Unix) stream socket.  Each frame is a
+# 5 byte header (body length, message type) followed by a batch of fixed
+# layout records, all in network byte order:
+#
+#    ROUTES    router -> analyzer, a change in the router's table
+#                network (4), length (1), as path length (1), asns (4 each)
+#                an as path length of 255 means the route was withdrawn
+#    INJECT    analyzer -> router, steer a prefix to a next hop
+#                network (4), length (1), next hop (4)
+#    WITHDRAW  analyzer -> router, stop steering a prefix
+#                network (4), length (1)
+#    DAMPEN    router -> analyzer, a prefix is flapping (or has settled down
+#              again), see churn.py
+#                network (4), length (1), damped (1)
+#
+# Nothing goes out right away.  Changes are queued per prefix, so a prefix
+# that changes twice before the queue drains is only sent once, with its
+# latest state, and the queue is drained as one batch of frames at the end
+# of the current reactor iteration.  That keeps the latency to a few
+# milliseconds without a frame (or a syscall) per route.
+#
+# To use this:
+#     create a new class that inherits control.Protocol
+#     implement routesReceived(), dampReceived() and/or injectReceived(),
+#       withdrawReceived()
+#     queue changes with queueRoute(), queueDampen(), queueInject() and
+#       queueWithdraw()
+
+HEADER = struct.Struct('!IB')
+ROUTES = 1
+INJECT = 2
+WITHDRAW = 3
+DAMPEN = 4
+
+PREFIX = struct.Struct('!IB')
+ROUTE = struct.Struct('!IBB')
+INJECTION = struct.Struct('!IBI')
+DAMPING = struct.Struct('!IBB')
+ASN = struct.Struct('!I')
+WITHDRAWN = 255
+MAX_PATH_LENGTH = 254
+
+# Frames are cut at about this size on the way out, and anything claiming to
+# be over MAX_FRAME_LENGTH on the way in means the stream is garbage
+FRAME_LENGTH = 65536
+MAX_FRAME_LENGTH = 16 * 1024 * 1024
+
+# Record encoders
+def encodeRoute(network, length, as_path):
+    # as_path is a list of asns, or None for a withdrawn route
+    if as_path is None:
+        return ROUTE.pack(network, length, WITHDRAWN)
+    as_path = as_path[:MAX_PATH_LENGTH]
+    return ROUTE.pack(network, length, len(as_path)) + ''.join([ASN.pack(asn) for asn in as_path])
+
+def encodeInjection(network, length, next_hop):
+    return INJECTION.pack(network, length, next_hop)
+
+def encodeWithdrawal(network, length):
+    return PREFIX.pack(network, length)
+
+def encodeDamping(network, length, damped):
+    return DAMPING.pack(network, length, int(damped))
+
+def frames(kind, records):
+    # Packs records into as few frames as possible
+    messages = []
+    batch = []
+    used = 0
+    for record in records:
+        if used + len(record) > FRAME_LENGTH and batch:
+            messages.append(HEADER.pack(used, kind) + ''.join(batch))
+            batch = []
+            used = 0
+        batch.append(record)
+        used += len(record)
+    if batch:
+        messages.append(HEADER.pack(used, kind) + ''.join(batch))
+    return messages
+
+class Protocol(protocol.Protocol):
+    def __init__(self):
+        self.buffer = bytearray()
+        self.pending = {}
+        self.flushing = None
+        self.connected = False
+
+    def connectionMade(self):
+        self.connected = True
+
+    def connectionLost(self, reason):
+        self.connected = False
+        self.pending = {}
+        if self.flushing is not None and self.flushing.active():
+            self.flushing.cancel()
+        self.flushing = None
+
+    # Outgoing
+    def queue(self, key, kind, record):
+        # The latest change to key replaces any queued one
+        self.pending[key] = (kind, record)
+        if self.flushing is None:
+            self.flushing = reactor.callLater(0, self.flush)
+
+    def queueRoute(self, network, length, as_path):
+        self.queue((network, length), ROUTES, encodeRoute(network, length, as_path))
+
+    def queueInject(self, network, length, next_hop):
+        self.queue((network, length), INJECT, encodeInjection(network, length, next_hop))
+
+    def queueWithdraw(self, network, length):
+        self.queue((network, length), WITHDRAW, encodeWithdrawal(network, length))
+
+    def queueDampen(self, network, length, damped):
+        # Queued apart from the prefix's route, it doesn't replace it
+        self.queue((network, length, DAMPEN), DAMPEN, encodeDamping(network, length, damped))
+
+    def flush(self):
+        self.flushing = None
+        if not self.pending or not self.connected:
+            return
+        batches = {}
+        for kind, record in self.pending.itervalues():
+            batches.setdefault(kind, []).append(record)
+        self.pending = {}
+        messages = []
+        # Withdrawals first, so a prefix is never steered two ways at once
+        for kind in (WITHDRAW, INJECT, ROUTES, DAMPEN):
+            if kind in batches:
+                messages.extend(frames(kind, batches[kind]))
+        self.transport.writeSequence(messages)
+
+    # Incoming
+    def dataReceived(self, data):
+        self.buffer.extend(data)
+        buffer = self.buffer
+        view = memoryview(buffer)
+        available = len(buffer)
+        offset = 0
+        while available - offset >= HEADER.size:
+            length, kind = HEADER.unpack_from(buffer, offset)
+            if length > MAX_FRAME_LENGTH:
+                logger.error('control', 'Bad control frame length %s, dropping connection', length)
+                del view
+                self.buffer = bytearray()
+                self.transport.loseConnection()
+                return
+            if available - offset - HEADER.size < length:
+                break
+            body = view[offset + HEADER.size : offset + HEADER.size + length]
+            offset += HEADER.size + length
+            self.frameReceived(kind, body)
+            del body
+        del view
+        if offset:
+            del buffer[:offset]
+
+    def frameReceived(self, kind, data):
+        if kind == ROUTES:
+            self.routesReceived(self.parseRoutes(data))
+        elif kind == INJECT:
+            self.injectReceived(self.parseInjections(data))
+        elif kind == WITHDRAW:
+            self.withdrawReceived(self.parseWithdrawals(data))
+        elif kind == DAMPEN:
+            self.dampReceived(self.parseDampings(data))
+        else:
+            logger.warning('control', 'unknown control message type: %s', kind)
+
+    def parseRoutes(self, data):
+        # Returns a list of ((network, length), as_path) with as_path None
+        # for withdrawn routes
+        routes = []
+        offset = 0
+        end = len(data)
+        while offset < end:
+            network, length, count = ROUTE.unpack_from(data, offset)
+            offset += ROUTE.size
+            if count == WITHDRAWN:
+                routes.append(((network, length), None))
+                continue
+            as_path = list(struct.unpack_from('!%sI' % count, data, offset))
+            offset += count * ASN.size
+            routes.append(((network, length), as_path))
+        return routes
+
+    def parseInjections(self, data):
+        # Returns a list of ((network, length), next_hop)
+        routes = []
+        for offset in xrange(0, len(data) - INJECTION.size + 1, INJECTION.size):
+            network, length, next_hop = INJECTION.unpack_from(data, offset)
+            routes.append(((network, length), next_hop))
+        return routes
+
+    def parseWithdrawals(self, data):
+        # Returns a list of (network, length)
+        return [PREFIX.unpack_from(data, offset) for offset in xrange(0, len(data) - PREFIX.size + 1, PREFIX.size)]
+
+    def parseDampings(self, data):
+        # Returns a list of ((network, length), damped)
+        prefixes = []
+        for offset in xrange(0, len(data) - DAMPING.size + 1, DAMPING.size):
+            network, length, damped = DAMPING.unpack_from(data, offset)
+            prefixes.append(((network, length), bool(damped)))
+        return prefixes
+
+    def routesReceived(self, routes):
+        # OVERRIDE ME!
+        pass
+
+    def dampReceived(self, prefixes):
+        # OVERRIDE ME!
+        pass
+
+    def injectReceived(self, routes):
+        # OVERRIDE ME!
+        pass
+
+    def withdrawReceived(self, prefixes):
+        # OVERRIDE ME!
+        pass
@@ -0,0 +1,123 @@
+import math
+
+__author__    = "Kyle Vogt <kyle@justin.tv>"
+__version__   = "0.1"
+__copyright__ = "Copyright (c) 2010, Kyle Vogt"
+__license__   = "MIT"
+
+# Per-prefix best path selection
+#
+# The engine keeps, for every prefix, the path it currently wants traffic on
+# (or None to leave it to BGP).  It only looks at a prefix when the analyzer
+# passes in fresh measurements for it, so the work is proportional to the
+# samples coming in, never to the size of the table.
+#
+# To keep routes from flapping:
+#   - a path needs 'min_samples' samples before it's considered at all
+#   - a challenger has to beat the current path by 'margin' (a fraction of
+#     the current cost) and by at least 'min_improvement' ms
+#   - after a change the prefix is held down for 'hold_down' seconds
+#
+# A path's cost is its latency plus 'loss_penalty' ms per percent of loss.
+#
+# Each decision also tracks how close it is to flipping (0 far, 1 right at
+# the switching threshold), so the analyzer can measure those more often.
+
+INFINITY = float('inf')
+
+class Decision(object):
+    __slots__ = ('path', 'default', 'changed', 'closeness')
+
+    def __init__(self, default=None):
+        # The path we steer to, the path BGP uses on its own, and when we last
+        # changed our mind
+        self.path = default
+        self.default = default
+        self.changed = None
+        self.closeness = 0.0
+
+class DecisionEngine(object):
+
+    def __init__(self, margin=0.1, min_improvement=5.0, loss_penalty=10.0, hold_down=300.0, min_samples=5):
+        self.margin = margin
+        self.min_improvement = min_improvement
+        self.loss_penalty = loss_penalty
+        self.hold_down = hold_down
+        self.min_samples = min_samples
+        self.decisions = {}
+
+    def __len__(self):
+        return len(self.decisions)
+
+    def cost(self, latency, loss, samples):
+        if samples < self.min_samples:
+            return None
+        if latency is None or math.isnan(latency):
+            # Enough pings, none answered
+            return INFINITY
+        return latency + self.loss_penalty * loss
+
+    def setDefault(self, prefix, path):
+        # Tells the engine which path BGP picks for prefix by itself
+        decision = self.decisions.get(prefix)
+        if decision is None:
+            self.decisions[prefix] = Decision(path)
+        else:
+            if decision.path == decision.default:
+                decision.path = path
+            decision.default = path
+
+    def remove(self, prefix):
+        self.decisions.pop(prefix, None)
+
+    def closeness(self, prefix):
+        decision = self.decisions.get(prefix)
+        return decision.closeness if decision is not None else 0.0
+
+    def update(self, prefix, metrics, now):
+        # Re-evaluates prefix given (latency, loss, samples) per path.
+        #
+        # Returns (old path, new path) when the choice changes, else None.
+        # Either may be None, meaning "whatever BGP picks".
+        decision = self.decisions.get(prefix)
+        if decision is None:
+            decision = self.decisions[prefix] = Decision()
+        if decision.changed is not None and now - decision.changed < self.hold_down:
+            return None
+
+        costs = [self.cost(*metric) for metric in metrics]
+        candidates = [(cost, path) for path, cost in enumerate(costs) if cost is not None]
+        if not candidates:
+            return None
+        best_cost, best = min(candidates)
+        if best_cost == INFINITY:
+            return None
+
+        current = decision.path
+        if current is not None and current < len(costs) and costs[current] is not None:
+            current_cost = costs[current]
+        elif current is None:
+            # BGP's choice is unknown, so only a path that clearly beats every
+            # other one is worth steering to
+            others = [cost for cost, path in candidates if path != best]
+            if not others:
+                return None
+            current_cost = min(others)
+        else:
+            # No usable measurements on the current path yet
+            return None
+
+        # How far the best other path is from the improvement needed to switch
+        required = max(self.margin * current_cost, self.min_improvement)
+        others = [cost for cost, path in candidates if path != current]
+        if others and current_cost != INFINITY and min(others) != INFINITY:
+            decision.closeness = 1.0 / (1.0 + abs(current_cost - min(others) - required) / required)
+
+        if best == current:
+            return None
+        if current_cost - best_cost < required:
+            return None
+
+        decision.path = best
+        decision.changed = now
+        return current, best
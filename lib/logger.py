@@ -0,0 +1,200 @@
+import sys
+import time
+import threading
+import atexit
+import Queue
+import metrics
+
+__author__    = "Kyle Vogt <kyle@justin.tv>"
+__version__   = "0.1"
+__copyright__ = "Copyright (c) 2010, Kyle Vogt"
+__license__   = "MIT"
+
+# Structured logging that stays off the hot paths
+#
+# Every record has a level, a category ('bgp.message', 'probe', ...), a
+# format string with its arguments, and optional key=value fields:
+#
+#     logger.debug('bgp.message', 'UPDATE from %s', self.ip, announced=count)
+#
+# Nothing is formatted where the record is made.  A record below its
+# category's level, skipped by sampling or over the rate limit costs a dict
+# lookup and a few comparisons.  The rest go on a bounded queue, and a
+# background thread formats and writes them.  When the queue is full records
+# are dropped (and counted) rather than slowing the caller down.  Arguments
+# are formatted later, so they shouldn't be changed after they're logged, or
+# be anything costly (or unsafe) to format off the reactor thread.
+#
+# Categories are configured by name or by any dotted prefix of it, 'bgp'
+# covers 'bgp.message' unless that has settings of its own:
+#
+#     logger.configure('bgp.message', level=logger.DEBUG, sample=100, rate=50)
+#
+# keeps one in 100 messages, at most 50 a second (a rate of 0 lifts the
+# limit).  Records skipped by the rate limit are counted on the next one that
+# gets through.
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+LEVELS = {DEBUG : 'DEBUG', INFO : 'INFO', WARNING : 'WARNING', ERROR : 'ERROR'}
+
+EMITTED = metrics.counter('kyro_log_records_total', 'Log records written, by level', ('level', ))
+DROPPED = metrics.counter('kyro_log_dropped_total', 'Log records dropped because the queue was full')
+
+class Category(object):
+    __slots__ = ('level', 'sample', 'rate', 'count', 'tokens', 'ts', 'suppressed')
+
+    def __init__(self, level=INFO, sample=1, rate=None):
+        self.level = level
+        self.sample = sample
+        self.rate = rate or None
+        self.count = 0
+        self.tokens = float(rate or 0)
+        self.ts = time.time()
+        self.suppressed = 0
+
+class Logger(object):
+
+    def __init__(self, out=None, level=INFO, queue_size=10000):
+        self.out = out
+        self.level = level
+        self.settings = {}
+        self.categories = {}
+        self.queue = Queue.Queue(queue_size)
+        self.thread = None
+
+    def configure(self, name, level=None, sample=None, rate=None):
+        # Settings for a category and the ones under it.  Unset values are
+        # inherited from the next shorter prefix, or the defaults.
+        settings = self.settings.setdefault(name, {})
+        if level is not None:
+            settings['level'] = level
+        if sample is not None:
+            settings['sample'] = sample
+        if rate is not None:
+            settings['rate'] = rate
+        self.categories = {}
+
+    def setLevel(self, level):
+        self.level = level
+        self.categories = {}
+
+    def category(self, name):
+        category = self.categories.get(name)
+        if category is None:
+            settings = {'level' : self.level, 'sample' : 1, 'rate' : None}
+            parts = name.split('.')
+            for i in range(1, len(parts) + 1):
+                settings.update(self.settings.get('.'.join(parts[:i]), {}))
+            category = self.categories[name] = Category(**settings)
+        return category
+
+    def enabled(self, level, name):
+        return level >= self.category(name).level
+
+    def log(self, level, name, msg, *args, **fields):
+        category = self.categories.get(name) or self.category(name)
+        if level < category.level:
+            return
+        if category.sample > 1:
+            category.count += 1
+            if category.count % category.sample:
+                return
+        if category.rate is not None:
+            now = time.time()
+            category.tokens = min(category.tokens + (now - category.ts) * category.rate, float(category.rate))
+            category.ts = now
+            if category.tokens < 1.0:
+                category.suppressed += 1
+                return
+            category.tokens -= 1.0
+        if category.suppressed:
+            fields['suppressed'] = category.suppressed
+            category.suppressed = 0
+        if self.thread is None:
+            self.start()
+        try:
+            self.queue.put_nowait((time.time(), level, name, msg, args, fields))
+        except Queue.Full:
+            DROPPED.inc()
+
+    def debug(self, name, msg, *args, **fields):
+        self.log(DEBUG, name, msg, *args, **fields)
+
+    def info(self, name, msg, *args, **fields):
+        self.log(INFO, name, msg, *args, **fields)
+
+    def warning(self, name, msg, *args, **fields):
+        self.log(WARNING, name, msg, *args, **fields)
+
+    def error(self, name, msg, *args, **fields):
+        self.log(ERROR, name, msg, *args, **fields)
+
+    # Writer
+    def start(self, out=None):
+        if out is not None:
+            self.out = out
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.write, name='logger')
+            self.thread.daemon = True
+            self.thread.start()
+            atexit.register(self.stop)
+
+    def stop(self):
+        # Writes out what's queued and stops the writer
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join(5.0)
+            self.thread = None
+
+    def write(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            out = self.out or sys.stdout
+            try:
+                out.write(self.format(*record))
+            except Exception, e:
+                out.write('%s ERROR logger could not format %r: %s\n' % (self.timestamp(record[0]), record[3], e))
+            EMITTED.labels(LEVELS.get(record[1], str(record[1]))).inc()
+            if self.queue.empty():
+                out.flush()
+
+    def timestamp(self, ts):
+        return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(ts)) + ('%.3f' % (ts % 1))[1:]
+
+    def format(self, ts, level, name, msg, args, fields):
+        if args:
+            msg = msg % args
+        line = '%s %s %s %s' % (self.timestamp(ts), LEVELS.get(level, level), name, msg)
+        if fields:
+            line += ''.join([' %s=%s' % (key, self.value(value)) for key, value in sorted(fields.items())])
+        return line + '\n'
+
+    def value(self, value):
+        if not isinstance(value, basestring):
+            value = repr(value)
+        if not value or ' ' in value or '"' in value:
+            value = '"%s"' % value.replace('\\', '\\\\').replace('"', '\\"')
+        return value
+
+# The process wide logger
+LOGGER = Logger()
+configure = LOGGER.configure
+setLevel = LOGGER.setLevel
+enabled = LOGGER.enabled
+log = LOGGER.log
+debug = LOGGER.debug
+info = LOGGER.info
+warning = LOGGER.warning
+error = LOGGER.error
+start = LOGGER.start
+stop = LOGGER.stop
+
+# Chatty categories are sampled and rate limited unless told otherwise
+configure('bgp.message', sample=100, rate=50)
+configure('bgp.keepalive', rate=10)
+configure('probe', rate=100)
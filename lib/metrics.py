@@ -0,0 +1,184 @@
+from twisted.internet import reactor
+from twisted.web import server, resource
+from bisect import bisect_left
+import math
+
+__author__    = "Kyle Vogt <kyle@justin.tv>"
+__version__   = "0.1"
+__copyright__ = "Copyright (c) 2010, Kyle Vogt"
+__license__   = "MIT"
+
+# Counters, gauges and histograms, served in Prometheus text format
+#
+# Metrics are module level objects that hot paths update directly, e.g.
+#
+#     MESSAGES = metrics.counter('kyro_bgp_messages_total', 'BGP messages received', ('type', ))
+#     ...
+#     MESSAGES.labels('UPDATE').inc()
+#
+# Updating one is an attribute add (plus a bisect for histograms), all the
+# formatting happens when the endpoint is scraped.  Values that are already
+# kept somewhere else can be read at scrape time instead, by passing a
+# function that returns them.
+#
+# Asking for a metric that exists returns the existing one, so any number of
+# peers or probers can share them.
+
+class Metric(object):
+    kind = 'untyped'
+
+    def __init__(self, name, help, labelnames=(), function=None):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.function = function
+        self.children = {}
+        self.value = 0
+
+    def labels(self, *values):
+        # The metric for one combination of label values
+        child = self.children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError('%s takes labels %s' % (self.name, self.labelnames))
+            child = self.children[values] = self.__class__(self.name, self.help)
+        return child
+
+    def samples(self):
+        # Yields (suffix, labels, value) for rendering
+        if self.labelnames:
+            for values, child in sorted(self.children.items()):
+                for suffix, labels, value in child.samples():
+                    yield suffix, zip(self.labelnames, values) + labels, value
+        else:
+            yield '', [], self.get()
+
+    def get(self):
+        if self.function is not None:
+            return self.function()
+        return self.value
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1):
+        self.value += amount
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+# Default histogram buckets, in seconds
+BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0)
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=BUCKETS):
+        Metric.__init__(self, name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # One count per bucket, and one for +Inf
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError('%s takes labels %s' % (self.name, self.labelnames))
+            child = self.children[values] = Histogram(self.name, self.help, buckets=self.buckets)
+        return child
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.total += value
+        self.count += 1
+
+    def samples(self):
+        if self.labelnames:
+            for sample in Metric.samples(self):
+                yield sample
+            return
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'), ), self.counts):
+            cumulative += count
+            yield '_bucket', [('le', formatValue(bound))], cumulative
+        yield '_sum', [], self.total
+        yield '_count', [], self.count
+
+def formatValue(value):
+    if isinstance(value, (int, long)):
+        return str(value)
+    if math.isnan(value):
+        return 'NaN'
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value))
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class Registry(object):
+
+    def __init__(self):
+        self.metrics = {}
+        self.order = []
+
+    def register(self, cls, name, *args, **kwargs):
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = self.metrics[name] = cls(name, *args, **kwargs)
+            self.order.append(name)
+        elif not isinstance(metric, cls):
+            raise ValueError('%s is already a %s' % (name, metric.kind))
+        return metric
+
+    def render(self):
+        lines = []
+        for name in self.order:
+            metric = self.metrics[name]
+            lines.append('# HELP %s %s' % (name, metric.help.replace('\\', '\\\\').replace('\n', '\\n')))
+            lines.append('# TYPE %s %s' % (name, metric.kind))
+            for suffix, labels, value in metric.samples():
+                if labels:
+                    labels = '{%s}' % ','.join(['%s="%s"' % (label, escape(label_value)) for label, label_value in labels])
+                else:
+                    labels = ''
+                lines.append('%s%s%s %s' % (name, suffix, labels, formatValue(value)))
+        return '\n'.join(lines) + '\n'
+
+REGISTRY = Registry()
+
+def counter(name, help, labelnames=(), function=None):
+    return REGISTRY.register(Counter, name, help, labelnames, function)
+
+def gauge(name, help, labelnames=(), function=None):
+    return REGISTRY.register(Gauge, name, help, labelnames, function)
+
+def histogram(name, help, labelnames=(), buckets=BUCKETS):
+    return REGISTRY.register(Histogram, name, help, labelnames, buckets)
+
+# Endpoint
+class MetricsResource(resource.Resource):
+    isLeaf = True
+
+    def __init__(self, registry=REGISTRY):
+        resource.Resource.__init__(self)
+        self.registry = registry
+
+    def render_GET(self, request):
+        request.setHeader('Content-Type', 'text/plain; version=0.0.4')
+        return self.registry.render()
+
+def listen(port, interface='127.0.0.1', registry=REGISTRY):
+    # Serves the metrics over HTTP, e.g. curl http://127.0.0.1:<port>/metrics
+    return reactor.listenTCP(int(port), server.Site(MetricsResource(registry)), interface=interface)
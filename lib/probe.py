@@ -1,25 +1,116 @@
 #!/usr/bin/env python
+from twisted.internet import reactor, protocol, stdio, defer
+from twisted.protocols import basic
 import socket
-import select
+import errno
 import time
 import struct
-import sys
 import os
 import util
+import metrics
+import logger
+import timer
+from array import array
+from collections import deque
 
 PAYLOAD = 'x' * 184
+# Timestamps go in the packet as a native unsigned long, that many 16 bit words
+TS_WORDS = struct.calcsize('L') // 2
+# ICMP sequence numbers are 16 bits
+SEQS = 0x10000
+
+RTT = metrics.histogram('kyro_probe_rtt_seconds', 'Round trip times of answered pings', buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.2, 0.3, 0.5, 1.0, 2.0))
+MAPPINGS = metrics.counter('kyro_probe_mapping_bursts_total', 'Path mapping bursts sent')
+
+def checksum(data):
+    # 16-bit one's complement of the one's complement sum of data (RFC 1071).
+    # Words are summed in native byte order and the result is stored back the
+    # same way, which gives the right bytes on the wire either way.
+    if len(data) % 2:
+        data = data + '\0'
+    total = sum(array('H', str(data)))
+    total = (total >> 16) + (total & 0xFFFF)
+    total += total >> 16
+    return ~total & 0xFFFF
+
+def is_ip(host):
+    # Dotted quad IPv4 address, as opposed to a name that needs looking up
+    try:
+        socket.inet_pton(socket.AF_INET, host)
+    except (socket.error, TypeError):
+        return False
+    return True
+
+class Packet(object):
+    # Preformatted ICMP echo request (RFC 792):
+    #
+    #  HEADER
+    #    8-bits:    type (8, echo request)
+    #    8-bits:    code (0)
+    #    16-bits:   checksum
+    #    16-bits:   id
+    #    16-bits:   sequence
+    #  DATA
+    #    timestamp (native unsigned long, ms since the epoch) and PAYLOAD
+    #
+    # The packet is built and checksummed once.  Each ping only patches the
+    # sequence number and timestamp in place and updates the checksum for the
+    # words that changed, per RFC 1624: HC' = ~(~HC + ~m + m').
+    __slots__ = ('data',)
+    
+    def __init__(self, id, payload=PAYLOAD):
+        self.data = bytearray(struct.pack('bbHHH', 8, 0, 0, id, 0) + struct.pack('L', 0) + payload)
+        struct.pack_into('H', self.data, 2, checksum(self.data))
+
+    def update(self, seq, ts):
+        # Returns the packet for seq and ts (in ms)
+        data = self.data
+        old = struct.unpack_from('%sH' % (1 + TS_WORDS), data, 6)
+        struct.pack_into('H', data, 6, seq)
+        struct.pack_into('L', data, 8, ts)
+        new = struct.unpack_from('%sH' % (1 + TS_WORDS), data, 6)
+        total = (~struct.unpack_from('H', data, 2)[0] & 0xFFFF) + sum(new)
+        for word in old:
+            total += ~word & 0xFFFF
+        total = (total >> 16) + (total & 0xFFFF)
+        total += total >> 16
+        struct.pack_into('H', data, 2, ~total & 0xFFFF)
+        return data
 
 class Probe():
     
-    def __init__(self, host):
+    def __init__(self, host, tos=0, ip=None):
         self.host = host
-        self.ip = socket.gethostbyname(host)
+        # IP type of service byte the pings go out with, which lets routing
+        # policy steer them down a particular path.  It's the whole byte, so
+        # DSCP code point << 2; the low two bits are ECN and must be clear.
+        if tos & 3 or not 0 <= tos <= 0xFF:
+            raise ValueError('not a TOS byte with the ECN bits clear: %s' % tos)
+        self.tos = tos
+        self.key = (host, tos)
+        # Looking a name up here would block the reactor, so the address has
+        # to be known already, see Prober.add_name()
+        self.ip = host if ip is None else ip
+        if not is_ip(self.ip):
+            raise ValueError('not an IPv4 address: %s' % self.ip)
+        # Resolved once, for sendto()
+        self.address = (self.ip, 1)
+        self.packet = None
+        # When the probe is next due, and its timer on the wheel
         self.next_ts = None
+        self.deadline = None
         self.ping_ts = None
         self.interval = 5.0
+        # How much this probe deserves to be measured, relative to the others.
+        # It's pinged every interval / priority seconds, give or take the
+        # scaling that keeps all probes within the send budget.
+        self.priority = 1.0
         self.count = 60
         self.current_ttl = 0
         self.max_ttl = 0
+        # TTL that mapped_ip answered at, or the target's distance if the
+        # target is mapped_ip
+        self.hop_ttl = 0
         self.mapping_tries = 0
         self.max_mapping_tries = 5
         self.seq = 0
@@ -27,174 +118,644 @@ class Probe():
         self.mapped = False
         self.waiting = False
         self.mapped_ip = self.ip
+        # While mapping: hop address by TTL from Time Exceeded replies, the
+        # lowest TTL that reached the target and its round trip time, and the
+        # sequence numbers of the burst in flight
+        self.hops = {}
+        self.reached = None
+        self.reached_ms = None
+        self.burst = []
+        # Key of the group this probe belongs to once mapped, and whether it's
+        # a member sitting out while another probe pings for the group
+        self.group = None
+        self.parked = False
+        # When the probe was last mapped, or last found still on its path
+        self.mapped_ts = None
         
-    def log(self, msg):
-        print "Probe(%s) %s" % (self.host, msg)
+    def log(self, msg, *args):
+        # Formatted by the log writer, and only if the 'probe' category is
+        # logging at DEBUG
+        logger.debug('probe', msg, *args, host=self.host, tos=self.tos)
 
 class Prober():
+    # Sends and receives pings on a raw ICMP socket driven by the twisted
+    # reactor: the socket is a reader, and each probe's next deadline (ping,
+    # timeout, or mapping again) is a timer on a timing wheel, see timer.py.
+    # Call start() once the reactor is available.
+    #
+    # A new probe is mapped with one burst of pings, one per TTL from 1 to
+    # 'mapping_ttl'.  Replies are matched back to their TTL by sequence number:
+    # the lowest TTL that gets an echo reply is the target's distance, and the
+    # deepest Time Exceeded below it is the last hop.  Mapping is over as soon
+    # as both are known, or when the burst times out.  Targets that don't
+    # answer are pinged at the TTL of the deepest hop that did.
+    #
+    # Once a probe is mapped every ping it sends produces a sample, handed to
+    # replyReceived() or replyLost().  Subclasses override those.
+    #
+    # 'pps' caps the packets sent per second across all probes (None for no
+    # cap).  Pings of mapped probes and mapping (bursts, checks and refreshes)
+    # draw on separate shares of it: rebalance() gives pings what the mapped
+    # probes will send, up to 'headroom' of the budget, and mapping the rest,
+    # so a flood of new probes can't hold up the ones already measuring.
+    # Probes that come due while their share is spent wait their turn, in
+    # the order they came due.
+    #
+    # With 'aggregate' on, mapped probes are grouped by group_key(), by default
+    # the path tag and the last responsive hop.  Only the first probe in a
+    # group keeps pinging and its samples go to every member.  Every 'refresh'
+    # seconds that probe maps its path again, staying in the group while it
+    # does, and moves to another group if the path moved.  Parked members
+    # are only checked: one ping at the TTL of the group's hop, and a full
+    # mapping burst only if something else answers it, or nothing does.
+    #
+    # Mapped probes ping every interval / priority seconds, times a common
+    # scale.  rebalance() sets the scale every few seconds so the average
+    # probe keeps its nominal interval, unless that would take more than
+    # 'headroom' of the send budget, in which case everyone slows down
+    # evenly.  Higher priority probes get a bigger share either way, within
+    # [min_interval, max_interval].
     
-    def __init__(self):
-        self.pid = os.getpid()
-        self.probes = []
+    def __init__(self, pps=None, aggregate=False, refresh=600.0, min_interval=0.5, max_interval=60.0, headroom=0.8, mapping_ttl=30, wheel=None):
+        # ICMP ids are 16 bits
+        self.pid = os.getpid() & 0xFFFF
+        # Probes by (host, tos) and by (destination IP, tos)
+        self.probes = {}
+        self.by_ip = {}
+        # Outstanding pings by (id, seq), so replies are matched in O(1)
+        self.pending = {}
+        self.seq = 0
+        # Probe deadlines go on the wheel.  Probes that came due but are
+        # waiting for the send budget (or for start()) queue up in 'ready',
+        # or in 'mapping_ready' if they're waiting to map.
+        self.wheel = timer.WHEEL if wheel is None else wheel
+        self.ready = deque()
+        self.mapping_ready = deque()
+        self.retry = None
+        self.running = False
+        # Send budget, a token bucket for each share holding up to a second's
+        # worth.  Until anything is mapped it all goes to mapping.
+        self.pps = pps
+        self.ping_rate = 0.0
+        self.tokens = 0.0
+        self.mapping_tokens = float(pps or 0)
+        self.tokens_ts = time.time()
+        self.sent = 0
+        self.received = 0
+        self.lost = 0
+        self.mapping_ttl = mapping_ttl
+        # Groups of probes by key, each a list with the pinging probe first
+        self.aggregate = aggregate
+        self.refresh = refresh
+        self.groups = {}
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.headroom = headroom
+        self.scale = 1.0
+        self.balancer = None
+        # Counts kept here anyway are read when metrics are scraped
+        metrics.counter('kyro_probe_sent_total', 'Pings sent').function = lambda: self.sent
+        metrics.counter('kyro_probe_received_total', 'Ping replies received').function = lambda: self.received
+        metrics.counter('kyro_probe_timeouts_total', 'Pings of mapped probes that timed out').function = lambda: self.lost
+        metrics.gauge('kyro_probe_probes', 'Probes').function = lambda: len(self.probes)
+        metrics.gauge('kyro_probe_pending', 'Pings waiting for an answer').function = lambda: len(self.pending)
+        metrics.gauge('kyro_probe_ready', 'Probes due and waiting for the send budget').function = lambda: len(self.ready) + len(self.mapping_ready)
+        metrics.gauge('kyro_probe_groups', 'Groups of probes sharing a last hop').function = lambda: len(self.groups)
+        metrics.gauge('kyro_probe_interval_scale', 'Common scale applied to probe intervals').function = lambda: self.scale
+        # TTL and TOS currently set on the socket, so they're only set again
+        # when they change
+        self.ttl = None
+        self.tos = None
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP)
         self.sock.setblocking(False)
         # Need massive socket receive buffer if concurrency is high
         self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1048576 * 2)
         
-    def add(self, host):
-        if host not in [probe.host for probe in self.probes]:
-            self.probes.append(Probe(host))
-        
-    def get_probe(self, ip):
-        probe = [p for p in self.probes if p.ip == ip]
+    def add(self, host, tos=0, ip=None):
+        # host has to be an IP address unless ip is given
+        key = (host, tos)
+        if key not in self.probes:
+            probe = Probe(host, tos, ip)
+            probe.packet = Packet(self.pid)
+            self.probes[key] = probe
+            self.by_ip[(probe.ip, tos)] = probe
+            self.reschedule(probe, time.time())
+        return self.probes[key]
+
+    def add_name(self, host, tos=0):
+        # Same as add() for a host name, looked up without blocking.  Returns
+        # a Deferred that fires with the probe.
+        if is_ip(host) or (host, tos) in self.probes:
+            return defer.maybeDeferred(self.add, host, tos)
+        return reactor.resolve(host).addCallback(lambda ip: self.add(host, tos, ip))
+
+    def remove(self, host, tos=0):
+        probe = self.probes.pop((host, tos), None)
         if probe:
-            return probe[0]
+            self.leave(probe)
+            self.forget(probe)
+            if probe.deadline is not None:
+                probe.deadline.cancel()
+        if probe and self.by_ip.get((probe.ip, tos)) is probe:
+            del self.by_ip[(probe.ip, tos)]
+        
+    def get_probe(self, ip, tos=0):
+        return self.by_ip.get((ip, tos))
+
+    def group_key(self, probe):
+        # Probes with the same key are assumed to see the same latency and
+        # loss.  Override to make groups finer.
+        return (probe.tos, probe.mapped_ip)
+
+    def join(self, probe, now):
+        # Puts a just mapped probe in its group.  Returns True if it parks
+        # behind the group's pinging probe.
+        if not self.aggregate:
+            return False
+        key = self.group_key(probe)
+        if probe.group is not None:
+            # Mapped again while pinging for its group
+            if key == probe.group:
+                return False
+            probe.log("MOVED group=%s", key)
+            self.leave(probe)
+        probe.group = key
+        group = self.groups.get(key)
+        if group is None:
+            self.groups[key] = [probe]
+            return False
+        group.append(probe)
+        probe.parked = True
+        probe.waiting = False
+        self.reschedule(probe, now + self.refresh)
+        probe.log("PARKED group=%s", key)
+        return True
+
+    def leave(self, probe):
+        key = probe.group
+        group = self.groups.get(key)
+        probe.group = None
+        probe.parked = False
+        if group is None or probe not in group:
+            return
+        pinging = group[0] is probe
+        group.remove(probe)
+        if not group:
+            del self.groups[key]
+        elif pinging:
+            # Next in line takes over
+            group[0].parked = False
+            self.reschedule(group[0], time.time())
+
+    def refresh_due(self, probe, now):
+        # Whether it's time for a probe pinging for its group to map again
+        return probe.mapped and probe.group is not None and not probe.parked and now >= probe.mapped_ts + self.refresh
+
+    def remap(self, probe):
+        # Forgets how probe's path was mapped and starts over
+        self.leave(probe)
+        self.forget(probe)
+        probe.mapped = False
+        probe.max_ttl = 0
+        probe.mapping_tries = 0
+        probe.mapped_ip = probe.ip
+
+    def forget(self, probe):
+        # Drops probe's pings still waiting for an answer.  Only entries that
+        # are still probe's go, a sequence number that was answered may have
+        # been handed to another probe since.
+        if probe.waiting:
+            for seq in [probe.seq] + probe.burst:
+                pending = self.pending.get((self.pid, seq))
+                if pending is not None and pending[0] is probe:
+                    del self.pending[(self.pid, seq)]
+            probe.burst = []
+            probe.waiting = False
+
+    def members(self, probe):
+        # Every probe a sample from probe counts for
+        group = self.groups.get(probe.group)
+        if group and group[0] is probe:
+            return group
+        return (probe, )
+
+    def priority_of(self, probe):
+        # A probe pinging for a group is as important as its top member
+        return max([member.priority for member in self.members(probe)])
+
+    def interval_for(self, probe):
+        interval = probe.interval * self.scale / max(self.priority_of(probe), 0.001)
+        return min(max(interval, self.min_interval), self.max_interval)
+
+    def rebalance(self):
+        # Work out the scale that keeps pings within the budget
+        self.balancer = None
+        total = demand = 0.0
+        parked = 0
+        pinging = []
+        for probe in self.probes.itervalues():
+            if probe.parked:
+                parked += 1
+            elif probe.mapped:
+                priority = max(self.priority_of(probe), 0.001)
+                total += priority
+                demand += priority / probe.interval
+                pinging.append(probe)
+        if pinging:
+            # Average priority counts as 1
+            scale = total / len(pinging)
+            if self.pps is not None:
+                # Refreshing groups takes a mapping burst per group and a
+                # check per parked member every 'refresh' seconds, pings get
+                # what's left of their share (but never less than half)
+                refreshing = (len(self.groups) * self.mapping_ttl + parked) / self.refresh
+                budget = max(self.pps * self.headroom - refreshing, self.pps * self.headroom / 2)
+                if demand / scale > budget:
+                    scale = demand / budget
+            self.scale = scale
+        if self.pps is not None:
+            # Pings get what they'll send at that scale, mapping the rest
+            rate = sum([1.0 / self.interval_for(probe) for probe in pinging])
+            self.ping_rate = min(rate, self.pps * self.headroom)
+        if self.running:
+            self.balancer = self.wheel.callLater(5.0, self.rebalance)
+
+    def reschedule(self, probe, ts):
+        # Moves the probe's deadline, the same timer is reused every time
+        probe.next_ts = ts
+        if probe.deadline is None:
+            probe.deadline = self.wheel.callAt(ts, self.due, probe)
+        else:
+            probe.deadline.resetAt(ts)
+
+    def start(self):
+        self.running = True
+        reactor.addReader(self)
+        self.rebalance()
+        self.drain()
+
+    def stop(self):
+        self.running = False
+        reactor.removeReader(self)
+        if self.retry is not None and self.retry.active():
+            self.retry.cancel()
+        self.retry = None
+        if self.balancer is not None and self.balancer.active():
+            self.balancer.cancel()
+        self.balancer = None
+
+    def mapping_due(self, probe, now):
+        # Whether what the probe sends next comes out of the mapping share
+        return not probe.mapped or probe.parked or self.refresh_due(probe, now)
+
+    def due(self, probe):
+        # A probe's deadline came up.  Anything already waiting for the same
+        # share goes first.
+        now = time.time()
+        ready = self.mapping_ready if self.mapping_due(probe, now) else self.ready
+        if ready or not self.running or not self.run(probe, now):
+            ready.append(probe)
+            self.wait()
+
+    def drain(self):
+        # Runs the probes that came due while the budget was spent
+        self.retry = None
+        if not self.running:
+            return
+        now = time.time()
+        for ready in (self.ready, self.mapping_ready):
+            while ready:
+                probe = ready.popleft()
+                if probe.deadline.active() or self.probes.get(probe.key) is not probe:
+                    # Rescheduled or removed while it waited
+                    continue
+                if not self.run(probe, now):
+                    ready.appendleft(probe)
+                    break
+        self.wait()
+
+    def wait(self):
+        # Come back when the buckets have tokens again
+        if (self.ready or self.mapping_ready) and self.running and self.retry is None:
+            self.retry = self.wheel.callLater(1.0 / self.pps if self.pps else 0, self.drain)
+
+    def take_token(self, now, count=1, mapping=False):
+        if self.pps is None:
+            return True
+        elapsed = now - self.tokens_ts
+        self.tokens_ts = now
+        # The mapping bucket holds at least a burst
+        mapping_rate = self.pps - self.ping_rate
+        self.tokens = min(self.tokens + elapsed * self.ping_rate, max(self.ping_rate, 1.0))
+        self.mapping_tokens = min(self.mapping_tokens + elapsed * mapping_rate, max(mapping_rate, float(self.mapping_ttl)))
+        if mapping:
+            if self.mapping_tokens < count:
+                return False
+            self.mapping_tokens -= count
         else:
-            return None
+            if self.tokens < count:
+                return False
+            self.tokens -= count
+        return True
+
+    def next_seq(self):
+        # Sequence numbers are shared by all probes so (id, seq) is unique,
+        # skipping any still waiting for an answer.  Callers make sure there's
+        # one free.
+        if len(self.pending) >= SEQS:
+            raise RuntimeError('no free ICMP sequence numbers')
+        seq = (self.seq + 1) & 0xFFFF
+        while (self.pid, seq) in self.pending:
+            seq = (seq + 1) & 0xFFFF
+        self.seq = seq
+        return seq
             
-    def run(self):
-        # Advance state of probes that are ready
-        for probe in self.probes:
-            now = time.time()
-            if not probe.next_ts <= now: continue
-            if probe.waiting:
-                # Last ping timed out, so back off a TTL
-                if probe.mapping_tries == probe.max_mapping_tries: 
-                    probe.mapped = True
-                    probe.max_ttl -= 1
-                    probe.log("MAPPED mapped_ip=%s max_ttl=%s" % (probe.mapped_ip, probe.max_ttl))
-                else:
-                    probe.log("MAPPING_TIMEOUT")
-                    probe.mapping_tries += 1
-            elif not probe.mapped:
-                # If probe isn't mapped, advance TTL and send a ping
-                probe.max_ttl += 1
-            probe.waiting = True
-            # Schedule a timeout handler
-            probe.next_ts = now + probe.timeout
-            probe.ping_ts = now
-            probe.seq += 1
-            # Send the ping!
-            probe.log("PING ip=%s id=%s seq=%s ttl=%s" % (probe.ip, self.pid, probe.seq, probe.max_ttl))
-            self.ping(probe.ip, id=self.pid, seq=probe.seq, ttl=probe.max_ttl)
-        # Process incoming data
-        while True:
-            now = time.time()
-            rlist, wlist, xlist = select.select([self.sock, sys.stdin], [], [], 0.01)
-            if not rlist:
-                break
-            if sys.stdin in rlist:
-                line = sys.stdin.readline()
-                if self.state == STATE_COMMAND:
-                    line = line.strip().upper()
-                    if line.startswith == 'PING':
-                        # TODO: allow registration of pings' remotely
-                        pass
-            if self.sock in rlist:
+    def run(self, probe, now):
+        # Advance state of a probe that's due.  Returns False, having done
+        # nothing, if it has to wait for the send budget.
+        if not probe.mapped and probe.waiting:
+            # The mapping burst has had its time
+            self.finish_mapping(probe, now)
+            return True
+        if probe.parked and probe.waiting:
+            # Nothing answered the check, the path may have moved
+            probe.log("CHECK_TIMEOUT")
+            self.remap(probe)
+        elif probe.waiting:
+            # Last ping timed out.  The next one goes out when it would have
+            # after an answer.
+            self.forget(probe)
+            self.lost += 1
+            self.reschedule(probe, probe.ping_ts + self.interval_for(probe))
+            for member in self.members(probe):
+                self.replyLost(member)
+            return True
+        elif self.refresh_due(probe, now):
+            # Map the group's path again.  The probe stays in the group
+            # meanwhile, finish_mapping() moves it if the path moved.
+            probe.mapped = False
+            probe.mapping_tries = 0
+        count = 1 if probe.mapped else self.mapping_ttl
+        if len(self.pending) + count > SEQS:
+            # Not enough sequence numbers free, try again once some pings
+            # have been answered or timed out
+            self.reschedule(probe, now + probe.timeout)
+            return True
+        if not self.take_token(now, count, not probe.mapped or probe.parked):
+            return False
+        if not probe.mapped:
+            self.start_mapping(probe, now)
+            return True
+        # Send the ping!  A parked probe's check goes to the group's hop
+        # rather than all the way.
+        ttl = probe.hop_ttl if probe.parked else probe.max_ttl
+        probe.waiting = True
+        # Schedule a timeout handler
+        self.reschedule(probe, now + probe.timeout)
+        probe.ping_ts = now
+        probe.seq = self.next_seq()
+        self.pending[(self.pid, probe.seq)] = (probe, ttl)
+        probe.log("%s ip=%s id=%s seq=%s ttl=%s", "CHECK" if probe.parked else "PING", probe.ip, self.pid, probe.seq, ttl)
+        self.ping(probe, probe.seq, ttl, now)
+        self.sent += 1
+        return True
+
+    def checked(self, probe, addr, now):
+        # A parked probe's check was answered by addr
+        probe.waiting = False
+        if addr == probe.mapped_ip:
+            probe.mapped_ts = now
+            self.reschedule(probe, now + self.refresh)
+        else:
+            probe.log("CHECK_MOVED addr=%s", addr)
+            self.remap(probe)
+            self.reschedule(probe, now)
+
+    def start_mapping(self, probe, now):
+        # Sends the mapping burst, one ping per TTL
+        probe.waiting = True
+        probe.ping_ts = now
+        probe.hops = {}
+        probe.reached = probe.reached_ms = None
+        probe.burst = []
+        for ttl in xrange(1, self.mapping_ttl + 1):
+            seq = self.next_seq()
+            probe.burst.append(seq)
+            self.pending[(self.pid, seq)] = (probe, ttl)
+            self.ping(probe, seq, ttl, now)
+        self.sent += self.mapping_ttl
+        MAPPINGS.inc()
+        probe.log("MAPPING ip=%s id=%s ttl=1-%s", probe.ip, self.pid, self.mapping_ttl)
+        self.reschedule(probe, now + probe.timeout)
+
+    def mapping_complete(self, probe):
+        # Target reached, and nothing closer could still reach it
+        return probe.reached is not None and (probe.reached == 1 or probe.reached - 1 in probe.hops)
+
+    def finish_mapping(self, probe, now):
+        # Settles a mapping burst, complete or timed out
+        for seq in probe.burst:
+            self.pending.pop((self.pid, seq), None)
+        probe.burst = []
+        probe.waiting = False
+        if probe.reached is not None:
+            probe.max_ttl = probe.reached
+            below = [ttl for ttl in probe.hops if ttl < probe.reached]
+            probe.hop_ttl = max(below) if below else probe.reached
+            probe.mapped_ip = probe.hops[probe.hop_ttl] if below else probe.ip
+        elif probe.hops:
+            # Target never answered, measure up to the last hop that did
+            probe.max_ttl = probe.hop_ttl = max(probe.hops)
+            probe.mapped_ip = probe.hops[probe.max_ttl]
+        elif probe.mapping_tries < probe.max_mapping_tries:
+            probe.log("MAPPING_TIMEOUT")
+            probe.mapping_tries += 1
+            self.reschedule(probe, now)
+            return
+        else:
+            # Nothing answers at all, ping at full TTL anyway
+            probe.max_ttl = probe.hop_ttl = self.mapping_ttl
+            probe.mapped_ip = probe.ip
+        probe.mapped = True
+        probe.mapped_ts = now
+        probe.mapping_tries = 0
+        probe.log("MAPPED mapped_ip=%s max_ttl=%s", probe.mapped_ip, probe.max_ttl)
+        pinging = probe.group is not None
+        parked = self.join(probe, now)
+        if not parked and not pinging and self.pps is not None:
+            # Its pings count against the pings' share right away, not only
+            # from the next rebalance()
+            self.ping_rate = min(self.ping_rate + 1.0 / self.interval_for(probe), self.pps * self.headroom)
+        if probe.reached_ms is not None:
+            # The target's answer to the burst is a sample already
+            for member in self.members(probe):
+                self.replyReceived(member, probe.reached_ms)
+        if not parked:
+            self.reschedule(probe, now + (self.interval_for(probe) if probe.reached_ms is not None else 0))
+
+    # IReadDescriptor, so the reactor tells us when replies are waiting
+    def fileno(self):
+        return self.sock.fileno()
+
+    def logPrefix(self):
+        return 'Prober'
+
+    def connectionLost(self, reason):
+        self.running = False
+        self.sock.close()
+
+    def doRead(self):
+        # Drain what's queued, but give the reactor back every so often
+        for i in xrange(1000):
+            try:
                 # Should never need more than ~50 bytes
                 data, paddr = self.sock.recvfrom(256)
-                paddr = paddr[0]
-                icmpHeader = data[20:24]
-                ptype, pcode, checksum = struct.unpack(
-                    "bbH", icmpHeader
-                )
-                if ptype == 0:
-                    # ICMP Echo Reply
-                    body = data[24:40]
-                    pid, pseq, tstamp = struct.unpack(
-                        "HhL", body
-                    )
-                    probe = self.get_probe(paddr)
-                    if probe:
-                        tstamp = data[28:36]
-                        et = int(time.time() * 1000.0)
-                        [st] = struct.unpack("L", tstamp)
-                        ms = (et - st)
-                        if not probe.mapped:
-                            probe.mapped = True
-                            probe.log("MAPPED mapped_ip=%s max_ttl=%s" % (probe.mapped_ip, probe.max_ttl))
-                        probe.log("PONG type=echo_reply id=%s seq=%s ms=%s" % (pid, pseq, ms))
-                        probe.next_ts = now + probe.interval
-                        probe.waiting = False
-                elif ptype == 11 and pcode == 0:
-                    # ICMP Time Exceeded
-                    original_ip_header, original_data = data[28:48], data[48:56]
-                    dest_addr = util.ip(original_ip_header[16:20])
-                    probe = self.get_probe(dest_addr)
-                    if not probe: return
-                    # Original datagram is included after the IP header
-                    otype, ocode, ochecksum, oid, oseq = struct.unpack(
-                        "bbHHh", original_data
-                    )
-                    ms = int((now - probe.ping_ts) * 1000.0)
-                    probe.log("PONG type=time_exceeded id=%s seq=%s addr=%s ms=%s" % (oid, oseq, paddr, ms))
-                    if probe.mapped:
-                        # Just schedule the next regular ping
-                        probe.next_ts = now + probe.interval
-                        probe.waiting = False
-                    if not probe.mapped:
-                        # Set new max_ttl, if necessary, and continue mapping
-                        probe.max_ttl = max(oseq, probe.max_ttl)
-                        probe.next_ts = now
-                        probe.waiting = False
-                        probe.mapped_ip = paddr
-                        # In case this was a retry, reset the counter
-                        probe.mapping_tries = 0
-        
-    def checksum(self, data):
-        byte_sum = sum([ord(data[i * 2]) + (ord(data[i * 2 + 1]) << 8) for i in range(len(data) / 2)])
-        if len(data) % 2 == 1:
-            byte_sum += ord(data[-1])
-        byte_sum = byte_sum + (byte_sum >> 16)
-        answer = ~byte_sum
-        answer = answer & 0xffff
-        answer = answer >> 8 | (answer << 8 & 0xff00)
-        return answer
-
-    def create_packet(self, addr, id, seq = 1):
-        # Creates an ICMP packet, including header.  See RFC 792 for details.
-        #
-        #  HEADER
-        #    8-bits:    type
-        #    8-bits:    code
-        #    16-bits:   checksum
-        #    16-bits:   id
-        #    16-bits:   sequence   
-        #  DATA
-        #    variable: data
-        #
-        # 'type' value for ICMP_ECHO_REQUEST is 8.
-        # 'code' value should be 0.
-        # 'checksum' is a 16-bit one's complement checksum of the entire packet
-        #
-        #  NOTE: since the checksum includes it's own value, calculate checksum as
-        #    if it were set to zero. 
-        header = struct.pack('bbHHh', 8, 0, 0, id, seq)
-        data = struct.pack('L', int(time.time() * 1000.0)) + PAYLOAD
-        fake_packet = header + data
-        new_checksum = struct.pack('H', socket.htons(self.checksum(fake_packet)))
-        packet = fake_packet[:2] + new_checksum + fake_packet[4:]
-        return packet
+            except socket.error, e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    return
+                raise
+            self.packetReceived(data, paddr[0])
+
+    def packetReceived(self, data, paddr):
+        now = time.time()
+        icmpHeader = data[20:24]
+        ptype, pcode, checksum = struct.unpack(
+            "bbH", icmpHeader
+        )
+        if ptype == 0:
+            # ICMP Echo Reply
+            body = data[24:40]
+            pid, pseq, tstamp = struct.unpack(
+                "HHL", body
+            )
+            pending = self.pending.pop((pid, pseq), None)
+            if pending:
+                probe, ttl = pending
+                tstamp = data[28:36]
+                et = int(time.time() * 1000.0)
+                [st] = struct.unpack("L", tstamp)
+                ms = (et - st)
+                probe.log("PONG type=echo_reply id=%s seq=%s ttl=%s ms=%s", pid, pseq, ttl, ms)
+                self.received += 1
+                if not probe.mapped:
+                    if probe.reached is None or ttl < probe.reached:
+                        probe.reached = ttl
+                        probe.reached_ms = ms
+                    if self.mapping_complete(probe):
+                        self.finish_mapping(probe, now)
+                    return
+                if probe.parked:
+                    self.checked(probe, probe.ip, now)
+                    return
+                probe.waiting = False
+                RTT.observe(ms / 1000.0)
+                self.reschedule(probe, now + self.interval_for(probe))
+                for member in self.members(probe):
+                    self.replyReceived(member, ms)
+        elif ptype == 11 and pcode == 0:
+            # ICMP Time Exceeded
+            # Original datagram is included after the IP header
+            original_data = data[48:56]
+            otype, ocode, ochecksum, oid, oseq = struct.unpack(
+                "bbHHH", original_data
+            )
+            pending = self.pending.pop((oid, oseq), None)
+            if not pending: return
+            probe, ttl = pending
+            ms = int((now - probe.ping_ts) * 1000.0)
+            probe.log("PONG type=time_exceeded id=%s seq=%s ttl=%s addr=%s ms=%s", oid, oseq, ttl, paddr, ms)
+            self.received += 1
+            if probe.parked:
+                self.checked(probe, paddr, now)
+            elif probe.mapped:
+                # Just schedule the next regular ping
+                RTT.observe(ms / 1000.0)
+                self.reschedule(probe, now + self.interval_for(probe))
+                probe.waiting = False
+                for member in self.members(probe):
+                    self.replyReceived(member, ms)
+            else:
+                probe.hops[ttl] = paddr
+                if self.mapping_complete(probe):
+                    self.finish_mapping(probe, now)
         
-    def ping(self, addr, id=1, seq=1, ttl=255, verbose = False):
-        addr = socket.gethostbyname(addr)
-        packet = self.create_packet(addr, id, seq)
-        if verbose:
-            print "Pinging %s (id=%s seq=%s ttl=%s)" % (addr, id, seq, ttl)
-        self.sock.setsockopt(socket.SOL_IP, socket.IP_TTL, ttl)
+    def replyReceived(self, probe, ms):
+        # OVERRIDE ME!  A mapped probe got an answer after 'ms' milliseconds
+        pass
+
+    def replyLost(self, probe):
+        # OVERRIDE ME!  A mapped probe's ping timed out
+        pass
+
+    def ping(self, probe, seq, ttl, now):
+        packet = probe.packet.update(seq, int(now * 1000.0))
+        if ttl != self.ttl:
+            self.sock.setsockopt(socket.SOL_IP, socket.IP_TTL, ttl)
+            self.ttl = ttl
+        if probe.tos != self.tos:
+            self.sock.setsockopt(socket.SOL_IP, socket.IP_TOS, probe.tos)
+            self.tos = probe.tos
         # Python requires a tuple of (addr, port), but the system call actually doesn't
-        #   require a port.  So we'll send '1' as a dummy port value.
-        self.sock.sendto(packet, (addr, 1))
+        #   require a port.  So probe.address has '1' as a dummy port value.
+        self.sock.sendto(packet, probe.address)
+
+class ControlProtocol(basic.LineReceiver):
+    # Line based control channel for a running Prober:
+    #
+    #   ADD <host> [tos]      start probing host
+    #   REMOVE <host> [tos]   stop probing host
+    #   LIST            one line per probe, then END
+    delimiter = '\n'
+
+    def __init__(self, prober):
+        self.prober = prober
+
+    def lineReceived(self, line):
+        parts = line.strip().split()
+        if not parts:
+            return
+        command, args = parts[0].upper(), parts[1:]
+        try:
+            if command == 'ADD' and len(args) in (1, 2):
+                # Answered once the name is looked up
+                d = self.prober.add_name(args[0], *[int(arg) for arg in args[1:]])
+                d.addCallbacks(lambda probe: self.sendLine('OK'), lambda failure: self.sendLine('ERROR %s' % failure.getErrorMessage()))
+                return
+            elif command == 'REMOVE' and len(args) in (1, 2):
+                self.prober.remove(args[0], *[int(arg) for arg in args[1:]])
+            elif command == 'LIST' and not args:
+                for (host, tos), probe in sorted(self.prober.probes.items()):
+                    self.sendLine('%s tos=%s ip=%s mapped=%s mapped_ip=%s max_ttl=%s' % (host, tos, probe.ip, probe.mapped, probe.mapped_ip, probe.max_ttl))
+                self.sendLine('END')
+                return
+            else:
+                self.sendLine('ERROR unknown command: %s' % line.strip())
+                return
+        except (socket.error, ValueError), e:
+            self.sendLine('ERROR %s' % e)
+            return
+        self.sendLine('OK')
+
+class ControlFactory(protocol.ServerFactory):
+    # For serving the control channel on a socket, e.g.
+    #   reactor.listenUNIX('/var/run/kyro-prober.sock', ControlFactory(prober))
+
+    def __init__(self, prober):
+        self.prober = prober
+
+    def buildProtocol(self, addr):
+        return ControlProtocol(self.prober)
 
 if __name__ == "__main__":
     hosts = ['cnn.com'] #, 'google.com', 'justin.tv', 'yahoo.com', 'nytimes.com', 'ustream.tv', 'ycombinator.com',
         #'blogtv.com', 'comcast.com', 'ea.com']
+    # Show every ping and pong
+    logger.configure('probe', level=logger.DEBUG, rate=0)
     probe = Prober()
     for host in hosts:
         print "Adding probe for %s..." % host
-        probe.add(host)
-    while True:
-        probe.run()
-            
-            
-
+        probe.add_name(host)
+    # Hosts can be added and removed while running by typing commands on stdin
+    stdio.StandardIO(ControlProtocol(probe))
+    probe.start()
+    reactor.run()
@@ -0,0 +1,515 @@
+from kyro import metrics
+from kyro.util import *
+from bisect import insort
+import gc
+
+__author__    = "Kyle Vogt <kyle@justin.tv>"
+__version__   = "0.1"
+__copyright__ = "Copyright (c) 2010, Kyle Vogt"
+__license__   = "MIT"
+
+# Routing information base storage
+#
+# Path attributes are interned: each distinct attribute set is stored once,
+# keyed by its raw wire encoding, and every route using it holds a reference
+# to the shared entry instead of its own copy of the decoded UPDATE.  Entries
+# are reference counted and dropped when the last route using them goes away.
+
+class AttributeSet(object):
+    __slots__ = ('key', 'attributes', 'refs', 'rank')
+
+    def __init__(self, key, attributes):
+        self.key = key
+        self.attributes = attributes
+        self.refs = 0
+        # Best path sort key, see rank()
+        self.rank = None
+
+    def __repr__(self):
+        return 'AttributeSet(%r, refs=%s)' % (self.attributes, self.refs)
+
+class AttributeTable(object):
+
+    def __init__(self):
+        self.sets = {}
+
+    def __len__(self):
+        return len(self.sets)
+
+    def intern(self, key, attributes):
+        # Returns the shared entry for this attribute set.  The caller takes a
+        # reference for each route with retain().
+        entry = self.sets.get(key)
+        if entry is None:
+            entry = self.sets[key] = AttributeSet(key, attributes)
+        return entry
+
+    def retain(self, entry):
+        entry.refs += 1
+        return entry
+
+    def release(self, entry):
+        entry.refs -= 1
+        if entry.refs <= 0:
+            del self.sets[entry.key]
+
+# Binary radix (Patricia) tree keyed by integer IPv4 prefix and length
+#
+# Only nodes that hold a route or join two subtrees exist, so the tree has at
+# most two nodes per route and no lookup visits more than 33 of them.  Glue
+# nodes (the joins) carry EMPTY as their value.
+
+EMPTY = object()
+MAX_BITS = 32
+BITS = [0x80000000 >> i for i in range(MAX_BITS)] + [0]
+
+class Node(object):
+    __slots__ = ('network', 'length', 'value', 'parent', 'left', 'right')
+
+    def __init__(self, network, length, value=EMPTY, parent=None):
+        self.network = network
+        self.length = length
+        self.value = value
+        self.parent = parent
+        self.left = None
+        self.right = None
+
+class RadixTree(object):
+
+    def __init__(self):
+        self.root = None
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        return self.subtree(0, 0)
+
+    def __contains__(self, key):
+        return self.node(*key) is not None
+
+    def node(self, network, length):
+        # Exact match, or None
+        node = self.root
+        while node is not None and node.length < length:
+            node = node.right if network & BITS[node.length] else node.left
+        if node is None or node.length != length or node.value is EMPTY:
+            return None
+        if node.network != network & MASKS[length]:
+            return None
+        return node
+
+    def get(self, network, length, default=None):
+        node = self.node(network, length)
+        return default if node is None else node.value
+
+    def insert(self, network, length, value):
+        # Stores value under network/length and returns whatever was there
+        # before, or None
+        network &= MASKS[length]
+        node = self.root
+        if node is None:
+            self.root = Node(network, length, value)
+            self.count += 1
+            return None
+
+        # Walk down to the closest existing node
+        while node.length < length or node.value is EMPTY:
+            child = node.right if network & BITS[node.length] else node.left
+            if child is None:
+                break
+            node = child
+
+        # Find the first bit where the new prefix leaves that node's path, then
+        # back up to the node that sits at or above it
+        check = min(node.length, length)
+        differ = MAX_BITS - ((node.network ^ network) & MASKS[check]).bit_length()
+        differ = min(differ, check)
+        parent = node.parent
+        while parent is not None and parent.length >= differ:
+            node = parent
+            parent = node.parent
+
+        if differ == length and node.length == length:
+            # Exact node already exists (possibly as glue)
+            previous = node.value
+            node.value = value
+            if previous is EMPTY:
+                self.count += 1
+                return None
+            return previous
+
+        new = Node(network, length, value)
+        self.count += 1
+        if node.length == differ:
+            # New prefix hangs below node
+            new.parent = node
+            if network & BITS[node.length]:
+                node.right = new
+            else:
+                node.left = new
+        elif length == differ:
+            # New prefix covers node, so it takes node's place
+            if node.network & BITS[length]:
+                new.right = node
+            else:
+                new.left = node
+            self.replace(node, new)
+            node.parent = new
+        else:
+            # Paths split below both, join them with a glue node
+            glue = Node(network & MASKS[differ], differ)
+            if network & BITS[differ]:
+                glue.right, glue.left = new, node
+            else:
+                glue.right, glue.left = node, new
+            new.parent = glue
+            self.replace(node, glue)
+            node.parent = glue
+        return None
+
+    def build(self, items):
+        # Fills an empty tree from (network, length, value) in the order
+        # subtree() yields them.  Each prefix can only land on the right edge
+        # of what's built so far, so this attaches it there without the walk
+        # down from the root that insert() does.
+        if self.root is not None:
+            raise ValueError('can only build an empty tree')
+        # The right edge, root first
+        edge = []
+        push = edge.append
+        pop = edge.pop
+        last = -1
+        count = 0
+        for network, length, value in items:
+            key = network << 6 | length
+            if key <= last:
+                raise ValueError('%s is out of order' % prefix(network, length))
+            last = key
+            new = Node(network, length, value)
+            count += 1
+            # Back up to the deepest node covering the new prefix
+            below = None
+            while edge:
+                node = edge[-1]
+                if node.length <= length and network & MASKS[node.length] == node.network:
+                    break
+                below = pop()
+            parent = edge[-1] if edge else None
+            if below is not None:
+                check = below.length if below.length < length else length
+                differ = MAX_BITS - ((below.network ^ network) & MASKS[check]).bit_length()
+                if parent is None or parent.length < differ:
+                    # The new prefix splits off below where it leaves it
+                    glue = Node(network & MASKS[differ], differ)
+                    glue.left = below
+                    glue.right = new
+                    self.replace(below, glue)
+                    below.parent = new.parent = glue
+                    push(glue)
+                    push(new)
+                    continue
+            if parent is None:
+                self.root = new
+            else:
+                new.parent = parent
+                if network & BITS[parent.length]:
+                    parent.right = new
+                else:
+                    parent.left = new
+            push(new)
+        self.count += count
+
+    def replace(self, old, new):
+        # Puts new where old hangs in the tree
+        parent = old.parent
+        new.parent = parent
+        if parent is None:
+            self.root = new
+        elif parent.right is old:
+            parent.right = new
+        else:
+            parent.left = new
+
+    def remove(self, network, length):
+        # Drops network/length and returns its value, or None if it wasn't there
+        node = self.node(network, length)
+        if node is None:
+            return None
+        value = node.value
+        self.count -= 1
+
+        if node.left is not None and node.right is not None:
+            # Still joins two subtrees, so keep it as glue
+            node.value = EMPTY
+            return value
+
+        child = node.left if node.left is not None else node.right
+        if child is not None:
+            self.replace(node, child)
+            return value
+
+        parent = node.parent
+        if parent is None:
+            self.root = None
+            return value
+        if parent.right is node:
+            parent.right = None
+            sibling = parent.left
+        else:
+            parent.left = None
+            sibling = parent.right
+        if parent.value is EMPTY:
+            # Glue with one child left is useless, splice it out
+            self.replace(parent, sibling)
+        return value
+
+    def match(self, address, length=MAX_BITS):
+        # Longest prefix match.  Returns (network, length, value) for the most
+        # specific route covering address/length, or None.
+        best = None
+        node = self.root
+        while node is not None and node.length <= length:
+            if node.network != address & MASKS[node.length]:
+                break
+            if node.value is not EMPTY:
+                best = node
+            node = node.right if address & BITS[node.length] else node.left
+        if best is None:
+            return None
+        return best.network, best.length, best.value
+
+    def subtree(self, network=0, length=0):
+        # Yields (network, length, value) for every route inside network/length,
+        # in address order, covering prefixes before the ones they cover
+        network &= MASKS[length]
+        node = self.root
+        while node is not None and node.length < length:
+            node = node.right if network & BITS[node.length] else node.left
+        if node is None or node.network & MASKS[length] != network:
+            return
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            if node.value is not EMPTY:
+                yield node.network, node.length, node.value
+            if node.right is not None:
+                stack.append(node.right)
+            if node.left is not None:
+                stack.append(node.left)
+
+# Best path selection
+#
+# The decision process boils down to a sort key per attribute set, lower is
+# better: highest LOCAL_PREF, then shortest AS_PATH (a set counts as one),
+# lowest ORIGIN and lowest MULTI_EXIT_DISC.  MEDs are compared whatever the
+# neighboring AS.  Ties go to the peer with the lowest source number (the
+# router uses the BGP identifier).
+
+ORIGINS = {'IGP' : 0, 'EGP' : 1, 'INCOMPLETE' : 2}
+
+ANNOUNCED = metrics.counter('kyro_rib_announced_paths_total', 'Paths announced into the Adj-RIB-In')
+WITHDRAWN = metrics.counter('kyro_rib_withdrawn_paths_total', 'Paths withdrawn from the Adj-RIB-In')
+BEST_CHANGED = metrics.counter('kyro_rib_best_path_changes_total', 'Announcements and withdrawals that changed a best path')
+DEFAULT_LOCAL_PREF = 100
+
+def rank(path_attributes):
+    as_path_length = 0
+    for segment_type, segment_length, asns in path_attributes.get('AS_PATH') or []:
+        as_path_length += 1 if segment_type == 'AS_SET' else len(asns)
+    local_pref = path_attributes.get('LOCAL_PREF')
+    if local_pref is None:
+        local_pref = DEFAULT_LOCAL_PREF
+    return (-local_pref, as_path_length, ORIGINS.get(path_attributes.get('ORIGIN'), 2), path_attributes.get('MULTI_EXIT_DISC') or 0)
+
+class AdjRibIn(object):
+    # Routes learned from every peer, in one table.
+    #
+    # Each prefix has a single node in the tree, whatever the number of peers
+    # announcing it, and attribute sets are interned across peers.  A node's
+    # value is the list of its paths, one (rank, source, attribute set) per
+    # peer, kept sorted so the best path is always first.
+    #
+    # Paths put back from a snapshot are stale until their peer announces or
+    # withdraws them again.  Whatever is still stale when the peer is done
+    # re-sending its table is gone from it, and sweep() drops it.
+
+    def __init__(self):
+        self.tree = RadixTree()
+        self.attributes = AttributeTable()
+        # Prefixes by source, as network << 6 | length, so a source's paths
+        # are found without walking the tree
+        self.routes = {}
+        self.path_count = 0
+        # Stale prefixes by source, as network << 6 | length
+        self.stale = {}
+        # Goes up with every change, to tell whether the table moved
+        self.generation = 0
+
+    def __len__(self):
+        return len(self.tree)
+
+    def __iter__(self):
+        # Yields (network, length, best attribute set) for every prefix
+        for network, length, paths in self.tree:
+            yield network, length, paths[0][2]
+
+    def count(self, source):
+        # Number of paths learned from source
+        return len(self.routes.get(source, ()))
+
+    def intern(self, key, attributes):
+        entry = self.attributes.intern(key, attributes)
+        if entry.rank is None:
+            entry.rank = rank(attributes)
+        return entry
+
+    def best(self, network, length):
+        paths = self.tree.get(network, length)
+        return paths[0][2] if paths else None
+
+    def paths(self, network, length):
+        # (source, attribute set) for every path to network/length, best first
+        return [(source, entry) for path_rank, source, entry in self.tree.get(network, length) or []]
+
+    def announce(self, source, network, length, entry):
+        # Sets source's path to network/length, replacing any it had before.
+        # Returns (previous best, best) attribute sets; they are the same
+        # object when the best path didn't change.
+        if self.stale:
+            self.refresh(source, network, length)
+        self.generation += 1
+        paths = self.tree.get(network, length)
+        if paths is None:
+            paths = []
+            self.tree.insert(network, length, paths)
+        previous = paths[0][2] if paths else None
+        # Retain before releasing the old path, which may be the only other
+        # reference to the same set
+        self.attributes.retain(entry)
+        self.discard(paths, source)
+        insort(paths, (entry.rank, source, entry))
+        try:
+            self.routes[source].add(network << 6 | length)
+        except KeyError:
+            self.routes[source] = set([network << 6 | length])
+        self.path_count += 1
+        ANNOUNCED.inc()
+        if previous is not paths[0][2]:
+            BEST_CHANGED.inc()
+        return previous, paths[0][2]
+
+    def withdraw(self, source, network, length):
+        # Drops source's path to network/length.  Returns (previous best, best)
+        # with best None if no path is left, or None if source had no path.
+        if self.stale:
+            self.refresh(source, network, length)
+        paths = self.tree.get(network, length)
+        if not paths:
+            return None
+        previous = paths[0][2]
+        if not self.discard(paths, source):
+            return None
+        self.routes[source].discard(network << 6 | length)
+        self.generation += 1
+        WITHDRAWN.inc()
+        if not paths:
+            self.tree.remove(network, length)
+            BEST_CHANGED.inc()
+            return previous, None
+        if previous is not paths[0][2]:
+            BEST_CHANGED.inc()
+        return previous, paths[0][2]
+
+    def withdrawSource(self, source):
+        # Drops every path learned from source, e.g. when its session goes
+        # down.  Returns (network, length, previous best, best) for each
+        # prefix whose best path changed, with best None if no path is left.
+        self.stale.pop(source, None)
+        changes = []
+        for key in sorted(self.routes.get(source, ())):
+            network, length = key >> 6, key & 63
+            previous, best = self.withdraw(source, network, length)
+            if previous is not best:
+                changes.append((network, length, previous, best))
+        self.routes.pop(source, None)
+        return changes
+
+    def restore(self, routes):
+        # Fills an empty table with the paths saved in a snapshot, all marked
+        # stale.  routes yields (network, length, source, attribute set)
+        # grouped by prefix, with the prefixes in tree order, so the tree
+        # can be built in one pass.
+        if len(self.tree):
+            raise ValueError('can only restore into an empty table')
+        # That's a few objects per route, all long lived.  The cyclic
+        # collector would keep rescanning them as they're made.
+        collecting = gc.isenabled()
+        gc.disable()
+        try:
+            self.tree.build(self.restoring(routes))
+        finally:
+            if collecting:
+                gc.enable()
+        # Every path is stale, one per source and prefix
+        for source, marks in self.stale.iteritems():
+            self.routes[source] = set(marks)
+        self.path_count = sum(len(keys) for keys in self.routes.itervalues())
+        self.generation += 1
+
+    def restoring(self, routes):
+        # Groups routes into (network, length, sorted paths)
+        stale = self.stale
+        last = None
+        paths = None
+        for network, length, source, entry in routes:
+            if network != last or length != last_length:
+                if paths:
+                    paths.sort()
+                    yield last, last_length, paths
+                last = network
+                last_length = length
+                key = network << 6 | length
+                paths = []
+            entry.refs += 1
+            paths.append((entry.rank, source, entry))
+            try:
+                stale[source].add(key)
+            except KeyError:
+                stale[source] = set([key])
+        if paths:
+            paths.sort()
+            yield last, last_length, paths
+
+    def refresh(self, source, network, length):
+        stale = self.stale.get(source)
+        if stale is not None:
+            stale.discard(network << 6 | length)
+
+    def staleCount(self, source=None):
+        # Stale paths from source, or from everyone
+        if source is None:
+            return sum(len(stale) for stale in self.stale.itervalues())
+        return len(self.stale.get(source, ()))
+
+    def sweep(self, source):
+        # Drops the paths from source still stale, i.e. restored from a
+        # snapshot and not sent again since.  Returns the changes like
+        # withdrawSource().
+        changes = []
+        for key in self.stale.pop(source, ()):
+            network, length = key >> 6, key & 63
+            change = self.withdraw(source, network, length)
+            if change is not None and change[0] is not change[1]:
+                changes.append((network, length, change[0], change[1]))
+        return changes
+
+    def discard(self, paths, source):
+        for index, path in enumerate(paths):
+            if path[1] == source:
+                del paths[index]
+                self.attributes.release(path[2])
+                self.path_count -= 1
+                return True
+        return False
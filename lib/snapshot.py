@@ -0,0 +1,158 @@
+from kyro import bgp
+from array import array
+from itertools import izip
+import struct
+import mmap
+import zlib
+import time
+import sys
+import os
+
+__author__    = "Kyle Vogt <kyle@justin.tv>"
+__version__   = "0.1"
+__copyright__ = "Copyright (c) 2010, Kyle Vogt"
+__license__   = "MIT"
+
+# Adj-RIB-In snapshots
+#
+# The router saves its table every few minutes, so that after a restart it
+# starts out with the routes it had instead of an empty table until every
+# peer has sent its whole table again.  A snapshot file is:
+#
+#    32 byte header: magic, version, path count, attribute set count, time
+#        written, and a crc32 of everything after the header
+#    the paths, one column at a time:
+#        networks (4 bytes each), sources (4), attribute set numbers (4),
+#        prefix lengths (1)
+#    the attribute sets, each a 4 byte length and its raw path attributes
+#
+# all little endian.  Loading maps the file and reads each column straight
+# into an array, and the attribute sets are decoded on demand just like the
+# ones off the wire, so a restore costs little more than putting the routes
+# back in the tree.
+#
+# A snapshot is written to <name>.tmp and renamed over <name> once it's on
+# disk, so a crash while writing leaves the previous one in place.
+
+MAGIC = 'KRIB'
+VERSION = 1
+HEADER = struct.Struct('<4sHxxIIdI4x')
+SET_LENGTH = struct.Struct('<I')
+COLUMNS = ('I', 'I', 'I', 'B')
+
+class Capture(object):
+    # Copies what a snapshot needs out of a table, the path columns and the
+    # raw attribute sets, to hand to write().
+    #
+    # The copy is made a /8 at a time, one per step when iterating, so it
+    # can be spread over reactor iterations (e.g. with task.cooperate())
+    # while the table keeps changing.  Every /8 is copied as it was at one
+    # point in time, and they all go out in tree order, which is all a
+    # restore needs.  run() copies the whole table in one go.
+
+    def __init__(self, rib):
+        self.rib = rib
+        self.columns = tuple([array(typecode) for typecode in COLUMNS])
+        self.sets = []
+        self.index = {}
+
+    def __iter__(self):
+        for top in xrange(256):
+            self.copy(top)
+            yield top
+
+    def run(self):
+        for top in self:
+            pass
+        return self
+
+    def copy(self, top):
+        networks, sources, numbers, lengths = self.columns
+        index = self.index
+        sets = self.sets
+        tree = self.rib.tree
+        start = top << 24
+        # Prefixes shorter than /8 that start here sort before the /8
+        routes = []
+        for length in xrange(8):
+            if not top & (0xFF >> length):
+                paths = tree.get(start, length)
+                if paths:
+                    routes.append((start, length, paths))
+        for network, length, paths in routes + list(tree.subtree(start, 8)):
+            for path_rank, source, entry in paths:
+                number = index.get(entry.key)
+                if number is None:
+                    number = index[entry.key] = len(sets)
+                    sets.append(entry.key)
+                networks.append(network)
+                sources.append(source)
+                numbers.append(number)
+                lengths.append(length)
+
+def write(name, columns, sets, ts=None):
+    # Saves the columns and attribute sets of a Capture
+    if ts is None:
+        ts = time.time()
+    if sys.byteorder != 'little':
+        columns = [array(column.typecode, column) for column in columns]
+        for column in columns:
+            column.byteswap()
+    body = [column.tostring() for column in columns]
+    body.extend(SET_LENGTH.pack(len(raw)) + raw for raw in sets)
+    crc = 0
+    for chunk in body:
+        crc = zlib.crc32(chunk, crc)
+    temporary = name + '.tmp'
+    f = open(temporary, 'wb')
+    try:
+        f.write(HEADER.pack(MAGIC, VERSION, len(columns[0]), len(sets), ts, crc & 0xFFFFFFFF))
+        f.writelines(body)
+        f.flush()
+        os.fsync(f.fileno())
+    finally:
+        f.close()
+    os.rename(temporary, name)
+
+def load(name, rib):
+    # Restores the paths in a snapshot into rib, which has to be empty.
+    # They're marked stale, see AdjRibIn.  Returns the time the snapshot was
+    # taken.
+    f = open(name, 'rb')
+    try:
+        if os.fstat(f.fileno()).st_size < HEADER.size:
+            raise ValueError('%s is not a RIB snapshot' % name)
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+        f.close()
+    try:
+        magic, version, path_count, set_count, ts, crc = HEADER.unpack_from(data, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('%s is not a version %s RIB snapshot' % (name, VERSION))
+        if zlib.crc32(buffer(data, HEADER.size)) & 0xFFFFFFFF != crc:
+            raise ValueError('%s is corrupt' % name)
+
+        offset = HEADER.size
+        columns = []
+        for typecode in COLUMNS:
+            column = array(typecode)
+            end = offset + column.itemsize * path_count
+            column.fromstring(data[offset:end])
+            if sys.byteorder != 'little':
+                column.byteswap()
+            columns.append(column)
+            offset = end
+
+        entries = []
+        for number in xrange(set_count):
+            length = SET_LENGTH.unpack_from(data, offset)[0]
+            offset += SET_LENGTH.size
+            raw = data[offset:offset + length]
+            offset += length
+            entries.append(rib.intern(raw, bgp.PathAttributes(raw)))
+    finally:
+        data.close()
+
+    networks, sources, numbers, lengths = columns
+    rib.restore((network, length, source, entries[number]) for network, source, number, length in izip(networks, sources, numbers, lengths))
+    return ts
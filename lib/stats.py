@@ -0,0 +1,170 @@
+import numpy
+import warnings
+
+__author__    = "Kyle Vogt <kyle@justin.tv>"
+__version__   = "0.1"
+__copyright__ = "Copyright (c) 2010, Kyle Vogt"
+__license__   = "MIT"
+
+# Streaming round trip time and loss statistics
+#
+# Samples are kept struct-of-arrays style: every measured thing (a host, or a
+# host over one path) owns a row, and each statistic is one NumPy array with
+# a slot per row.  Each row keeps a fixed ring of its most recent samples, so
+# memory is bounded by rows * window no matter how long we run.  A lost ping
+# is stored as NaN.
+#
+# EWMA, jitter and loss are updated as each sample arrives.  Percentiles are
+# computed over the ring on demand, for one row or for all of them at once.
+
+class SampleStore(object):
+
+    def __init__(self, window=120, capacity=1024, alpha=0.125):
+        self.window = window
+        self.alpha = alpha
+        # Row number by key, and key by row number
+        self.rows = {}
+        self.keys = []
+        self.capacity = 0
+        self.samples = numpy.empty((0, window), numpy.float32)
+        self.head = numpy.empty(0, numpy.int32)
+        self.count = numpy.empty(0, numpy.int32)
+        self.lost = numpy.empty(0, numpy.int32)
+        self.ewma = numpy.empty(0, numpy.float64)
+        self.jitter = numpy.empty(0, numpy.float64)
+        self.last = numpy.empty(0, numpy.float64)
+        self.updated = numpy.empty(0, numpy.float64)
+        self.grow(capacity)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        return key in self.rows
+
+    def grow(self, capacity):
+        extra = capacity - self.capacity
+        if extra <= 0:
+            return
+        self.samples = numpy.vstack([self.samples, numpy.empty((extra, self.window), numpy.float32)])
+        self.head = numpy.concatenate([self.head, numpy.zeros(extra, numpy.int32)])
+        self.count = numpy.concatenate([self.count, numpy.zeros(extra, numpy.int32)])
+        self.lost = numpy.concatenate([self.lost, numpy.zeros(extra, numpy.int32)])
+        self.ewma = numpy.concatenate([self.ewma, numpy.zeros(extra) + numpy.nan])
+        self.jitter = numpy.concatenate([self.jitter, numpy.zeros(extra)])
+        self.last = numpy.concatenate([self.last, numpy.zeros(extra) + numpy.nan])
+        self.updated = numpy.concatenate([self.updated, numpy.zeros(extra)])
+        self.capacity = capacity
+
+    def row(self, key):
+        # Row for key, allocated on first use
+        row = self.rows.get(key)
+        if row is None:
+            row = len(self.keys)
+            if row == self.capacity:
+                self.grow(self.capacity * 2)
+            self.rows[key] = row
+            self.keys.append(key)
+        return row
+
+    def add(self, key, rtt, ts=0.0):
+        # Records one sample; rtt is in milliseconds, or None if the ping was
+        # lost.  Returns the row.
+        row = self.row(key)
+        position = self.head[row]
+        if self.count[row] == self.window:
+            # Ring is full, the oldest sample falls out
+            if numpy.isnan(self.samples[row, position]):
+                self.lost[row] -= 1
+        else:
+            self.count[row] += 1
+        if rtt is None:
+            self.samples[row, position] = numpy.nan
+            self.lost[row] += 1
+        else:
+            self.samples[row, position] = rtt
+            last = self.last[row]
+            if numpy.isnan(last):
+                self.ewma[row] = rtt
+            else:
+                self.ewma[row] += self.alpha * (rtt - self.ewma[row])
+                # Interarrival jitter as in RFC 3550
+                self.jitter[row] += (abs(rtt - last) - self.jitter[row]) / 16.0
+            self.last[row] = rtt
+        self.head[row] = (position + 1) % self.window
+        self.updated[row] = ts
+        return row
+
+    def remove(self, key):
+        # Forgets key; its row is reused by the last key so rows stay dense
+        row = self.rows.pop(key)
+        last = len(self.keys) - 1
+        moved = self.keys.pop()
+        if row != last:
+            self.rows[moved] = row
+            self.keys[row] = moved
+            for column in (self.samples, self.head, self.count, self.lost, self.ewma, self.jitter, self.last, self.updated):
+                column[row] = column[last]
+        self.head[last] = self.count[last] = self.lost[last] = 0
+        self.ewma[last] = self.last[last] = numpy.nan
+        self.jitter[last] = self.updated[last] = 0.0
+
+    # Queries.  Given a key they return that row's value, otherwise an array
+    # with one value per row (in the order of self.keys).
+    def select(self, column, key):
+        if key is None:
+            return column[:len(self.keys)]
+        return column[self.rows[key]]
+
+    def loss(self, key=None):
+        # Percent of the samples in the window that were lost
+        count = self.select(self.count, key)
+        lost = self.select(self.lost, key)
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            return numpy.true_divide(lost, count) * 100.0
+
+    def latency(self, key=None):
+        # EWMA of answered round trip times
+        return self.select(self.ewma, key)
+
+    def variation(self, key=None):
+        # Smoothed jitter between consecutive answered samples
+        return self.select(self.jitter, key)
+
+    def percentiles(self, percentiles=(50, 95, 99), key=None):
+        # Round trip time percentiles over the window, ignoring lost pings.
+        # Returns one value per percentile, or a rows x percentiles array.
+        if key is None:
+            samples = self.samples[:len(self.keys)]
+            count = self.count[:len(self.keys)]
+        else:
+            row = self.rows[key]
+            samples = self.samples[row:row + 1]
+            count = self.count[row:row + 1]
+        # Slots not yet written in a partly filled ring hold garbage
+        filled = numpy.arange(self.window) < count[:, None]
+        samples = numpy.where(filled, samples, numpy.nan)
+        with warnings.catch_warnings():
+            # Rows with nothing answered come back NaN, that's expected
+            warnings.simplefilter('ignore', RuntimeWarning)
+            result = numpy.nanpercentile(samples, percentiles, axis=1).T
+        return result[0] if key is not None else result
+
+    def metrics(self, key):
+        # (latency, loss, samples) for one key, as the decision engine wants
+        row = self.rows[key]
+        count = int(self.count[row])
+        loss = self.lost[row] * 100.0 / count if count else 0.0
+        return float(self.ewma[row]), loss, count
+
+    def summary(self, key):
+        p50, p95, p99 = self.percentiles(key=key)
+        return {
+            'samples' : int(self.count[self.rows[key]]),
+            'latency' : float(self.latency(key)),
+            'jitter' : float(self.variation(key)),
+            'loss' : float(self.loss(key)),
+            'p50' : float(p50),
+            'p95' : float(p95),
+            'p99' : float(p99),
+        }
@@ -0,0 +1,250 @@
+from twisted.internet import reactor
+import traceback
+import metrics
+import logger
+
+__author__    = "Kyle Vogt <kyle@justin.tv>"
+__version__   = "0.1"
+__copyright__ = "Copyright (c) 2010, Kyle Vogt"
+__license__   = "MIT"
+
+# Hierarchical timing wheel
+#
+# Tens of thousands of probes each have a deadline that moves every time
+# they're pinged or answered.  As reactor delayed calls that's a heap push
+# (and a cancelled entry left behind) per move.  The wheel files timers by
+# deadline instead:
+#
+#    level 0: 256 slots of one tick each ('resolution' seconds)
+#    level 1: 256 slots of 256 ticks each
+#    level 2, 3: 256 slots of 65536 and 16777216 ticks each
+#
+# A timer goes in the lowest level whose span covers its deadline.  Every
+# time level 0 comes round, the next slot of level 1 is emptied back into
+# level 0, and so on up.  Adding, moving and cancelling a timer are O(1),
+# however many there are.
+#
+# The wheel runs off a single reactor delayed call, set for the next tick
+# that has anything to do, and none at all while it's empty.  Timers fire in
+# the first tick that starts at or after their time, so up to a tick late and
+# never early.  Timers due in the same tick fire in no particular order.
+#
+# The API follows the reactor's:
+#
+#     t = timer.callLater(5.0, f, *args)
+#     t.reset(10.0) ; t.active() ; t.cancel()
+#
+# and callAt() / resetAt() take an absolute time (reactor.seconds()).  Unlike
+# the reactor, cancelling a timer that has fired or was cancelled already is
+# a no-op.
+
+BITS = 8
+SLOTS = 1 << BITS
+MASK = SLOTS - 1
+LEVELS = 4
+HORIZON = 1 << (BITS * LEVELS)
+
+class Timer(object):
+    __slots__ = ('wheel', 'time', 'tick', 'func', 'args', 'kw', 'slot', 'level')
+
+    def __init__(self, wheel, time, func, args, kw):
+        self.wheel = wheel
+        self.time = time
+        self.tick = None
+        self.func = func
+        self.args = args
+        self.kw = kw
+        self.slot = None
+        self.level = None
+
+    def getTime(self):
+        return self.time
+
+    def active(self):
+        return self.slot is not None
+
+    def cancel(self):
+        if self.slot is not None:
+            self.wheel.remove(self)
+
+    def reset(self, seconds):
+        self.resetAt(self.wheel.clock.seconds() + seconds)
+
+    def resetAt(self, ts):
+        # Moves the timer, or sets it again if it fired or was cancelled
+        if self.slot is not None:
+            self.wheel.remove(self)
+        self.time = ts
+        self.wheel.add(self)
+
+class Wheel(object):
+
+    def __init__(self, resolution=0.01, clock=reactor):
+        self.resolution = resolution
+        self.clock = clock
+        self.levels = [[set() for i in xrange(SLOTS)] for level in xrange(LEVELS)]
+        # Timers per level, and the next tick to run
+        self.counts = [0] * LEVELS
+        self.current = int(clock.seconds() / resolution)
+        # The reactor delayed call and the tick it's set for
+        self.timer = None
+        self.wakeup = None
+        self.running = False
+        self.fired = 0
+        metrics.gauge('kyro_timer_pending', 'Timers waiting on the timing wheel').function = lambda: len(self)
+        metrics.counter('kyro_timer_fired_total', 'Timers fired by the timing wheel').function = lambda: self.fired
+
+    def __len__(self):
+        return sum(self.counts)
+
+    def callAt(self, ts, func, *args, **kw):
+        timer = Timer(self, ts, func, args, kw)
+        self.add(timer)
+        return timer
+
+    def callLater(self, seconds, func, *args, **kw):
+        return self.callAt(self.clock.seconds() + seconds, func, *args, **kw)
+
+    def setResolution(self, resolution):
+        # Files every timer again for the new tick length
+        timers = [timer for level in self.levels for slot in level for timer in slot]
+        for timer in timers:
+            self.remove(timer)
+        self.wake()
+        self.resolution = resolution
+        self.current = int(self.clock.seconds() / resolution)
+        for timer in timers:
+            self.add(timer)
+
+    # Filing
+    def add(self, timer):
+        # First tick starting at or after the timer's time
+        tick = -int(-timer.time // self.resolution)
+        timer.tick = tick
+        if self.running:
+            self.file(timer)
+            return
+        idle = self.wakeup is None
+        if idle:
+            # The wheel is empty and nothing's been running the ticks, catch
+            # up first
+            self.current = max(self.current, int(self.clock.seconds() / self.resolution))
+        self.file(timer)
+        if idle or tick < self.wakeup:
+            self.wake()
+
+    def file(self, timer):
+        tick = timer.tick
+        delta = tick - self.current
+        if delta < 0:
+            # Overdue, it goes out with the next tick
+            tick = self.current
+        elif delta >= HORIZON:
+            # Too far out for the wheel, park it at the edge and file it
+            # again when it gets there
+            tick = self.current + HORIZON - 1
+        delta = tick - self.current
+        level = 0
+        while delta >= SLOTS:
+            delta >>= BITS
+            level += 1
+        slot = self.levels[level][(tick >> (BITS * level)) & MASK]
+        slot.add(timer)
+        timer.slot = slot
+        timer.level = level
+        self.counts[level] += 1
+
+    def remove(self, timer):
+        timer.slot.discard(timer)
+        timer.slot = None
+        self.counts[timer.level] -= 1
+
+    # Running
+    def skip(self):
+        # The next tick that could have anything to do: the current one if
+        # level 0 has timers, or else the next time the lowest level that
+        # has any comes round.  None if the wheel is empty.
+        for level in xrange(LEVELS):
+            if self.counts[level]:
+                span = 1 << (BITS * level)
+                return -(-self.current // span) * span
+        return None
+
+    def wake(self):
+        # (Re)sets the delayed call for the next tick with anything to do
+        if self.timer is not None and self.timer.active():
+            self.timer.cancel()
+        self.timer = None
+        self.wakeup = None
+        tick = self.skip()
+        if tick is None:
+            return
+        if tick & MASK:
+            # Within level 0, find the next slot with timers in it
+            slots = self.levels[0]
+            while not slots[tick & MASK]:
+                tick += 1
+                if not tick & MASK:
+                    break
+        self.wakeup = tick
+        self.timer = self.clock.callLater(max(tick * self.resolution - self.clock.seconds(), 0), self.run)
+
+    def run(self):
+        self.timer = None
+        self.wakeup = None
+        self.running = True
+        try:
+            self.advance(int(self.clock.seconds() / self.resolution))
+        finally:
+            self.running = False
+        self.wake()
+
+    def advance(self, last):
+        # Runs every tick up to and including last
+        levels = self.levels
+        while self.current <= last:
+            tick = self.skip()
+            if tick is None or tick > last:
+                self.current = last + 1
+                break
+            self.current = tick
+            index = tick & MASK
+            if not index:
+                self.cascade(tick)
+            slot = levels[0][index]
+            self.current = tick + 1
+            if not slot:
+                continue
+            levels[0][index] = set()
+            for timer in list(slot):
+                # Skipping any cancelled or moved by an earlier callback
+                if timer.slot is slot:
+                    self.remove(timer)
+                    self.fire(timer)
+
+    def cascade(self, tick):
+        # Files the timers from the slots of the higher levels that come due
+        # in the next SLOTS ticks one level down
+        for level in xrange(1, LEVELS):
+            index = (tick >> (BITS * level)) & MASK
+            slot = self.levels[level][index]
+            if slot:
+                self.levels[level][index] = set()
+                self.counts[level] -= len(slot)
+                for timer in slot:
+                    self.file(timer)
+            if index:
+                break
+
+    def fire(self, timer):
+        self.fired += 1
+        try:
+            timer.func(*timer.args, **timer.kw)
+        except Exception:
+            logger.error('timer', 'Error in timer callback %r:\n%s', timer.func, traceback.format_exc())
+
+# The process wide wheel
+WHEEL = Wheel()
+callAt = WHEEL.callAt
+callLater = WHEEL.callLater
+setResolution = WHEEL.setResolution
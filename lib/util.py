@@ -1,11 +1,22 @@
 import struct
+import ast
+from itertools import izip
+
+MASKS = [(0xFFFFFFFF << (32 - i)) & 0xFFFFFFFF for i in range(33)]
 
 # Utility functions
 def ip(data): 
     if not isinstance(data, str): data = unlong(data)
     return '.'.join([str(ord(c)) for c in data])
 def unip(data): return ''.join(chr(int(s)) for s in data.split('.'))
-def prefix(data): return 'prefix'
+def prefix(network, length): return '%s/%s' % (ip(network), length)
+def unprefix(data):
+    address, length = data.split('/')
+    return long(unip(address)), int(length)
+def prefixes(data):
+    # Pairs up a flat array of network, length, network, length, ...
+    data = iter(data)
+    return izip(data, data)
     
 def short(data): return struct.unpack('!H', data)[0]
 def unshort(data): return struct.pack('!H', data)
@@ -35,3 +46,12 @@ def parseConfig(data):
             pass
         conf[key] = val
     return conf
+
+def parsePaths(data):
+    # Path config is a python list of dicts, see conf/sample.conf
+    paths = ast.literal_eval('\n'.join(line for line in data.split('\n') if not line.strip().startswith('#')))
+    for path in paths:
+        for key in ('name', 'asn', 'probe'):
+            if key not in path:
+                raise ValueError('path %r is missing %r' % (path, key))
+    return paths
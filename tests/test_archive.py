@@ -0,0 +1,95 @@
+import unittest
+import tempfile
+import shutil
+import random
+import os
+from kyro import archive
+
+HOSTS = ['10.0.%d.1' % i for i in xrange(20)]
+
+class ArchiveTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.name = os.path.join(self.directory, 'kyro')
+        self.written = []
+        self.ts = 1000.0
+        self.random = random.Random(1)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, writer, count):
+        for i in xrange(count):
+            self.ts += 0.01
+            host = self.random.choice(HOSTS)
+            rtt = self.random.choice([None, 5.0, 7.5])
+            writer.append(self.ts, host, rtt, i % 2)
+            self.written.append((self.ts, host, i % 2))
+
+    def assertSelects(self, reader, start=None, end=None, host=None, path=None):
+        expected = [(ts, h, p) for ts, h, p in self.written
+                    if (start is None or ts >= start) and (end is None or ts < end)
+                    and (host is None or h == host) and (path is None or p == path)]
+        got = [(ts, reader.hosts[host_id], p) for ts, host_id, p in zip(*[reader.select(start, end, host, path)[column] for column in ('ts', 'host', 'path')])]
+        self.assertEqual(got, expected)
+
+    def assertAllSelect(self, reader):
+        for host in HOSTS[:5]:
+            self.assertSelects(reader, host=host)
+            self.assertSelects(reader, 1005.0, 1015.0, host)
+            self.assertSelects(reader, 1010.0, None, host, 1)
+
+    def testSelect(self):
+        writer = archive.ArchiveWriter(self.name, flush_records=100)
+        self.write(writer, 1950)
+        writer.close()
+        reader = archive.Archive(self.name)
+        self.assertEqual(len(reader.blocks), 20)
+        self.assertAllSelect(reader)
+        self.assertSelects(reader, 1003.0, 1004.0)
+        self.assertEqual(len(reader.select(host='10.9.9.9')), 0)
+
+    def testRefreshPicksUpNewRecords(self):
+        writer = archive.ArchiveWriter(self.name, flush_records=100)
+        self.write(writer, 500)
+        writer.flush()
+        reader = archive.Archive(self.name)
+        self.write(writer, 550)
+        writer.flush()
+        reader.refresh()
+        self.assertEqual(len(reader.blocks), 11)
+        self.assertAllSelect(reader)
+
+    def testRecordsWithoutTheirIndexBlock(self):
+        writer = archive.ArchiveWriter(self.name, flush_records=100)
+        self.write(writer, 1000)
+        writer.close()
+        # Crashed part way through the last index block, with a record torn
+        index = open(self.name + '.idx', 'rb').read()
+        open(self.name + '.idx', 'wb').write(index[:-100])
+        open(self.name + '.dat', 'ab').write('torn')
+        reader = archive.Archive(self.name)
+        self.assertEqual((len(reader), reader.indexed), (1000, 900))
+        self.assertAllSelect(reader)
+        # The next writer indexes what was left out
+        writer = archive.ArchiveWriter(self.name, flush_records=100)
+        self.write(writer, 100)
+        writer.close()
+        reader = archive.Archive(self.name)
+        self.assertEqual((len(reader), reader.indexed), (1100, 1100))
+        self.assertAllSelect(reader)
+
+    def testArchiveWithoutAnIndex(self):
+        writer = archive.ArchiveWriter(self.name, flush_records=100)
+        self.write(writer, 300)
+        writer.close()
+        os.unlink(self.name + '.idx')
+        self.assertAllSelect(archive.Archive(self.name))
+        archive.ArchiveWriter(self.name).close()
+        reader = archive.Archive(self.name)
+        self.assertEqual((len(reader.blocks), reader.indexed), (1, 300))
+        self.assertAllSelect(reader)
+
+if __name__ == '__main__':
+    unittest.main()
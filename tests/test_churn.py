@@ -0,0 +1,83 @@
+import unittest
+from twisted.internet import task
+from kyro import churn, timer
+
+class Entry(object):
+    def __init__(self, key):
+        self.key = key
+
+A, B = Entry('a'), Entry('b')
+
+class Table(object):
+    def __init__(self):
+        self.routes = {}
+
+    def best(self, network, length):
+        return self.routes.get((network, length))
+
+class ChurnFilterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.reactor = churn.reactor
+        churn.reactor = self.clock
+        self.table = Table()
+        self.published = []
+        self.filter = churn.ChurnFilter(self.table, self.publish, window=1.0, wheel=timer.Wheel(clock=self.clock))
+
+    def tearDown(self):
+        churn.reactor = self.reactor
+
+    def publish(self, changes, damped):
+        self.published.append(([(network, length, best and best.key) for network, length, best in changes], damped))
+
+    def change(self, network, previous, best):
+        self.filter.routeChanged(network, 24, previous, best, now=self.clock.seconds())
+
+    def testCoalescing(self):
+        # A flap inside the window cancels out, the net change goes out once
+        self.change(1, A, B)
+        self.clock.advance(0.3)
+        self.change(1, B, A)
+        self.change(2, A, B)
+        self.clock.advance(0.3)
+        self.change(2, B, A)
+        self.change(2, A, B)
+        self.clock.advance(2.0)
+        self.assertEqual(self.published, [([(2, 24, 'b')], [])])
+
+    def testNewRoutesAreNotCharged(self):
+        self.change(3, None, A)
+        self.change(4, A, Entry('a'))
+        self.clock.advance(2.0)
+        self.assertEqual(self.filter.penalties, {})
+
+    def testDampening(self):
+        for i in xrange(2):
+            self.change(5, A, None)
+            self.clock.advance(5.0)
+            self.change(5, None, A)
+            self.clock.advance(5.0)
+        self.change(5, A, None)
+        self.clock.advance(0)
+        self.assertTrue(self.filter.isDamped(5, 24))
+        self.assertEqual(self.published[-1], ([], [(5, 24, True)]))
+        del self.published[:]
+        # Nothing goes out while it's damped
+        self.change(5, None, B)
+        self.clock.advance(2.0)
+        self.assertEqual(self.published, [])
+        # Released with its best path as of then, once the penalty decays
+        self.table.routes[(5, 24)] = B
+        while not self.published:
+            self.clock.advance(10.0)
+        self.assertEqual(self.published, [([(5, 24, 'b')], [(5, 24, False)])])
+        self.assertFalse(self.filter.isDamped(5, 24))
+        # And forgotten once it's decayed further
+        for i in xrange(400):
+            self.clock.advance(10.0)
+        self.assertEqual(self.filter.penalties, {})
+        self.assertEqual(len(self.filter.wheel), 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+import unittest
+from twisted.internet import task
+from twisted.test import proto_helpers
+from kyro import control, logger
+
+class Recorder(control.Protocol):
+
+    def __init__(self):
+        control.Protocol.__init__(self)
+        self.received = []
+
+    def routesReceived(self, routes):
+        self.received.append(('routes', routes))
+
+    def dampReceived(self, prefixes):
+        self.received.append(('damp', prefixes))
+
+    def injectReceived(self, routes):
+        self.received.append(('inject', routes))
+
+    def withdrawReceived(self, prefixes):
+        self.received.append(('withdraw', prefixes))
+
+class ControlTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.reactor = control.reactor
+        control.reactor = self.clock
+        self.sender = Recorder()
+        self.transport = proto_helpers.StringTransport()
+        self.sender.makeConnection(self.transport)
+        self.receiver = Recorder()
+        self.receiver.makeConnection(proto_helpers.StringTransport())
+
+    def tearDown(self):
+        control.reactor = self.reactor
+
+    def deliver(self, chunk=None):
+        self.clock.advance(0)
+        data = self.transport.value()
+        self.transport.clear()
+        chunk = chunk or len(data) or 1
+        for offset in xrange(0, len(data), chunk):
+            self.receiver.dataReceived(data[offset:offset + chunk])
+
+    def testLatestChangeWins(self):
+        self.sender.queueRoute(1 << 24, 8, [174, 3356])
+        self.sender.queueRoute(1 << 24, 8, None)
+        self.sender.queueRoute(2 << 24, 8, [1299])
+        self.sender.queueDampen(2 << 24, 8, True)
+        self.assertEqual(self.transport.value(), '')
+        self.deliver()
+        (routes, batch), damp = self.receiver.received
+        self.assertEqual(routes, 'routes')
+        self.assertEqual(sorted(batch), [((1 << 24, 8), None), ((2 << 24, 8), [1299])])
+        self.assertEqual(damp, ('damp', [((2 << 24, 8), True)]))
+
+    def testWithdrawalsGoFirst(self):
+        self.sender.queueInject(1 << 24, 8, 0x0A000001)
+        self.sender.queueWithdraw(2 << 24, 8)
+        self.deliver()
+        self.assertEqual(self.receiver.received, [
+            ('withdraw', [(2 << 24, 8)]),
+            ('inject', [((1 << 24, 8), 0x0A000001)]),
+        ])
+
+    def testLargeBatchesSplitAcrossFrames(self):
+        for i in xrange(20000):
+            self.sender.queueRoute(i << 8, 24, [174, 3356, 1299])
+        self.deliver(chunk=1000)
+        routes = sorted(route for kind, batch in self.receiver.received for route in batch)
+        self.assertTrue(len(self.receiver.received) > 1)
+        self.assertEqual(routes, [((i << 8, 24), [174, 3356, 1299]) for i in xrange(20000)])
+
+    def testNothingSentOnceDisconnected(self):
+        self.sender.queueRoute(1 << 24, 8, [174])
+        self.sender.connectionLost(None)
+        self.clock.advance(0)
+        self.assertEqual(self.transport.value(), '')
+
+    def testBadFrameLength(self):
+        logger.configure('control', level=logger.ERROR + 1)
+        try:
+            self.receiver.dataReceived(control.HEADER.pack(control.MAX_FRAME_LENGTH + 1, control.ROUTES))
+        finally:
+            logger.configure('control', level=logger.INFO)
+        self.assertTrue(self.receiver.transport.disconnecting)
+
+if __name__ == '__main__':
+    unittest.main()
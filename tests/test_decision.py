@@ -0,0 +1,42 @@
+import unittest
+from kyro import decision
+
+class DecisionEngineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = decision.DecisionEngine(margin=0.1, min_improvement=5.0, loss_penalty=10.0, hold_down=300.0, min_samples=5)
+        self.engine.setDefault('10.0.0.0/24', 0)
+
+    def testSwitchesToAClearlyBetterPath(self):
+        self.assertEqual(self.engine.update('10.0.0.0/24', [(100.0, 0.0, 10), (50.0, 0.0, 10)], 0.0), (0, 1))
+        self.assertEqual(self.engine.decisions['10.0.0.0/24'].path, 1)
+
+    def testMarginAndMinimumImprovement(self):
+        # 3ms better is under min_improvement, 8ms is under 10% of 100
+        self.assertEqual(self.engine.update('10.0.0.0/24', [(20.0, 0.0, 10), (17.0, 0.0, 10)], 0.0), None)
+        self.assertEqual(self.engine.update('10.0.0.0/24', [(100.0, 0.0, 10), (92.0, 0.0, 10)], 0.0), None)
+
+    def testLossCounts(self):
+        self.assertEqual(self.engine.update('10.0.0.0/24', [(50.0, 10.0, 10), (60.0, 0.0, 10)], 0.0), (0, 1))
+
+    def testNeedsEnoughSamples(self):
+        self.assertEqual(self.engine.update('10.0.0.0/24', [(100.0, 0.0, 10), (10.0, 0.0, 4)], 0.0), None)
+
+    def testHoldDown(self):
+        self.engine.update('10.0.0.0/24', [(100.0, 0.0, 10), (50.0, 0.0, 10)], 0.0)
+        self.assertEqual(self.engine.update('10.0.0.0/24', [(10.0, 0.0, 10), (50.0, 0.0, 10)], 100.0), None)
+        self.assertEqual(self.engine.update('10.0.0.0/24', [(10.0, 0.0, 10), (50.0, 0.0, 10)], 301.0), (1, 0))
+
+    def testUnknownDefaultNeedsAClearWinner(self):
+        self.assertEqual(self.engine.update('10.0.1.0/24', [(50.0, 0.0, 10)], 0.0), None)
+        self.assertEqual(self.engine.update('10.0.1.0/24', [(100.0, 0.0, 10), (50.0, 0.0, 10)], 0.0), (None, 1))
+
+    def testCloseness(self):
+        self.engine.update('10.0.0.0/24', [(100.0, 0.0, 10), (95.0, 0.0, 10)], 0.0)
+        near = self.engine.closeness('10.0.0.0/24')
+        self.engine.update('10.0.0.0/24', [(100.0, 0.0, 10), (200.0, 0.0, 10)], 0.0)
+        self.assertTrue(0.0 < self.engine.closeness('10.0.0.0/24') < near <= 1.0)
+        self.assertEqual(self.engine.closeness('10.9.9.0/24'), 0.0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+import unittest
+import socket
+import struct
+from twisted.internet import task
+from kyro import probe, timer
+
+HOPS = 6
+
+class Socket(object):
+    # Stands in for the raw socket, remembering what was sent and at what TTL
+    def __init__(self, *args):
+        self.sent = []
+        self.ttl = 64
+
+    def setblocking(self, flag):
+        pass
+
+    def setsockopt(self, level, option, value):
+        if option == socket.IP_TTL:
+            self.ttl = value
+
+    def sendto(self, packet, address):
+        self.sent.append((str(packet), address[0], self.ttl))
+
+class ProberTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.clock.advance(1000.0)
+        self.clock.addReader = self.clock.removeReader = lambda reader: None
+        self.patched = probe.reactor, probe.time.time, probe.socket.socket
+        probe.reactor = self.clock
+        probe.time.time = self.clock.seconds
+        probe.socket.socket = Socket
+        # Last hop of each /16 of targets
+        self.last = {0: '172.16.0.5', 1: '172.16.1.5', 2: '172.16.2.5'}
+
+    def tearDown(self):
+        probe.reactor, probe.time.time, probe.socket.socket = self.patched
+
+    def prober(self, **kwargs):
+        prober = probe.Prober(wheel=timer.Wheel(clock=self.clock), **kwargs)
+        for i in xrange(10):
+            prober.add('10.%d.%d.1' % (i % 2, i)).interval = 1.0
+        prober.start()
+        return prober
+
+    def answer(self, prober, seconds):
+        # Answers everything sent, targets are HOPS away
+        for i in xrange(int(seconds * 20)):
+            self.clock.advance(0.05)
+            sent, prober.sock.sent = prober.sock.sent, []
+            for packet, host, ttl in sent:
+                if ttl < HOPS:
+                    hop = self.last[int(host.split('.')[1])] if ttl == HOPS - 1 else '172.16.9.%d' % ttl
+                    prober.packetReceived('\x45' + '\0' * 19 + '\x0b\x00\0\0' + '\0' * 24 + packet[:8], hop)
+                else:
+                    prober.packetReceived('\x45' + '\0' * 19 + '\0\0' + packet[2:], host)
+
+    def groups(self, prober):
+        return sorted((key[1], len(group)) for key, group in prober.groups.items())
+
+    def testParkedMembersAreOnlyChecked(self):
+        prober = self.prober(aggregate=True, refresh=10.0, mapping_ttl=10)
+        self.answer(prober, 5.0)
+        self.assertEqual(self.groups(prober), [('172.16.0.5', 5), ('172.16.1.5', 5)])
+        bursts = probe.MAPPINGS.value
+        self.answer(prober, 10.0)
+        # Only the two pinging probes mapped again, each member was checked
+        # with a single ping at the last hop's TTL
+        self.assertEqual(probe.MAPPINGS.value - bursts, 2)
+        for member in prober.probes.itervalues():
+            if member.parked:
+                self.assertEqual(member.hop_ttl, HOPS - 1)
+                self.assertTrue(member.mapped_ts > 1005.0)
+
+    def testPathsMovingAreNoticed(self):
+        prober = self.prober(aggregate=True, refresh=10.0, mapping_ttl=10)
+        self.answer(prober, 5.0)
+        self.last[0] = '172.17.0.5'
+        self.answer(prober, 12.0)
+        # The pinging probe and the members all moved
+        self.assertEqual(self.groups(prober), [('172.16.1.5', 5), ('172.17.0.5', 5)])
+
+    def testRefreshingIsBudgeted(self):
+        prober = self.prober(aggregate=True, refresh=10.0, mapping_ttl=10, pps=10)
+        self.answer(prober, 30.0)
+        prober.rebalance()
+        # Refreshing takes a 10 ping burst per group and a check per parked
+        # member every 10s, 2.8 pps of the 8 pps share
+        self.assertEqual(prober.scale, 1.0)
+        for member in prober.probes.itervalues():
+            member.interval = 0.25
+        prober.rebalance()
+        self.assertAlmostEqual(prober.scale, 8.0 / 5.2)
+
+    def testMappingLeavesPingsTheirShare(self):
+        prober = self.prober(pps=40, mapping_ttl=10)
+        self.answer(prober, 10.0)
+        samples = []
+        prober.replyReceived = lambda member, ms: samples.append(member.key)
+        # Ten times the budget's worth of new probes, all mapping at once
+        for i in xrange(400):
+            prober.add('10.2.%d.%d' % (i >> 8, i & 255))
+        self.answer(prober, 10.0)
+        old = [key for key in samples if key[0].startswith('10.0.') or key[0].startswith('10.1.')]
+        # The ten probes already mapped keep pinging once a second
+        self.assertTrue(len(old) >= 90, len(old))
+        self.assertTrue(prober.sent <= 40 * 21)
+
+if __name__ == '__main__':
+    unittest.main()
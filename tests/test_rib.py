@@ -0,0 +1,88 @@
+import unittest
+from kyro import rib
+
+NETWORK = 0x0A000000
+
+class AdjRibInTest(unittest.TestCase):
+
+    def testReannounceSameAttributes(self):
+        # The old path may hold the only other reference to the set
+        table = rib.AdjRibIn()
+        entry = table.intern('a', {})
+        table.announce(1, NETWORK, 24, entry)
+        previous, best = table.announce(1, NETWORK, 24, table.intern('a', {}))
+        self.assertTrue(previous is entry and best is entry)
+        self.assertEqual(len(table.attributes), 1)
+        self.assertEqual(entry.refs, 1)
+        self.assertEqual(table.count(1), 1)
+        self.assertEqual(table.path_count, 1)
+
+    def testWithdraw(self):
+        table = rib.AdjRibIn()
+        entry = table.intern('a', {})
+        table.announce(1, NETWORK, 24, entry)
+        self.assertEqual(table.withdraw(1, NETWORK, 24), (entry, None))
+        self.assertEqual(table.withdraw(1, NETWORK, 24), None)
+        self.assertEqual(len(table.attributes), 0)
+        self.assertEqual(table.path_count, 0)
+        self.assertEqual(len(table), 0)
+
+    def testBestPath(self):
+        table = rib.AdjRibIn()
+        worse = table.intern('worse', {'LOCAL_PREF' : 50})
+        better = table.intern('better', {'LOCAL_PREF' : 200})
+        table.announce(1, NETWORK, 24, worse)
+        self.assertEqual(table.announce(2, NETWORK, 24, better), (worse, better))
+        self.assertEqual(table.paths(NETWORK, 24), [(2, better), (1, worse)])
+        self.assertEqual(table.withdraw(2, NETWORK, 24), (better, worse))
+
+    def testWithdrawSource(self):
+        table = rib.AdjRibIn()
+        first = table.intern('first', {'LOCAL_PREF' : 200})
+        second = table.intern('second', {})
+        for i in xrange(10):
+            table.announce(1, NETWORK + (i << 8), 24, first)
+        table.announce(2, NETWORK, 24, second)
+        table.announce(2, NETWORK + (20 << 8), 24, second)
+        changes = table.withdrawSource(1)
+        self.assertEqual(changes[0], (NETWORK, 24, first, second))
+        self.assertEqual(sorted(changes[1:]), [(NETWORK + (i << 8), 24, first, None) for i in xrange(1, 10)])
+        self.assertEqual(table.count(1), 0)
+        self.assertEqual(table.count(2), 2)
+        self.assertEqual(table.path_count, 2)
+        self.assertEqual(len(table), 2)
+        self.assertEqual(first.refs, 0)
+        self.assertEqual(table.withdrawSource(1), [])
+
+    def testRestore(self):
+        table = rib.AdjRibIn()
+        entry = table.intern('b', {})
+        table.restore([(NETWORK, 24, 1, entry), (NETWORK + 256, 24, 1, entry)])
+        self.assertEqual(table.staleCount(1), 2)
+        self.assertEqual(table.count(1), 2)
+        previous, best = table.announce(1, NETWORK, 24, table.intern('b', {}))
+        self.assertTrue(previous is entry and best is entry)
+        self.assertEqual(len(table.attributes), 1)
+        self.assertEqual(table.staleCount(), 1)
+        # Whatever wasn't sent again goes
+        self.assertEqual(table.sweep(1), [(NETWORK + 256, 24, entry, None)])
+        self.assertEqual(table.withdraw(1, NETWORK, 24), (entry, None))
+        self.assertEqual(len(table.attributes), 0)
+        self.assertEqual(table.path_count, 0)
+
+    def testWithdrawRestoredSource(self):
+        table = rib.AdjRibIn()
+        entry = table.intern('b', {})
+        table.restore([(NETWORK, 24, 1, entry), (NETWORK + 256, 24, 1, entry)])
+        self.assertEqual(len(table.withdrawSource(1)), 2)
+        self.assertEqual(table.staleCount(), 0)
+        self.assertEqual(table.path_count, 0)
+        self.assertEqual(len(table), 0)
+
+    def testRestoreIntoFullTable(self):
+        table = rib.AdjRibIn()
+        table.announce(1, NETWORK, 24, table.intern('a', {}))
+        self.assertRaises(ValueError, table.restore, [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+import unittest
+import tempfile
+import shutil
+import os
+from kyro import rib, bgp, snapshot
+
+def attributes(*asns):
+    return bgp.encodePathAttributes([
+        {'flags' : 0x40, 'type_code' : 'ORIGIN', 'value' : 'IGP'},
+        {'flags' : 0x40, 'type_code' : 'AS_PATH', 'value' : [('AS_SEQUENCE', len(asns), list(asns))]},
+        {'flags' : 0x40, 'type_code' : 'NEXT_HOP', 'value' : '10.0.0.1'},
+    ])
+
+class SnapshotTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.name = os.path.join(self.directory, 'kyro.rib')
+        self.table = rib.AdjRibIn()
+        sets = [attributes(174), attributes(3356, 174), attributes(1299)]
+        for i in xrange(1000):
+            for source in (1, 2):
+                raw = sets[(i + source) % len(sets)]
+                self.table.announce(source, (10 << 24) + (i << 8), 24, self.table.intern(raw, bgp.PathAttributes(raw)))
+        self.table.announce(1, 0, 0, self.table.intern(sets[0], bgp.PathAttributes(sets[0])))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def save(self, capture):
+        snapshot.write(self.name, capture.columns, capture.sets, 1234.0)
+
+    def testRoundTrip(self):
+        self.save(snapshot.Capture(self.table).run())
+        restored = rib.AdjRibIn()
+        self.assertEqual(snapshot.load(self.name, restored), 1234.0)
+        self.assertEqual(len(restored), len(self.table))
+        self.assertEqual(restored.path_count, self.table.path_count)
+        self.assertEqual(len(restored.attributes), len(self.table.attributes))
+        for (network, length, best), (network2, length2, best2) in zip(self.table, restored):
+            self.assertEqual((network, length, best.key), (network2, length2, best2.key))
+            self.assertEqual([(source, entry.key) for source, entry in self.table.paths(network, length)],
+                             [(source, entry.key) for source, entry in restored.paths(network, length)])
+        self.assertEqual(restored.staleCount(1), 1001)
+        self.assertEqual(restored.count(2), 1000)
+
+    def testCaptureInSlices(self):
+        # Changes made between slices land in the slices copied after them
+        capture = snapshot.Capture(self.table)
+        steps = iter(capture)
+        for top in xrange(10):
+            steps.next()
+        self.table.withdraw(2, (10 << 24), 24)
+        self.table.withdraw(1, 0, 0)
+        for top in steps:
+            pass
+        self.save(capture)
+        restored = rib.AdjRibIn()
+        snapshot.load(self.name, restored)
+        self.assertEqual(restored.count(2), 999)
+        self.assertEqual(restored.count(1), 1001)
+
+    def testCorruptSnapshot(self):
+        self.save(snapshot.Capture(self.table).run())
+        data = bytearray(open(self.name, 'rb').read())
+        data[100] ^= 0xFF
+        open(self.name, 'wb').write(data)
+        self.assertRaises(ValueError, snapshot.load, self.name, rib.AdjRibIn())
+        open(self.name, 'wb').write('junk')
+        self.assertRaises(ValueError, snapshot.load, self.name, rib.AdjRibIn())
+
+if __name__ == '__main__':
+    unittest.main()
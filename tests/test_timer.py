@@ -0,0 +1,88 @@
+import unittest
+from twisted.internet import task
+from kyro import timer, logger
+
+class WheelTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.clock.advance(1000.0)
+        self.wheel = timer.Wheel(resolution=0.01, clock=self.clock)
+        self.fired = []
+
+    def fire(self, name):
+        self.fired.append((name, self.clock.seconds()))
+
+    def advance(self, seconds, step=0.01):
+        for i in xrange(int(round(seconds / step))):
+            self.clock.advance(step)
+
+    def testFiresInOrderAndNeverEarly(self):
+        self.wheel.callLater(0.5, self.fire, 'b')
+        self.wheel.callLater(0.05, self.fire, 'a')
+        self.wheel.callLater(3.0, self.fire, 'c')
+        self.advance(4.0)
+        self.assertEqual([name for name, ts in self.fired], ['a', 'b', 'c'])
+        for (name, ts), due in zip(self.fired, (1000.05, 1000.5, 1003.0)):
+            self.assertTrue(due - 1e-6 <= ts <= due + 0.02, (name, ts))
+        self.assertEqual(len(self.wheel), 0)
+
+    def testCancelAndReset(self):
+        cancelled = self.wheel.callLater(1.0, self.fire, 'cancelled')
+        moved = self.wheel.callLater(1.0, self.fire, 'moved')
+        cancelled.cancel()
+        cancelled.cancel()
+        moved.reset(2.0)
+        self.assertFalse(cancelled.active())
+        self.advance(1.5)
+        self.assertEqual(self.fired, [])
+        self.advance(1.0)
+        self.assertEqual([name for name, ts in self.fired], ['moved'])
+        self.assertFalse(moved.active())
+        # A fired timer can be set again
+        moved.reset(1.0)
+        self.advance(1.5)
+        self.assertEqual(len(self.fired), 2)
+
+    def testFarTimersCascade(self):
+        # Past level 0 and level 1
+        self.wheel.callLater(700.0, self.fire, 'far')
+        self.clock.advance(699.0)
+        self.assertEqual(self.fired, [])
+        self.advance(1.5)
+        self.assertEqual([name for name, ts in self.fired], ['far'])
+        self.assertTrue(1700.0 <= self.fired[0][1] <= 1700.02)
+
+    def testIdleWheelHasNoDelayedCall(self):
+        t = self.wheel.callLater(1.0, self.fire, 'x')
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+        t.cancel()
+        self.advance(2.0)
+        self.assertEqual(len(self.clock.getDelayedCalls()), 0)
+        # Timers set after a long idle spell still fire on time
+        self.clock.advance(5000.0)
+        self.wheel.callLater(0.1, self.fire, 'late')
+        self.advance(0.2)
+        self.assertEqual([name for name, ts in self.fired], ['late'])
+
+    def testCallbackErrorsDontStopTheWheel(self):
+        def broken():
+            raise RuntimeError('broken')
+        self.wheel.callLater(0.1, broken)
+        self.wheel.callLater(0.1, self.fire, 'ok')
+        # The error is logged, keep it out of the test output
+        logger.configure('timer', level=logger.ERROR + 1)
+        try:
+            self.advance(0.2)
+        finally:
+            logger.configure('timer', level=logger.INFO)
+        self.assertEqual([name for name, ts in self.fired], ['ok'])
+
+    def testSetResolution(self):
+        self.wheel.callLater(1.0, self.fire, 'x')
+        self.wheel.setResolution(0.1)
+        self.advance(1.2)
+        self.assertEqual([name for name, ts in self.fired], ['x'])
+
+if __name__ == '__main__':
+    unittest.main()
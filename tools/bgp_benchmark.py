@@ -0,0 +1,337 @@
+#!/usr/bin/env python
+# Replays a BGP table through bgp.Protocol offline and reports how fast it
+# parses.
+#
+# Routes come from an MRT dump (TABLE_DUMP_V2 RIB_IPV4_UNICAST or BGP4MP
+# messages, optionally .gz/.bz2 compressed) or from a synthetic table.  They
+# are packed into UPDATEs the way a router would send them, then fed to
+# Protocol.dataReceived in fixed size chunks.
+#
+#   python bgp_benchmark.py --synthetic 800000
+#   python bgp_benchmark.py --mrt rib.20100601.0000.bz2 --rib --save-baseline base.json
+#   python bgp_benchmark.py --mrt rib.20100601.0000.bz2 --rib --baseline base.json
+from twisted.python import usage
+from kyro import bgp, rib
+from kyro.util import *
+import sys, time, random, struct, resource, json, gzip, bz2
+
+AS_TRANS = 23456
+
+# MRT input (RFC 6396)
+def openDump(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    if path.endswith('.bz2'):
+        return bz2.BZ2File(path, 'rb')
+    return open(path, 'rb')
+
+def readRecords(path):
+    # Yields (type, subtype, body) for each MRT record
+    f = openDump(path)
+    while True:
+        head = f.read(12)
+        if len(head) < 12:
+            break
+        timestamp, kind, subtype, length = struct.unpack('!IHHI', head)
+        body = f.read(length)
+        if len(body) < length:
+            break
+        if kind == 17:
+            # BGP4MP_ET has 4 more bytes of microseconds up front
+            body = body[4:]
+            kind = 16
+        yield kind, subtype, body
+
+def narrowPathAttributes(data):
+    # MRT stores AS_PATH and AGGREGATOR with 4 byte ASNs; bgp.Protocol speaks
+    # 2 byte ASNs, so squeeze them down (AS_TRANS for anything that won't fit)
+    out = ''
+    offset = 0
+    while offset < len(data):
+        flags, type_code = ord(data[offset]), ord(data[offset + 1])
+        if flags & bgp.EXTENDED_LENGTH:
+            length = short(data[offset + 2:offset + 4])
+            offset += 4
+        else:
+            length = ord(data[offset + 2])
+            offset += 3
+        value = data[offset:offset + length]
+        offset += length
+        if type_code == 2:
+            narrow = ''
+            a_offset = 0
+            while a_offset < len(value):
+                segment_type, count = ord(value[a_offset]), ord(value[a_offset + 1])
+                a_offset += 2
+                asns = struct.unpack('!%sI' % count, value[a_offset:a_offset + count * 4])
+                a_offset += count * 4
+                narrow += chr(segment_type) + chr(count)
+                narrow += ''.join(unshort(asn if asn <= 0xFFFF else AS_TRANS) for asn in asns)
+            value = narrow
+        elif type_code == 7 and length == 8:
+            asn = long(value[:4])
+            value = unshort(asn if asn <= 0xFFFF else AS_TRANS) + value[4:]
+        elif type_code in (14, 15):
+            # Multiprotocol NLRI isn't IPv4 unicast, leave it out
+            continue
+        if len(value) > 255:
+            flags |= bgp.EXTENDED_LENGTH
+            out += chr(flags) + chr(type_code) + unshort(len(value)) + value
+        else:
+            flags &= ~bgp.EXTENDED_LENGTH
+            out += chr(flags) + chr(type_code) + chr(len(value)) + value
+    return out
+
+def readTableDump(path, peer=None):
+    # Yields UPDATE messages rebuilt from one peer's routes in a
+    # TABLE_DUMP_V2 RIB, packed like a table transfer, or passes one peer's
+    # BGP4MP UPDATEs through.  'peer' is a peer index or AS respectively,
+    # without it that's the first peer seen.
+    routes = []
+    peer_index = peer_as = peer
+    for kind, subtype, body in readRecords(path):
+        if kind == 13 and subtype == 2:
+            # RIB_IPV4_UNICAST
+            length = ord(body[4])
+            size = (length + 7) >> 3
+            network = long(body[5:5 + size] + chr(0) * (4 - size))
+            offset = 5 + size
+            count = short(body[offset:offset + 2])
+            offset += 2
+            for i in xrange(count):
+                index, originated, attr_length = struct.unpack('!HIH', body[offset:offset + 8])
+                offset += 8
+                attributes = body[offset:offset + attr_length]
+                offset += attr_length
+                if peer_index is None:
+                    peer_index = index
+                if index == peer_index:
+                    routes.append(((network, length), narrowPathAttributes(attributes)))
+            if len(routes) >= 10000:
+                for message in bgp.updateMessages(routes):
+                    yield message
+                routes = []
+        elif kind == 16 and subtype in (1, 4):
+            # BGP4MP_MESSAGE and BGP4MP_MESSAGE_AS4
+            asn_size = 4 if subtype == 4 else 2
+            asn = struct.unpack('!I' if asn_size == 4 else '!H', body[:asn_size])[0]
+            offset = asn_size * 2 + 2
+            afi = short(body[offset:offset + 2])
+            offset += 2 + (8 if afi == 1 else 32)
+            message = body[offset:]
+            if afi != 1 or len(message) < 19 or ord(message[18]) != 2:
+                continue
+            if peer_as is None:
+                peer_as = asn
+            if asn != peer_as:
+                continue
+            if subtype == 4:
+                data = message[19:]
+                withdrawn = short(data[:2])
+                attr_length = short(data[2 + withdrawn:4 + withdrawn])
+                attributes = narrowPathAttributes(data[4 + withdrawn:4 + withdrawn + attr_length])
+                data = data[:2 + withdrawn] + unshort(len(attributes)) + attributes + data[4 + withdrawn + attr_length:]
+                message = bgp.header(2, data)
+            yield message
+    if routes:
+        for message in bgp.updateMessages(routes):
+            yield message
+
+# Synthetic input
+def syntheticTable(count, paths, seed=0):
+    # Yields UPDATEs for 'count' distinct prefixes spread over 'paths' distinct
+    # attribute sets, roughly shaped like a full table (mostly /24s)
+    rand = random.Random(seed)
+    attribute_sets = []
+    for i in xrange(paths):
+        as_path = [rand.randint(1, 64511) for j in xrange(rand.randint(1, 8))]
+        attribute_sets.append(bgp.encodePathAttributes([
+            {'flags' : 0x40, 'type_code' : 'ORIGIN', 'value' : 'IGP'},
+            {'flags' : 0x40, 'type_code' : 'AS_PATH', 'value' : [('AS_SEQUENCE', len(as_path), as_path)]},
+            {'flags' : 0x40, 'type_code' : 'NEXT_HOP', 'value' : '192.0.2.1'},
+            {'flags' : 0x80, 'type_code' : 'MULTI_EXIT_DISC', 'value' : rand.randint(0, 1000)},
+            {'flags' : 0xc0, 'type_code' : 'COMMUNITIES', 'value' : ['%s:%s' % (as_path[0], rand.randint(0, 65535))]},
+        ]))
+    lengths = [24] * 12 + [23, 22, 21, 20, 19, 18, 17, 16]
+    seen = set()
+    routes = []
+    while len(seen) < count:
+        length = rand.choice(lengths)
+        network = rand.randint(0x01000000, 0xDFFFFFFF) & MASKS[length]
+        if (network, length) in seen:
+            continue
+        seen.add((network, length))
+        # Neighbouring prefixes tend to share paths, like a real table
+        routes.append(((network, length), attribute_sets[(network >> 16) % paths]))
+        if len(routes) >= 10000:
+            for message in bgp.updateMessages(routes):
+                yield message
+            routes = []
+    if routes:
+        for message in bgp.updateMessages(routes):
+            yield message
+
+# Measurement
+class Sink(bgp.Protocol):
+    # Counts what the parser hands up and, optionally, loads the routes into a
+    # RIB the way router.py does
+
+    def __init__(self, config):
+        bgp.Protocol.__init__(self, config)
+        self.ip = 'benchmark'
+        self.messages = 0
+        self.prefixes = 0
+        self.decode = config.get('decode-attributes')
+        self.rib = rib.RadixTree() if config.get('rib') else None
+        self.attributes = rib.AttributeTable()
+
+    def messageReceived(self, message):
+        self.messages += 1
+        if message['type'] != 'UPDATE':
+            return
+        nlri = message['network_layer_reachability_information']
+        self.prefixes += len(nlri) / 2
+        if self.decode:
+            list(message['path_attributes'])
+        if self.rib is not None:
+            self.updateRib(message)
+
+    def updateRib(self, message):
+        for network, length in prefixes(message['withdrawn_routes']):
+            previous = self.rib.remove(network, length)
+            if previous is not None:
+                self.attributes.release(previous)
+        if message['network_layer_reachability_information']:
+            path_attributes = message['path_attributes']
+            attributes = self.attributes.intern(path_attributes.raw, path_attributes)
+            for network, length in prefixes(message['network_layer_reachability_information']):
+                previous = self.rib.insert(network, length, self.attributes.retain(attributes))
+                if previous is not None:
+                    self.attributes.release(previous)
+
+class StageSink(Sink):
+    # Same, with a stopwatch around each stage.  The timing calls cost enough
+    # to skew throughput, so this runs as a separate pass.
+
+    def __init__(self, config):
+        Sink.__init__(self, config)
+        self.stages = {'attributes' : 0.0, 'nlri' : 0.0, 'rib' : 0.0}
+
+    def parsePrefixes(self, data):
+        start = time.time()
+        result = Sink.parsePrefixes(self, data)
+        self.stages['nlri'] += time.time() - start
+        return result
+
+    def parsePathAttributes(self, data):
+        start = time.time()
+        result = Sink.parsePathAttributes(self, data)
+        self.stages['attributes'] += time.time() - start
+        return result
+
+    def messageReceived(self, message):
+        start = time.time()
+        if self.decode and message['type'] == 'UPDATE':
+            list(message['path_attributes'])
+        self.stages['attributes'] += time.time() - start
+        start = time.time()
+        self.messages += 1
+        if message['type'] != 'UPDATE':
+            return
+        self.prefixes += len(message['network_layer_reachability_information']) / 2
+        if self.rib is not None:
+            self.updateRib(message)
+        self.stages['rib'] += time.time() - start
+
+def feed(sink, stream, chunk):
+    start = time.time()
+    for offset in xrange(0, len(stream), chunk):
+        sink.dataReceived(stream[offset:offset + chunk])
+    return time.time() - start
+
+def run(config, stream):
+    chunk = int(config['chunk'])
+    sink = Sink(config)
+    elapsed = feed(sink, stream, chunk)
+    results = {
+        'bytes' : len(stream),
+        'messages' : sink.messages,
+        'prefixes' : sink.prefixes,
+        'seconds' : elapsed,
+        'messages_per_second' : sink.messages / elapsed,
+        'prefixes_per_second' : sink.prefixes / elapsed,
+        'peak_rss_kb' : resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+    del sink
+    if config.get('stages'):
+        sink = StageSink(config)
+        elapsed = feed(sink, stream, chunk)
+        stages = dict(sink.stages)
+        stages['framing'] = max(elapsed - sum(stages.values()), 0.0)
+        results['stages'] = stages
+    return results
+
+def report(results, baseline=None):
+    rows = [
+        ('messages', 'messages', '%d'),
+        ('prefixes', 'prefixes', '%d'),
+        ('seconds', 'seconds', '%.3f'),
+        ('messages/s', 'messages_per_second', '%.0f'),
+        ('prefixes/s', 'prefixes_per_second', '%.0f'),
+        ('peak rss (KB)', 'peak_rss_kb', '%d'),
+    ]
+    for label, key, fmt in rows:
+        line = '%-16s %14s' % (label, fmt % results[key])
+        if baseline and key in baseline and baseline[key]:
+            line += '   %+.1f%% vs baseline' % ((float(results[key]) / baseline[key] - 1.0) * 100.0)
+        print line
+    if 'stages' in results:
+        total = sum(results['stages'].values()) or 1.0
+        print 'stages:'
+        for stage in ('framing', 'attributes', 'nlri', 'rib'):
+            seconds = results['stages'][stage]
+            line = '  %-14s %14.3f s  %5.1f%%' % (stage, seconds, seconds / total * 100.0)
+            if baseline and baseline.get('stages', {}).get(stage):
+                line += '   %+.1f%% vs baseline' % ((seconds / baseline['stages'][stage] - 1.0) * 100.0)
+            print line
+
+if __name__ == '__main__':
+
+    class Options(usage.Options):
+        optFlags = [
+            ['rib', 'r', 'Load routes into a RIB like router.py does'],
+            ['decode-attributes', 'd', 'Decode every path attribute'],
+            ['stages', 't', 'Run a second, instrumented pass for per-stage timings'],
+        ]
+        optParameters = [
+            ['mrt', 'm', None, 'MRT dump to replay (TABLE_DUMP_V2 or BGP4MP)'],
+            ['peer', 'p', None, 'TABLE_DUMP_V2 peer index or BGP4MP peer AS to replay (default: first seen)'],
+            ['synthetic', 'n', '800000', 'Routes in the synthetic table, when no MRT dump is given'],
+            ['paths', 'a', '50000', 'Distinct attribute sets in the synthetic table'],
+            ['chunk', 'c', '16384', 'Bytes per dataReceived call'],
+            ['baseline', 'b', None, 'Compare against results saved with --save-baseline'],
+            ['save-baseline', 's', None, 'Save results as a baseline'],
+        ]
+    try:
+        options = Options()
+        options.parseOptions()
+        config = dict(options)
+    except usage.UsageError, errortext:
+        print '%s: %s' % (sys.argv[0], errortext)
+        print '%s: Try --help for usage details.' % (sys.argv[0])
+        sys.exit(1)
+
+    start = time.time()
+    if config['mrt']:
+        peer = int(config['peer']) if config['peer'] is not None else None
+        messages = readTableDump(config['mrt'], peer)
+    else:
+        messages = syntheticTable(int(config['synthetic']), int(config['paths']))
+    stream = ''.join(messages)
+    print 'Built %s bytes of UPDATEs in %.1fs' % (len(stream), time.time() - start)
+
+    results = run(config, stream)
+    baseline = json.load(open(config['baseline'])) if config['baseline'] else None
+    report(results, baseline)
+    if config['save-baseline']:
+        json.dump(results, open(config['save-baseline'], 'w'), indent=2)
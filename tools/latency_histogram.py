@@ -1,11 +1,17 @@
 import matplotlib.pyplot as plt
-import pickle
+from kyro import archive
+import numpy
+import sys
+import time
 
-hostinfo = pickle.load(open('hosts.dat', 'r'))
-x = [host['latency'] for host in hostinfo if host['latency']]
+# usage: latency_histogram.py [archive name] [hours of history]
+name = sys.argv[1] if len(sys.argv) > 1 else 'measurements'
+start = time.time() - float(sys.argv[2]) * 3600.0 if len(sys.argv) > 2 else None
+
+hosts, latency, loss = archive.Archive(name).summarize(start)
+x = latency[~numpy.isnan(latency)]
 print "Data points: %s" % len(x)
 
-mu, sigma = 100, 15
 n, bins, patches = plt.hist(x, 200, normed=1, range=(0, 800), facecolor='green', alpha=0.75)
 
 plt.xlabel('Network Latency (ms)')
@@ -13,4 +19,4 @@ plt.ylabel('Frequency')
 plt.axis([0, 800, 0, 0.01])
 plt.grid(True)
 
-plt.show()
\ No newline at end of file
+plt.show()
@@ -1,15 +1,20 @@
 import matplotlib.pyplot as plt
-import pickle
+from kyro import archive
+import sys
+import time
 
-hostinfo = pickle.load(open('hosts.dat', 'r'))
-x = [host['loss'] for host in hostinfo if host['loss'] and host['loss'] != 100.0]
+# usage: loss_histogram.py [archive name] [hours of history]
+name = sys.argv[1] if len(sys.argv) > 1 else 'measurements'
+start = time.time() - float(sys.argv[2]) * 3600.0 if len(sys.argv) > 2 else None
+
+hosts, latency, loss = archive.Archive(name).summarize(start)
+x = loss[(loss > 0) & (loss != 100.0)]
 print "Data points: %s" % len(x)
 
-mu, sigma = 100, 15
 n, bins, patches = plt.hist(x, 100, range=(0, 100), facecolor='green', alpha=0.75)
 
 plt.xlabel('Packet Loss (%)')
-plt.ylabel('Number of networks (out of 18505)')
+plt.ylabel('Number of networks (out of %s)' % len(hosts))
 plt.grid(True)
 
-plt.show()
\ No newline at end of file
+plt.show()